@@ -1,26 +1,59 @@
 import copy
 import json
+import asyncio
 import os
 import logging
+import math
+import tempfile
+import time
 import uuid
 import httpx
 from quart import (
     Blueprint,
     Quart,
+    current_app,
+    g,
     jsonify,
     make_response,
     request,
     send_from_directory,
 )
 from quart_cors import cors
-from openai import AsyncAzureOpenAI
-from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from openai import DEFAULT_MAX_RETRIES, AsyncAzureOpenAI, RateLimitError
+from azure.identity.aio import DefaultAzureCredential
+from backend.aoai.client import AzureADTokenProvider, create_http_client, warmup_connections, SEARCH_SCOPE
 from backend.auth.auth_utils import get_authenticated_user_details
-from backend.history.cosmosdbservice import CosmosConversationClient
-from backend.utils import format_as_ndjson, format_stream_response, generateFilterString, parse_multi_columns, format_non_streaming_response
+from backend.history.cosmosdbservice import CosmosConversationClient, decode_continuation_token, encode_continuation_token
+from backend.history.conversationdocuments import DocumentConversationClient
+from backend.history.journal import HistoryJournal, WriteBehindConversationClient
+from backend.user.userdetailsservice import CosmosUserDetailsClient
+from backend.cache.response_cache import (
+    InMemoryCacheBackend,
+    ResponseCache,
+    SQLiteCacheBackend,
+    cacheable_response,
+    make_cache_key,
+    merge_frames,
+    replay_response,
+    replay_stream_response,
+)
+from backend.cache.semantic_cache import SemanticCache, latest_user_message
+from backend.search.retrieval import SearchClient, FallbackSearchClient, HybridSearchClient, Retriever
+from backend.search.vector_index import VectorIndex, LocalSearchClient
+from backend.search.keyword_index import KeywordIndex, KeywordSearchClient
+from backend.auth.graph_groups import GraphClient, GroupFilterCache, group_filter_key
+from backend.aoai.embeddings import EmbeddingClient
+from backend.aoai.prompt_budget import HistoryAssembler, TokenCounter
+from backend.aoai.admission import AdmissionController, SlotStream
+from backend.aoai.router import CircuitBreaker, Deployment, DeploymentRouter, parse_deployments
+from backend.aoai.hedging import HedgePolicy
+from backend.aoai.stream_metrics import ERROR, StreamTimer
+from backend import metrics
+from backend.serialization import FastJSONProvider
+from backend.utils import format_as_ndjson, format_as_delta_ndjson, format_stream_response, parse_multi_columns, format_non_streaming_response
 import jwt
 from jwt.exceptions import InvalidTokenError
-from azure.cosmos import CosmosClient, exceptions
+from azure.cosmos import exceptions
 from azure.cosmos.exceptions import CosmosHttpResponseError
 
 # Current minimum Azure OpenAI version supported
@@ -36,52 +69,30 @@ UI_FAVICON = os.environ.get("UI_FAVICON") or "/favicon.ico"
 UI_SHOW_SHARE_BUTTON = os.environ.get("UI_SHOW_SHARE_BUTTON", "true").lower() == "true"
 
 # CosmosDB Configuration
-USER_DETAILS_CONTAINER_NAME = 'UserDetails'
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
 AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
 AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
 AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 AZURE_COSMOSDB_ACCOUNT_URI = os.environ.get("AZURE_COSMOSDB_ACCOUNT_URI")
 AZURE_COSMOSDB_ENABLE_FEEDBACK = os.environ.get("AZURE_COSMOSDB_ENABLE_FEEDBACK", "true").lower() == "true"
+AZURE_COSMOSDB_PREFERRED_REGIONS = os.environ.get("AZURE_COSMOSDB_PREFERRED_REGIONS")
+AZURE_COSMOSDB_MAX_CONNECTIONS = int(os.environ.get("AZURE_COSMOSDB_MAX_CONNECTIONS", 100))
+AZURE_COSMOSDB_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("AZURE_COSMOSDB_MAX_CONNECTIONS_PER_HOST", 0))
+AZURE_COSMOSDB_LIST_PAGE_SIZE = int(os.environ.get("AZURE_COSMOSDB_LIST_PAGE_SIZE", 25))
+AZURE_COSMOSDB_LIST_MAX_PAGE_SIZE = 100
+AZURE_COSMOSDB_DELETE_CONCURRENCY = int(os.environ.get("AZURE_COSMOSDB_DELETE_CONCURRENCY", 4))
+AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY = os.environ.get("AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY", "false").lower() == "true"
+AZURE_COSMOSDB_STORAGE_LAYOUT = os.environ.get("AZURE_COSMOSDB_STORAGE_LAYOUT", "items").lower()
+AZURE_COSMOSDB_MESSAGE_CACHE_SIZE = int(os.environ.get("AZURE_COSMOSDB_MESSAGE_CACHE_SIZE", 256))
+AZURE_COSMOSDB_CONVERSATION_INDEX_SIZE = int(os.environ.get("AZURE_COSMOSDB_CONVERSATION_INDEX_SIZE", 100))
+AZURE_COSMOSDB_LOG_OPERATIONS = os.environ.get("AZURE_COSMOSDB_LOG_OPERATIONS", "false").lower() == "true"
+AZURE_COSMOSDB_WRITE_BEHIND = os.environ.get("AZURE_COSMOSDB_WRITE_BEHIND", "false").lower() == "true"
+AZURE_COSMOSDB_JOURNAL_PATH = os.environ.get("AZURE_COSMOSDB_JOURNAL_PATH") or os.path.join(tempfile.gettempdir(), "history_journal.sqlite3")
+AZURE_COSMOSDB_FLUSH_INTERVAL_MS = int(os.environ.get("AZURE_COSMOSDB_FLUSH_INTERVAL_MS", 50))
 AZURE_COSMOSDB_USER_DETAILS_CONTAINER = 'userdetails'
 AZURE_COSMOSDB_USER_DETAILS_DATABASE = 'userdetails'
-
-# Global cosmos client holders
-cosmos_clients = None
-
-def init_cosmos_clients():
-    """Initialize CosmosDB clients safely"""
-    global cosmos_clients
-    try:
-        url = AZURE_COSMOSDB_ACCOUNT_URI
-        if not url:
-            logging.warning("Cosmos DB URL not configured")
-            return None
-        
-        key = AZURE_COSMOSDB_ACCOUNT_KEY
-        if not key:
-            logging.warning("Cosmos DB key not configured")
-            return None
-            
-        client = CosmosClient(url, credential=key)
-        
-        # User details containers
-        database = client.get_database_client(AZURE_COSMOSDB_USER_DETAILS_DATABASE)
-        container = database.get_container_client(AZURE_COSMOSDB_USER_DETAILS_CONTAINER)
-        user_details_container = database.get_container_client(USER_DETAILS_CONTAINER_NAME)
-        
-        cosmos_clients = {
-            'client': client,
-            'database': database,
-            'container': container,
-            'user_details_container': user_details_container
-        }
-        
-        logging.info("CosmosDB clients initialized successfully")
-        return cosmos_clients
-    except Exception as e:
-        logging.error(f"Failed to initialize CosmosDB: {e}")
-        return None
+## a failed start of the user details client is retried by requests at most this often, in seconds
+USER_DETAILS_RETRY_INTERVAL = 30
 
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
@@ -112,6 +123,20 @@ AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
 AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
 AZURE_SEARCH_STRICTNESS = os.environ.get("AZURE_SEARCH_STRICTNESS", SEARCH_STRICTNESS)
+AZURE_SEARCH_ENDPOINT = os.environ.get("AZURE_SEARCH_ENDPOINT") or (f"https://{AZURE_SEARCH_SERVICE}.search.windows.net" if AZURE_SEARCH_SERVICE else None)
+AZURE_SEARCH_EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("AZURE_SEARCH_EMBEDDING_CACHE_MAX_ENTRIES", 1000))
+AZURE_SEARCH_RESULT_CACHE_TTL = float(os.environ.get("AZURE_SEARCH_RESULT_CACHE_TTL", 60))
+AZURE_SEARCH_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("AZURE_SEARCH_RESULT_CACHE_MAX_ENTRIES", 1000))
+AZURE_SEARCH_GROUPS_CACHE_TTL = float(os.environ.get("AZURE_SEARCH_GROUPS_CACHE_TTL", 300))
+AZURE_SEARCH_GROUPS_REFRESH_MARGIN = float(os.environ.get("AZURE_SEARCH_GROUPS_REFRESH_MARGIN", 60))
+AZURE_SEARCH_GROUPS_CACHE_MAX_ENTRIES = int(os.environ.get("AZURE_SEARCH_GROUPS_CACHE_MAX_ENTRIES", 10000))
+
+# Local memory-mapped vector and BM25 keyword indexes (python -m backend.search.vector_index and
+# backend.search.keyword_index); searched directly when no search service is configured, otherwise
+# used when the service fails. With both, results are fused by reciprocal rank.
+LOCAL_VECTOR_INDEX_PATH = os.environ.get("LOCAL_VECTOR_INDEX_PATH")
+LOCAL_VECTOR_INDEX_NPROBE = int(os.environ.get("LOCAL_VECTOR_INDEX_NPROBE", 8))
+LOCAL_KEYWORD_INDEX_PATH = os.environ.get("LOCAL_KEYWORD_INDEX_PATH")
 
 # AOAI Integration Settings
 AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
@@ -135,9 +160,68 @@ AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turb
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
+AZURE_OPENAI_TITLE_MODEL = os.environ.get("AZURE_OPENAI_TITLE_MODEL") or AZURE_OPENAI_MODEL
+AZURE_OPENAI_TITLE_MAX_INPUT_TOKENS = int(os.environ.get("AZURE_OPENAI_TITLE_MAX_INPUT_TOKENS", 256))
+
+# Prompt budget settings; 0 sends the whole conversation
+AZURE_OPENAI_MAX_PROMPT_TOKENS = int(os.environ.get("AZURE_OPENAI_MAX_PROMPT_TOKENS", 0))
+HISTORY_TRIM_STRATEGY = os.environ.get("HISTORY_TRIM_STRATEGY", "drop").lower()
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL") or AZURE_OPENAI_TITLE_MODEL
+HISTORY_SUMMARY_MAX_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", 256))
+HISTORY_SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get("HISTORY_SUMMARY_CACHE_MAX_ENTRIES", 1000))
+
+# AOAI connection pool settings
+AZURE_OPENAI_MAX_CONNECTIONS = int(os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", 100))
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20))
+AZURE_OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", 30))
+AZURE_OPENAI_HTTP2 = os.environ.get("AZURE_OPENAI_HTTP2", "true").lower() == "true"
+AZURE_OPENAI_WARMUP_CONNECTIONS = int(os.environ.get("AZURE_OPENAI_WARMUP_CONNECTIONS", 1))
+AZURE_OPENAI_TOKEN_REFRESH_MARGIN = int(os.environ.get("AZURE_OPENAI_TOKEN_REFRESH_MARGIN", 300))
+
+# Deployments of the chat model to balance across, as a JSON list of {"endpoint", "deployment", "key", "name"}
+# objects; replaces AZURE_OPENAI_ENDPOINT/AZURE_OPENAI_KEY. "deployment" defaults to AZURE_OPENAI_MODEL and
+# entries without a key use Azure AD auth. The first entry also serves titles and summaries.
+AZURE_OPENAI_DEPLOYMENTS = os.environ.get("AZURE_OPENAI_DEPLOYMENTS")
+AZURE_OPENAI_CIRCUIT_BREAKER_FAILURES = int(os.environ.get("AZURE_OPENAI_CIRCUIT_BREAKER_FAILURES", 3))
+AZURE_OPENAI_CIRCUIT_BREAKER_RESET = float(os.environ.get("AZURE_OPENAI_CIRCUIT_BREAKER_RESET", 30))
+
+# Hedged streaming requests across AZURE_OPENAI_DEPLOYMENTS; without a fixed delay, the hedge starts
+# once the first token is later than the given percentile of recent times to first token
+AZURE_OPENAI_HEDGE_REQUESTS = os.environ.get("AZURE_OPENAI_HEDGE_REQUESTS", "false").lower() == "true"
+AZURE_OPENAI_HEDGE_DELAY = os.environ.get("AZURE_OPENAI_HEDGE_DELAY")
+AZURE_OPENAI_HEDGE_PERCENTILE = float(os.environ.get("AZURE_OPENAI_HEDGE_PERCENTILE", 90))
+AZURE_OPENAI_HEDGE_BUDGET_PERCENT = float(os.environ.get("AZURE_OPENAI_HEDGE_BUDGET_PERCENT", 10))
+
+# Admission control in front of chat completion calls, per worker; 0 concurrent requests means no limit
+AZURE_OPENAI_MAX_CONCURRENT_REQUESTS = int(os.environ.get("AZURE_OPENAI_MAX_CONCURRENT_REQUESTS", 0))
+AZURE_OPENAI_MAX_QUEUED_REQUESTS = int(os.environ.get("AZURE_OPENAI_MAX_QUEUED_REQUESTS", 100))
+AZURE_OPENAI_QUEUE_TIMEOUT = float(os.environ.get("AZURE_OPENAI_QUEUE_TIMEOUT", 10))
 
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
 
+# Compact "delta" stream format, requested per call with the X-Stream-Format header or ?stream_format=
+STREAM_FORMAT_DELTA = "delta"
+STREAM_DELTA_FLUSH_INTERVAL_MS = int(os.environ.get("STREAM_DELTA_FLUSH_INTERVAL_MS", 30))
+STREAM_DELTA_FLUSH_BYTES = int(os.environ.get("STREAM_DELTA_FLUSH_BYTES", 64))
+
+# Response cache settings
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory").lower()
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+RESPONSE_CACHE_SQLITE_PATH = os.environ.get("RESPONSE_CACHE_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "response_cache.sqlite3")
+
+# Metrics settings
+METRICS_SQLITE_PATH = os.environ.get("METRICS_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "metrics.sqlite3")
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("METRICS_PUBLISH_INTERVAL", 15))
+
+# Semantic cache settings
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", 3600))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 1000))
+SEMANTIC_CACHE_MAX_TURNS = int(os.environ.get("SEMANTIC_CACHE_MAX_TURNS", 1))
+
 # Chat History CosmosDB Integration Settings
 CHAT_HISTORY_ENABLED = AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
 
@@ -179,16 +263,27 @@ def decode_jwt(token):
 # Check if data source is configured
 def should_use_data():
     global DATASOURCE_TYPE
-    if AZURE_SEARCH_SERVICE and AZURE_SEARCH_INDEX:
+    if AZURE_SEARCH_ENDPOINT and AZURE_SEARCH_INDEX:
         DATASOURCE_TYPE = "AzureCognitiveSearch"
         logging.debug("Using Azure Cognitive Search")
         return True
+    if LOCAL_VECTOR_INDEX_PATH or LOCAL_KEYWORD_INDEX_PATH:
+        DATASOURCE_TYPE = "LocalIndex"
+        logging.debug("Using the local search indexes")
+        return True
     return False
 
 SHOULD_USE_DATA = should_use_data()
 
 # Initialize Azure OpenAI Client
-def init_openai_client():
+def get_openai_endpoint():
+    return (
+        AZURE_OPENAI_ENDPOINT
+        if AZURE_OPENAI_ENDPOINT
+        else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
+    )
+
+def init_openai_client(ad_token_provider=None, http_client=None):
     try:
         if (
             AZURE_OPENAI_PREVIEW_API_VERSION
@@ -203,19 +298,11 @@ def init_openai_client():
                 "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
             )
 
-        endpoint = (
-            AZURE_OPENAI_ENDPOINT
-            if AZURE_OPENAI_ENDPOINT
-            else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-        )
+        endpoint = get_openai_endpoint()
 
         aoai_api_key = AZURE_OPENAI_KEY
-        ad_token_provider = None
-        if not aoai_api_key:
-            logging.debug("No AZURE_OPENAI_KEY found, using Azure AD auth")
-            ad_token_provider = get_bearer_token_provider(
-                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
-            )
+        if not aoai_api_key and not ad_token_provider:
+            raise Exception("AZURE_OPENAI_KEY or an Azure AD token provider is required")
 
         deployment = AZURE_OPENAI_MODEL
         if not deployment:
@@ -229,6 +316,7 @@ def init_openai_client():
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
         )
 
         return azure_openai_client
@@ -236,6 +324,118 @@ def init_openai_client():
         logging.exception("Exception in Azure OpenAI initialization")
         raise e
 
+def get_openai_deployments():
+    if AZURE_OPENAI_DEPLOYMENTS:
+        return parse_deployments(json.loads(AZURE_OPENAI_DEPLOYMENTS), default_deployment=AZURE_OPENAI_MODEL)
+    return [{"name": AZURE_OPENAI_MODEL, "endpoint": get_openai_endpoint(), "deployment": AZURE_OPENAI_MODEL, "key": AZURE_OPENAI_KEY}]
+
+def init_openai_router(deployments, ad_token_provider=None, http_client=None):
+    if not AZURE_OPENAI_DEPLOYMENTS:
+        clients = [init_openai_client(ad_token_provider, http_client)]
+    else:
+        ## with somewhere to fail over to, a throttled deployment should not be retried in place
+        max_retries = 0 if len(deployments) > 1 else DEFAULT_MAX_RETRIES
+        clients = [
+            AsyncAzureOpenAI(
+                api_version=AZURE_OPENAI_PREVIEW_API_VERSION,
+                api_key=deployment["key"],
+                azure_ad_token_provider=None if deployment["key"] else ad_token_provider,
+                default_headers={"x-ms-useragent": USER_AGENT},
+                azure_endpoint=deployment["endpoint"],
+                http_client=http_client,
+                max_retries=max_retries,
+            )
+            for deployment in deployments
+        ]
+
+    hedge_policy = None
+    if AZURE_OPENAI_HEDGE_REQUESTS:
+        if len(deployments) > 1:
+            hedge_policy = HedgePolicy(
+                delay=float(AZURE_OPENAI_HEDGE_DELAY) if AZURE_OPENAI_HEDGE_DELAY else None,
+                percentile=AZURE_OPENAI_HEDGE_PERCENTILE,
+                budget_percent=AZURE_OPENAI_HEDGE_BUDGET_PERCENT,
+            )
+        else:
+            logging.warning("AZURE_OPENAI_HEDGE_REQUESTS needs at least two AZURE_OPENAI_DEPLOYMENTS, hedging is disabled")
+
+    return DeploymentRouter([
+        Deployment(
+            deployment["name"],
+            deployment["endpoint"],
+            deployment["deployment"],
+            client,
+            CircuitBreaker(AZURE_OPENAI_CIRCUIT_BREAKER_FAILURES, AZURE_OPENAI_CIRCUIT_BREAKER_RESET),
+        )
+        for deployment, client in zip(deployments, clients)
+    ], hedge_policy=hedge_policy)
+
+# Create the per-worker Azure OpenAI clients, their shared connection pool and token cache
+async def start_openai_client(app):
+    ad_token_provider = None
+
+    async def observe_rate_limits(response):
+        if app.openai_router is not None:
+            await app.openai_router.observe_response(response)
+
+    http_client = create_http_client(
+        max_connections=AZURE_OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=AZURE_OPENAI_KEEPALIVE_EXPIRY,
+        http2=AZURE_OPENAI_HTTP2,
+        event_hooks={"response": [observe_rate_limits]},
+    )
+    try:
+        deployments = get_openai_deployments()
+        if any(not deployment["key"] for deployment in deployments):
+            logging.debug("No Azure OpenAI key found for every deployment, using Azure AD auth")
+            ad_token_provider = AzureADTokenProvider(
+                DefaultAzureCredential(), refresh_margin=AZURE_OPENAI_TOKEN_REFRESH_MARGIN
+            )
+            await ad_token_provider.start()
+
+        openai_router = init_openai_router(deployments, ad_token_provider, http_client)
+        if AZURE_OPENAI_WARMUP_CONNECTIONS > 0:
+            for endpoint in dict.fromkeys(deployment["endpoint"] for deployment in deployments):
+                await warmup_connections(http_client, endpoint, AZURE_OPENAI_WARMUP_CONNECTIONS)
+    except Exception:
+        await http_client.aclose()
+        if ad_token_provider:
+            await ad_token_provider.close()
+        raise
+
+    app.openai_router = openai_router
+    app.admission_controller.rate_limit = openai_router
+    app.azure_openai_client = openai_router.primary.client
+    app.azure_openai_token_provider = ad_token_provider
+    return app.azure_openai_client
+
+async def stop_openai_client(app):
+    openai_router = getattr(app, "openai_router", None)
+    if openai_router:
+        ## the clients share one connection pool, closing it again is a no-op
+        for deployment in openai_router.deployments:
+            await deployment.client.close()
+    ad_token_provider = getattr(app, "azure_openai_token_provider", None)
+    if ad_token_provider:
+        await ad_token_provider.close()
+    app.openai_router = None
+    app.azure_openai_client = None
+    app.azure_openai_token_provider = None
+
+async def get_openai_router():
+    ## normally created in before_serving; retry here if startup failed or the app was not started
+    if getattr(current_app, "openai_router", None) is None:
+        ## one restart at a time, concurrent requests wait for it instead of each building (and leaking) a pool and token provider
+        async with current_app.openai_client_lock:
+            if getattr(current_app, "openai_router", None) is None:
+                await start_openai_client(current_app)
+    return current_app.openai_router
+
+async def get_openai_client():
+    await get_openai_router()
+    return current_app.azure_openai_client
+
 # Initialize CosmosDB Client for Chat History
 def init_cosmosdb_client():
     cosmos_conversation_client = None
@@ -248,12 +448,33 @@ def init_cosmosdb_client():
             else:
                 credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
-            cosmos_conversation_client = CosmosConversationClient(
+            preferred_locations = None
+            if AZURE_COSMOSDB_PREFERRED_REGIONS:
+                preferred_locations = [region.strip() for region in parse_multi_columns(AZURE_COSMOSDB_PREFERRED_REGIONS)]
+
+            if AZURE_COSMOSDB_STORAGE_LAYOUT == "items":
+                conversation_client_class = CosmosConversationClient
+            elif AZURE_COSMOSDB_STORAGE_LAYOUT == "document":
+                if AZURE_COSMOSDB_WRITE_BEHIND:
+                    raise Exception("AZURE_COSMOSDB_WRITE_BEHIND is not supported with AZURE_COSMOSDB_STORAGE_LAYOUT 'document'")
+                conversation_client_class = DocumentConversationClient
+            else:
+                raise Exception(f"Unsupported AZURE_COSMOSDB_STORAGE_LAYOUT '{AZURE_COSMOSDB_STORAGE_LAYOUT}', expected 'items' or 'document'")
+
+            cosmos_conversation_client = conversation_client_class(
                 cosmosdb_endpoint=cosmos_endpoint, 
                 credential=credential, 
                 database_name=AZURE_COSMOSDB_DATABASE,
                 container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
                 enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+                preferred_locations=preferred_locations,
+                max_connections=AZURE_COSMOSDB_MAX_CONNECTIONS,
+                max_connections_per_host=AZURE_COSMOSDB_MAX_CONNECTIONS_PER_HOST,
+                delete_concurrency=AZURE_COSMOSDB_DELETE_CONCURRENCY,
+                delete_by_partition_key=AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY,
+                message_cache_size=AZURE_COSMOSDB_MESSAGE_CACHE_SIZE,
+                conversation_index_size=AZURE_COSMOSDB_CONVERSATION_INDEX_SIZE,
+                log_operations=AZURE_COSMOSDB_LOG_OPERATIONS,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization")
@@ -264,14 +485,291 @@ def init_cosmosdb_client():
 
     return cosmos_conversation_client
 
+# Create the per-worker conversation history client and check it can reach its container
+async def start_cosmosdb_client(app):
+    cosmos_conversation_client = init_cosmosdb_client()
+    if cosmos_conversation_client:
+        cosmos_db_ok, message = await cosmos_conversation_client.ensure()
+        if not cosmos_db_ok:
+            await cosmos_conversation_client.close()
+            raise Exception(message)
+        if AZURE_COSMOSDB_WRITE_BEHIND:
+            ## writes return once journaled on local disk and reach CosmosDB in the background
+            cosmos_conversation_client = WriteBehindConversationClient(
+                cosmos_conversation_client,
+                HistoryJournal(AZURE_COSMOSDB_JOURNAL_PATH),
+                flush_interval=AZURE_COSMOSDB_FLUSH_INTERVAL_MS / 1000,
+            )
+            await cosmos_conversation_client.start()
+    app.cosmos_conversation_client = cosmos_conversation_client
+    return cosmos_conversation_client
+
+async def stop_cosmosdb_client(app):
+    cosmos_conversation_client = getattr(app, "cosmos_conversation_client", None)
+    if cosmos_conversation_client:
+        await cosmos_conversation_client.close()
+    app.cosmos_conversation_client = None
+
+async def get_cosmosdb_client():
+    ## normally created in before_serving; retry here if startup failed or the app was not started
+    cosmos_conversation_client = getattr(current_app, "cosmos_conversation_client", None)
+    if cosmos_conversation_client is None:
+        ## one restart at a time, concurrent requests wait for it instead of each building (and leaking) a client
+        async with current_app.cosmos_client_lock:
+            cosmos_conversation_client = getattr(current_app, "cosmos_conversation_client", None)
+            if cosmos_conversation_client is None:
+                cosmos_conversation_client = await start_cosmosdb_client(current_app)
+    return cosmos_conversation_client
+
+# Initialize CosmosDB Client for User Details
+def init_user_details_client():
+    if not AZURE_COSMOSDB_ACCOUNT_URI or not AZURE_COSMOSDB_ACCOUNT_KEY:
+        logging.debug("CosmosDB user details not configured")
+        return None
+
+    try:
+        return CosmosUserDetailsClient(
+            cosmosdb_endpoint=AZURE_COSMOSDB_ACCOUNT_URI,
+            credential=AZURE_COSMOSDB_ACCOUNT_KEY,
+            database_name=AZURE_COSMOSDB_USER_DETAILS_DATABASE,
+            container_name=AZURE_COSMOSDB_USER_DETAILS_CONTAINER,
+            log_operations=AZURE_COSMOSDB_LOG_OPERATIONS,
+        )
+    except Exception as e:
+        logging.exception("Exception in CosmosDB user details initialization")
+        raise e
+
+async def start_user_details_client(app):
+    try:
+        user_details_client = init_user_details_client()
+        if user_details_client:
+            cosmos_db_ok, message = await user_details_client.ensure()
+            if not cosmos_db_ok:
+                await user_details_client.close()
+                raise Exception(message)
+    except Exception as e:
+        app.user_details_failure = (time.monotonic(), str(e))
+        raise
+    app.user_details_failure = None
+    app.user_details_client = user_details_client
+    return user_details_client
+
+async def stop_user_details_client(app):
+    user_details_client = getattr(app, "user_details_client", None)
+    if user_details_client:
+        await user_details_client.close()
+    app.user_details_client = None
+
+async def get_user_details_client():
+    ## normally created in before_serving; retry here if startup failed, once at a time and at most every USER_DETAILS_RETRY_INTERVAL seconds
+    user_details_client = getattr(current_app, "user_details_client", None)
+    if user_details_client is None:
+        async with current_app.user_details_client_lock:
+            user_details_client = current_app.user_details_client
+            if user_details_client is None:
+                if current_app.user_details_failure:
+                    failed_at, error = current_app.user_details_failure
+                    if time.monotonic() - failed_at < USER_DETAILS_RETRY_INTERVAL:
+                        raise Exception(error)
+                user_details_client = await start_user_details_client(current_app)
+    return user_details_client
+
+# Initialize the chat response cache
+def init_response_cache():
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        backend = SQLiteCacheBackend(RESPONSE_CACHE_SQLITE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+    elif RESPONSE_CACHE_BACKEND == "memory":
+        backend = InMemoryCacheBackend(max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+    else:
+        raise Exception(f"Unsupported RESPONSE_CACHE_BACKEND '{RESPONSE_CACHE_BACKEND}', expected 'memory' or 'sqlite'")
+
+    return ResponseCache(backend, ttl=RESPONSE_CACHE_TTL)
+
+# Create the per-worker embedding client used for query embeddings
+async def start_embedding_client(app):
+    if app.embedding_client is not None:
+        return app.embedding_client
+    if not AZURE_OPENAI_EMBEDDING_ENDPOINT:
+        raise Exception("AZURE_OPENAI_EMBEDDING_ENDPOINT is required for query embeddings")
+
+    ad_token_provider = None
+    if not AZURE_OPENAI_EMBEDDING_KEY:
+        ## its own provider, the chat client's is closed whenever that client is restarted
+        ad_token_provider = AzureADTokenProvider(
+            DefaultAzureCredential(), refresh_margin=AZURE_OPENAI_TOKEN_REFRESH_MARGIN
+        )
+        await ad_token_provider.start()
+        app.embedding_token_provider = ad_token_provider
+
+    app.embedding_client = EmbeddingClient(
+        AZURE_OPENAI_EMBEDDING_ENDPOINT,
+        api_key=AZURE_OPENAI_EMBEDDING_KEY,
+        ad_token_provider=ad_token_provider,
+        http_client=create_http_client(
+            max_connections=AZURE_OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AZURE_OPENAI_KEEPALIVE_EXPIRY,
+            http2=AZURE_OPENAI_HTTP2,
+        ),
+        default_headers={"x-ms-useragent": USER_AGENT},
+    )
+    return app.embedding_client
+
+async def stop_embedding_client(app):
+    if getattr(app, "embedding_client", None):
+        await app.embedding_client.close()
+    if getattr(app, "embedding_token_provider", None):
+        await app.embedding_token_provider.close()
+    app.embedding_client = None
+    app.embedding_token_provider = None
+
+# Initialize the semantic response cache
+async def start_semantic_cache(app):
+    embedding_client = await start_embedding_client(app)
+    app.semantic_cache = SemanticCache(
+        embedding_client,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl=SEMANTIC_CACHE_TTL,
+        max_turns=SEMANTIC_CACHE_MAX_TURNS,
+    )
+    return app.semantic_cache
+
+# Create the per-worker retrieval stage for Azure OpenAI on your data
+async def start_retriever(app):
+    query_type = AZURE_SEARCH_QUERY_TYPE or ("semantic" if AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" else "simple")
+    vector_columns = parse_multi_columns(AZURE_SEARCH_VECTOR_COLUMNS) if AZURE_SEARCH_VECTOR_COLUMNS else None
+    ## load off the event loop; only the small arrays are read, the rest is memory-mapped
+    local_vector_client = local_keyword_client = None
+    if LOCAL_VECTOR_INDEX_PATH:
+        local_index = await asyncio.to_thread(VectorIndex.load, LOCAL_VECTOR_INDEX_PATH)
+        local_vector_client = LocalSearchClient(local_index, nprobe=LOCAL_VECTOR_INDEX_NPROBE)
+        logging.info(f"Loaded local vector index of {len(local_index)} chunks from {LOCAL_VECTOR_INDEX_PATH}")
+    if LOCAL_KEYWORD_INDEX_PATH:
+        local_index = await asyncio.to_thread(KeywordIndex.load, LOCAL_KEYWORD_INDEX_PATH)
+        local_keyword_client = KeywordSearchClient(local_index)
+        logging.info(f"Loaded local keyword index of {len(local_index)} chunks from {LOCAL_KEYWORD_INDEX_PATH}")
+    local_search_client = local_vector_client or local_keyword_client
+    if local_vector_client and local_keyword_client:
+        local_search_client = HybridSearchClient([local_keyword_client, local_vector_client])
+    embedding_client = await start_embedding_client(app) if query_type.startswith("vector") or local_vector_client else None
+
+    if not AZURE_SEARCH_ENDPOINT:
+        ## the local indexes are the only data source, searched by what they hold
+        search_client = local_search_client
+        if local_vector_client:
+            query_type = "vectorSimpleHybrid" if local_keyword_client else "vector"
+            vector_columns = vector_columns or ["contentVector"]
+        else:
+            query_type = "simple"
+    else:
+        ad_token_provider = None
+        if not AZURE_SEARCH_KEY:
+            ad_token_provider = AzureADTokenProvider(
+                DefaultAzureCredential(), scope=SEARCH_SCOPE, refresh_margin=AZURE_OPENAI_TOKEN_REFRESH_MARGIN
+            )
+            await ad_token_provider.start()
+            app.search_token_provider = ad_token_provider
+
+        search_client = SearchClient(
+            AZURE_SEARCH_ENDPOINT,
+            AZURE_SEARCH_INDEX,
+            create_http_client(
+                max_connections=AZURE_OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=AZURE_OPENAI_KEEPALIVE_EXPIRY,
+                http2=AZURE_OPENAI_HTTP2,
+                read_timeout=30,
+            ),
+            api_key=AZURE_SEARCH_KEY,
+            ad_token_provider=ad_token_provider,
+        )
+        if local_search_client is not None:
+            search_client = FallbackSearchClient(search_client, local_search_client)
+
+    app.retriever = Retriever(
+        search_client,
+        embedding_client=embedding_client,
+        query_type=query_type,
+        top_k=int(AZURE_SEARCH_TOP_K),
+        strictness=int(AZURE_SEARCH_STRICTNESS),
+        content_columns=parse_multi_columns(AZURE_SEARCH_CONTENT_COLUMNS) if AZURE_SEARCH_CONTENT_COLUMNS else None,
+        title_column=AZURE_SEARCH_TITLE_COLUMN or "title",
+        filename_column=AZURE_SEARCH_FILENAME_COLUMN or "filepath",
+        url_column=AZURE_SEARCH_URL_COLUMN or "url",
+        vector_columns=vector_columns,
+        semantic_configuration=AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG,
+        embedding_cache_size=AZURE_SEARCH_EMBEDDING_CACHE_MAX_ENTRIES,
+        result_cache_ttl=AZURE_SEARCH_RESULT_CACHE_TTL,
+        result_cache_size=AZURE_SEARCH_RESULT_CACHE_MAX_ENTRIES,
+    )
+    if local_vector_client is not None:
+        ## text-only fallback searches share the retriever's query embedding cache
+        local_vector_client.embed = app.retriever.embed_query
+
+    if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+        app.group_filter_cache = GroupFilterCache(
+            GraphClient(create_http_client(
+                max_connections=AZURE_OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=AZURE_OPENAI_KEEPALIVE_EXPIRY,
+                http2=AZURE_OPENAI_HTTP2,
+                read_timeout=30,
+            )),
+            AZURE_SEARCH_PERMITTED_GROUPS_COLUMN,
+            ttl=AZURE_SEARCH_GROUPS_CACHE_TTL,
+            refresh_margin=AZURE_SEARCH_GROUPS_REFRESH_MARGIN,
+            max_entries=AZURE_SEARCH_GROUPS_CACHE_MAX_ENTRIES,
+        )
+    return app.retriever
+
+async def stop_retriever(app):
+    if getattr(app, "retriever", None):
+        await app.retriever.close()
+    if getattr(app, "search_token_provider", None):
+        await app.search_token_provider.close()
+    if getattr(app, "group_filter_cache", None):
+        await app.group_filter_cache.close()
+    app.retriever = None
+    app.search_token_provider = None
+    app.group_filter_cache = None
+
+# Initialize the prompt budget; the tokenizer is loaded in before_serving
+def init_history_assembler():
+    if AZURE_OPENAI_MAX_PROMPT_TOKENS <= 0:
+        return None
+
+    return HistoryAssembler(
+        TokenCounter(AZURE_OPENAI_MODEL_NAME),
+        max_prompt_tokens=AZURE_OPENAI_MAX_PROMPT_TOKENS,
+        strategy=HISTORY_TRIM_STRATEGY,
+        summarize=summarize_history,
+        max_summaries=HISTORY_SUMMARY_CACHE_MAX_ENTRIES,
+    )
+
 # Prepare model args for OpenAI
-def prepare_model_args(request_body):
+def prepare_model_args(request_body, retrieval=None):
     request_messages = request_body.get("messages", [])
-    messages = [{"role": "system", "content": AZURE_OPENAI_SYSTEM_MESSAGE}]
+    system_messages = [{"role": "system", "content": AZURE_OPENAI_SYSTEM_MESSAGE}]
+    if retrieval is not None:
+        system_messages.append({"role": "system", "content": retrieval.prompt(in_domain=AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true")})
+    history = []
 
     for message in request_messages:
         if message:
-            messages.append({"role": message["role"], "content": message["content"]})
+            history.append({"role": message["role"], "content": message["content"]})
+
+    messages = system_messages + history
+    history_assembler = current_app.history_assembler
+    if history_assembler is not None:
+        conversation_id = request_body.get("history_metadata", {}).get("conversation_id")
+        messages, trim = history_assembler.assemble(system_messages, history, conversation_id)
+        g.prompt_tokens_trimmed = trim.tokens
+        if trim.summary_update:
+            current_app.add_background_task(history_assembler.update_summary, *trim.summary_update)
 
     model_args = {
         "messages": messages,
@@ -285,81 +783,399 @@ def prepare_model_args(request_body):
     return model_args
 
 # Chat Request Handler
-async def send_chat_request(request):
+def prepare_chat_request(request, retrieval=None):
     filtered_messages = [message for message in request['messages'] if message['role'] != 'tool']
     request['messages'] = filtered_messages
-    model_args = prepare_model_args(request)
+    return prepare_model_args(request, retrieval)
 
+# Security filter restricting search results to the signed-in user's groups
+async def get_search_filter():
+    group_filter_cache = current_app.group_filter_cache
+    if group_filter_cache is None:
+        return None
+    user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+    user_principal_id = get_authenticated_user_details(request_headers=request.headers)["user_principal_id"]
+    return await group_filter_cache.get_filter(group_filter_key(user_principal_id, user_token), user_token)
+
+# Retrieve passages for the latest user question; None when no data source is configured
+async def retrieve_documents(request_body):
+    retriever = current_app.retriever
+    if retriever is None:
+        return None
+    query = latest_user_message(request_body)
+    if not query:
+        return None
+    return await retriever.retrieve(query, await get_search_filter())
+
+async def send_chat_request(model_args):
+    admission_controller = current_app.admission_controller
+    slot = await admission_controller.acquire()
+    ## also released when the request ends, in case it is cancelled before its stream is ever iterated or closed
+    asyncio.current_task().add_done_callback(lambda task: slot.release())
+    handed_off = False
     try:
-        azure_openai_client = init_openai_client()
-        response = await azure_openai_client.chat.completions.create(**model_args)
+        openai_router = await get_openai_router()
+        response = await openai_router.create(model_args)
+        ## a streamed response holds its slot until the stream is finished or closed
+        if model_args.get("stream"):
+            handed_off = True
+            return SlotStream(response, slot)
+        return response
+    except RateLimitError as e:
+        raise admission_controller.throttled(e)
     except Exception as e:
         logging.exception("Exception in send_chat_request")
         raise e
+    finally:
+        ## runs on cancellation too, when the client disconnects while waiting for Azure OpenAI
+        if not handed_off:
+            slot.release()
+
+# Look the request up in the response caches. Returns (cached, pending); on a
+# miss, pending carries what store_cached_response needs once the answer is complete.
+async def lookup_cached_response(model_args):
+    pending = {"started": time.monotonic()}
+
+    response_cache = current_app.response_cache
+    if response_cache:
+        cache_key = make_cache_key(model_args)
+        cached = await response_cache.get(cache_key)
+        if cached:
+            return cached, None
+        pending["response_cache"] = response_cache
+        pending["cache_key"] = cache_key
+
+    semantic_cache = current_app.semantic_cache
+    if semantic_cache is not None:
+        cached, embedding = await semantic_cache.get(model_args)
+        if cached:
+            return cached, None
+        if embedding is not None:
+            pending["semantic_cache"] = semantic_cache
+            pending["embedding"] = embedding
+
+    return None, pending
+
+async def store_cached_response(pending, model_args, response):
+    if "response_cache" in pending:
+        await pending["response_cache"].set(pending["cache_key"], response)
+    if "semantic_cache" in pending:
+        pending["semantic_cache"].set(pending["embedding"], model_args, response, time.monotonic() - pending["started"])
+
+# on_complete(messages), when given, runs as a background task once the whole
+# answer has been produced, with the reply messages to persist
+async def complete_chat_request(request_body, on_complete=None):
+    retrieval = await retrieve_documents(request_body)
+    model_args = prepare_chat_request(request_body, retrieval)
+    history_metadata = request_body.get("history_metadata", {})
 
-    return response
+    cached, pending = await lookup_cached_response(model_args)
+    if cached:
+        response_obj = replay_response(cached, history_metadata)
+    else:
+        response = await send_chat_request(model_args)
+        response_obj = format_non_streaming_response(response, history_metadata)
+        if response_obj and retrieval is not None:
+            response_obj["choices"][0]["messages"].insert(0, retrieval.tool_message())
+        if response_obj:
+            await store_cached_response(pending, model_args, cacheable_response(response_obj, [response_obj["choices"][0]["messages"]]))
+    if response_obj and on_complete is not None:
+        current_app.add_background_task(on_complete, merge_frames([response_obj["choices"][0]["messages"]]))
+    return response_obj
+
+def persist_replayed_stream(frames, on_complete):
+    app = current_app._get_current_object()
 
-async def complete_chat_request(request_body):
-    response = await send_chat_request(request_body)
-    history_metadata = request_body.get("history_metadata", {})
-    return format_non_streaming_response(response, history_metadata)
+    async def generate():
+        messages = []
+        async for frame in frames:
+            messages.append(frame["choices"][0]["messages"])
+            yield frame
+        app.add_background_task(on_complete, merge_frames(messages))
+
+    return generate()
 
-async def stream_chat_request(request_body):
-    response = await send_chat_request(request_body)
+# stream_timer, when given, is told when Azure OpenAI is called and of every chunk it streams back
+async def stream_chat_request(request_body, on_complete=None, stream_timer=None):
+    retrieval = await retrieve_documents(request_body)
+    model_args = prepare_chat_request(request_body, retrieval)
     history_metadata = request_body.get("history_metadata", {})
 
+    cached, pending = await lookup_cached_response(model_args)
+    if cached:
+        replayed = replay_stream_response(cached, history_metadata)
+        return persist_replayed_stream(replayed, on_complete) if on_complete is not None else replayed
+
+    if stream_timer is not None:
+        stream_timer.upstream_call()
+    try:
+        response = await send_chat_request(model_args)
+    except Exception:
+        if stream_timer is not None:
+            stream_timer.finish(ERROR)
+        raise
+    app = current_app._get_current_object()
+
     async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata)
+        first_frame = None
+        frames = []
+        try:
+            async for completionChunk in response:
+                response_obj = format_stream_response(completionChunk, history_metadata)
+                if stream_timer is not None:
+                    stream_timer.chunk(bool(response_obj) and any(
+                        message["role"] == "assistant" and message.get("content") for message in response_obj["choices"][0]["messages"]
+                    ))
+                if response_obj:
+                    if first_frame is None and retrieval is not None:
+                        ## citations go out ahead of the first answer text
+                        response_obj["choices"][0]["messages"].insert(0, retrieval.tool_message())
+                    first_frame = first_frame or response_obj
+                    frames.append(response_obj["choices"][0]["messages"])
+                yield response_obj
+        except Exception:
+            ## the response body turns the error into a final line, so the stream would otherwise look complete
+            if stream_timer is not None:
+                stream_timer.finish(ERROR)
+            raise
+        finally:
+            ## release the upstream stream as soon as the client goes away
+            await response.aclose()
+
+        ## only complete streams reach this point, aborted ones are never cached or persisted
+        if frames and on_complete is not None:
+            app.add_background_task(on_complete, merge_frames(frames))
+        if frames:
+            await store_cached_response(pending, model_args, cacheable_response(first_frame, frames))
 
     return generate()
 
-async def conversation_internal(request_body):
+def requested_stream_format():
+    stream_format = request.headers.get("X-Stream-Format") or request.args.get("stream_format") or ""
+    return stream_format.strip().lower()
+
+
+async def conversation_internal(request_body, on_complete=None):
     try:
         if SHOULD_STREAM:
-            result = await stream_chat_request(request_body)
-            response = await make_response(format_as_ndjson(result))
+            stream_timer = StreamTimer(g.get("received_at"))
+            result = await stream_chat_request(request_body, on_complete, stream_timer)
+            if requested_stream_format() == STREAM_FORMAT_DELTA:
+                response = await make_response(stream_timer.timed(format_as_delta_ndjson(
+                    result,
+                    flush_interval=STREAM_DELTA_FLUSH_INTERVAL_MS / 1000,
+                    flush_bytes=STREAM_DELTA_FLUSH_BYTES,
+                )))
+                response.headers["X-Stream-Format"] = STREAM_FORMAT_DELTA
+            else:
+                response = await make_response(stream_timer.timed(format_as_ndjson(result)))
             response.timeout = None
             response.mimetype = "application/json-lines"
-            return response
         else:
-            result = await complete_chat_request(request_body)
-            return jsonify(result)
+            result = await complete_chat_request(request_body, on_complete)
+            response = jsonify(result)
+
+        if "prompt_tokens_trimmed" in g:
+            response.headers["X-Prompt-Tokens-Trimmed"] = str(g.prompt_tokens_trimmed)
+        return response
 
     except Exception as ex:
         logging.exception(ex)
+        if getattr(ex, "retry_after", None) is not None:
+            return jsonify({"error": str(ex)}), ex.status_code, {"Retry-After": str(math.ceil(ex.retry_after))}
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
             return jsonify({"error": str(ex)}), 500
 
 # Generate a title for the conversation
-async def generate_title(conversation_messages):
-    title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+TITLE_PROMPT = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+
+# Roughly 4 characters per token for English text
+CHARS_PER_TOKEN = 4
+
+def truncate_title_messages(conversation_messages, max_input_tokens):
+    ## keep the most recent user/assistant turns that fit in the budget, trimming the oldest one kept
+    budget = max_input_tokens * CHARS_PER_TOKEN
+    messages = []
+    for msg in reversed(conversation_messages):
+        if budget <= 0:
+            break
+        if msg["role"] not in ("user", "assistant") or not msg.get("content"):
+            continue
+        content = msg["content"][:budget]
+        messages.insert(0, {"role": msg["role"], "content": content})
+        budget -= len(content)
+    return messages
+
+def placeholder_title(conversation_messages):
+    user_messages = [msg["content"] for msg in conversation_messages if msg["role"] == "user"]
+    return user_messages[-1][:64] if user_messages else ""
 
-    messages = [
-        {"role": msg["role"], "content": msg["content"]}
-        for msg in conversation_messages
-    ]
-    messages.append({"role": "user", "content": title_prompt})
+async def generate_title(conversation_messages):
+    messages = truncate_title_messages(conversation_messages, AZURE_OPENAI_TITLE_MAX_INPUT_TOKENS)
+    messages.append({"role": "user", "content": TITLE_PROMPT})
 
     try:
-        azure_openai_client = init_openai_client()
+        azure_openai_client = await get_openai_client()
         response = await azure_openai_client.chat.completions.create(
-            model=AZURE_OPENAI_MODEL, messages=messages, temperature=1, max_tokens=64
+            model=AZURE_OPENAI_TITLE_MODEL, messages=messages, temperature=1, max_tokens=64
         )
 
         title = json.loads(response.choices[0].message.content)["title"]
         return title
     except Exception as e:
-        return messages[-2]['content']
+        logging.warning(f"Failed to generate conversation title: {e}")
+        return None
+
+# Summarize conversation turns dropped from the prompt, extending the previous summary
+SUMMARY_PROMPT = 'Summarize the conversation above in a few sentences, keeping names, numbers, decisions and open questions the assistant may need later. Respond with the summary only.'
+
+async def summarize_history(messages, previous_summary=None):
+    summary_messages = []
+    if previous_summary:
+        summary_messages.append({"role": "system", "content": f"Summary of the conversation before these messages:\n{previous_summary}"})
+    summary_messages.extend(messages)
+    summary_messages.append({"role": "user", "content": SUMMARY_PROMPT})
+
+    azure_openai_client = await get_openai_client()
+    response = await azure_openai_client.chat.completions.create(
+        model=HISTORY_SUMMARY_MODEL, messages=summary_messages, temperature=0, max_tokens=HISTORY_SUMMARY_MAX_TOKENS
+    )
+    return response.choices[0].message.content
+
+# Runs as a background task so title generation stays off the streaming path.
+# history_metadata is the dict serialized into every stream frame, so frames
+# sent after the title is ready carry it; the conversation document is updated too,
+# unless it is gone by then, e.g. deleted while the title was being generated.
+async def update_conversation_title(cosmos_conversation_client, user_id, conversation_id, conversation_messages, history_metadata):
+    title = await generate_title(conversation_messages)
+    if not title:
+        return
+    history_metadata["title"] = title
+    try:
+        await cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title)
+    except (CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+        logging.warning(f"Failed to save title of conversation {conversation_id}: {e}")
 
 # Create app function
 def create_app():
     app = Quart(__name__)
-    
-    # Initialize CosmosDB on app startup
-    init_cosmos_clients()
+    app.json = FastJSONProvider(app)
+    app.azure_openai_client = None
+    app.azure_openai_token_provider = None
+    app.openai_router = None
+    app.cosmos_conversation_client = None
+    app.openai_client_lock = asyncio.Lock()
+    app.cosmos_client_lock = asyncio.Lock()
+    app.user_details_client = None
+    app.user_details_client_lock = asyncio.Lock()
+    app.user_details_failure = None
+    app.response_cache = init_response_cache()
+    app.semantic_cache = None
+    app.embedding_client = None
+    app.embedding_token_provider = None
+    app.retriever = None
+    app.search_token_provider = None
+    app.group_filter_cache = None
+    app.history_assembler = init_history_assembler()
+    app.shared_metrics = metrics.SharedMetrics(METRICS_SQLITE_PATH, publish_interval=METRICS_PUBLISH_INTERVAL)
+    app.admission_controller = AdmissionController(
+        max_concurrency=AZURE_OPENAI_MAX_CONCURRENT_REQUESTS,
+        max_queue=AZURE_OPENAI_MAX_QUEUED_REQUESTS,
+        queue_timeout=AZURE_OPENAI_QUEUE_TIMEOUT,
+    )
+
+    @app.before_request
+    async def record_receipt():
+        ## the start of the streaming latency metrics, see backend/aoai/stream_metrics.py
+        g.received_at = time.perf_counter()
+
+    @app.before_serving
+    async def init_openai():
+        try:
+            await start_openai_client(app)
+        except Exception:
+            logging.exception("Failed to initialize Azure OpenAI client on startup")
+
+    @app.before_serving
+    async def init_cosmosdb():
+        try:
+            await start_cosmosdb_client(app)
+        except Exception:
+            logging.exception("Failed to initialize CosmosDB conversation client on startup")
+
+    @app.before_serving
+    async def init_user_details():
+        if not AZURE_COSMOSDB_ACCOUNT_URI or not AZURE_COSMOSDB_ACCOUNT_KEY:
+            logging.warning("Cosmos DB URL or key not configured, user details are disabled")
+            return
+        try:
+            await start_user_details_client(app)
+        except Exception:
+            logging.exception("Failed to initialize CosmosDB user details client on startup")
+
+    @app.before_serving
+    async def init_semantic_cache():
+        if not SEMANTIC_CACHE_ENABLED:
+            return
+        try:
+            await start_semantic_cache(app)
+        except Exception:
+            logging.exception("Failed to initialize the semantic cache, continuing without it")
+
+    @app.before_serving
+    async def init_retriever():
+        if not SHOULD_USE_DATA:
+            return
+        try:
+            await start_retriever(app)
+        except Exception:
+            logging.exception("Failed to initialize the retrieval stage on startup")
+
+    @app.before_serving
+    async def init_tokenizer():
+        if app.history_assembler is not None:
+            await asyncio.to_thread(app.history_assembler.token_counter.load)
+
+    @app.before_serving
+    async def init_shared_metrics():
+        try:
+            await app.shared_metrics.start()
+        except Exception:
+            logging.exception("Failed to publish this worker's metrics, /metrics will report it alone")
+
+    @app.after_serving
+    async def close_shared_metrics():
+        try:
+            await app.shared_metrics.close()
+        except Exception:
+            logging.exception("Failed to retire this worker's metrics")
+
+    @app.after_serving
+    async def close_openai():
+        await stop_openai_client(app)
+
+    @app.after_serving
+    async def close_cosmosdb():
+        await stop_cosmosdb_client(app)
+
+    @app.after_serving
+    async def close_user_details():
+        await stop_user_details_client(app)
+
+    @app.after_serving
+    async def close_retriever():
+        await stop_retriever(app)
+
+    @app.after_serving
+    async def close_embedding_client():
+        await stop_embedding_client(app)
+
+    @app.after_serving
+    async def close_response_cache():
+        if app.response_cache:
+            app.response_cache.close()
     
     # Create main blueprint
     main_bp = Blueprint("main", __name__, static_folder="static", template_folder="static")
@@ -388,6 +1204,15 @@ def create_app():
             logging.exception("Exception in /frontend_settings")
             return jsonify({"error": str(e)}), 500
 
+    @main_bp.route("/metrics", methods=["GET"])
+    async def get_metrics():
+        try:
+            body = await asyncio.to_thread(current_app.shared_metrics.render)
+        except Exception:
+            logging.exception("Failed to read the node's metrics, reporting this worker's alone")
+            body = metrics.REGISTRY.render()
+        return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
     @main_bp.route("/conversation", methods=["POST"])
     async def conversation():
         if not request.is_json:
@@ -399,65 +1224,43 @@ def create_app():
     @user_bp.route('/details/<user_id>', methods=['GET'])
     async def get_user_details(user_id):
         try:
-            if not cosmos_clients or not cosmos_clients['container']:
+            user_details_client = await get_user_details_client()
+            if not user_details_client:
                 return jsonify({"error": "Database not configured"}), 500
-                
-            container = cosmos_clients['container']
-            query = "SELECT * FROM c WHERE c.userId = @userId"
-            items = list(container.query_items(
-                query=query,
-                parameters=[{"name": "@userId", "value": user_id}],
-                enable_cross_partition_query=True
-            ))
-            
-            if items:
-                return jsonify(items[0]), 200
-            else:
-                # Create new user profile
-                new_user_profile = {
-                    "id": str(uuid.uuid4()),
-                    "userId": user_id,
-                    "answers": []
-                }
-                container.upsert_item(new_user_profile)
-                return jsonify(new_user_profile), 201
-                
+
+            user_profile, created = await user_details_client.get_or_create_user_details(user_id)
+            response = jsonify(user_profile)
+            response.headers["ETag"] = user_profile.get("_etag", "")
+            return response, 201 if created else 200
+
         except CosmosHttpResponseError as e:
             return jsonify({"error": str(e)}), 500
+        except Exception as e:
+            logging.exception("Exception in /api/user/details")
+            return jsonify({"error": str(e)}), 500
 
     @user_bp.route('/details/<user_id>', methods=['POST'])
     async def update_user_details(user_id):
         data = await request.get_json()
         try:
-            if not cosmos_clients or not cosmos_clients['container']:
+            user_details_client = await get_user_details_client()
+            if not user_details_client:
                 return jsonify({"error": "Database not configured"}), 500
-                
-            container = cosmos_clients['container']
-            
-            # Fetch existing or create new
-            existing_items = list(container.query_items(
-                query="SELECT * FROM c WHERE c.userId = @userId",
-                parameters=[{"name": "@userId", "value": user_id}],
-                enable_cross_partition_query=True
-            ))
-            
-            if existing_items:
-                user_doc = existing_items[0]
-                # Update with new data
-                for key, value in data.items():
-                    user_doc[key] = value
-            else:
-                user_doc = {
-                    "id": str(uuid.uuid4()),
-                    "userId": user_id,
-                    **data
-                }
-            
-            container.upsert_item(user_doc)
-            return jsonify({"message": "User details updated successfully"}), 200
-            
+
+            ## clients that send back the ETag from GET get optimistic concurrency
+            etag = request.headers.get("If-Match")
+            user_profile = await user_details_client.update_user_details(user_id, data, etag=etag)
+            response = jsonify({"message": "User details updated successfully"})
+            response.headers["ETag"] = user_profile.get("_etag", "")
+            return response, 200
+
+        except exceptions.CosmosAccessConditionFailedError:
+            return jsonify({"error": "User details were modified by another request"}), 412
         except CosmosHttpResponseError as e:
             return jsonify({"error": str(e)}), 500
+        except Exception as e:
+            logging.exception("Exception in /api/user/details")
+            return jsonify({"error": str(e)}), 500
 
     ## Conversation History API ##
     @main_bp.route("/history/generate", methods=["POST"])
@@ -469,19 +1272,27 @@ def create_app():
         conversation_id = request_json.get("conversation_id", None)
 
         try:
-            cosmos_conversation_client = init_cosmosdb_client()
+            cosmos_conversation_client = await get_cosmosdb_client()
             if not cosmos_conversation_client:
                 raise Exception("CosmosDB is not configured or not working")
 
             history_metadata = {}
             if not conversation_id:
-                title = await generate_title(request_json["messages"])
+                title = placeholder_title(request_json["messages"])
                 conversation_dict = await cosmos_conversation_client.create_conversation(
                     user_id=user_id, title=title
                 )
                 conversation_id = conversation_dict["id"]
                 history_metadata["title"] = title
                 history_metadata["date"] = conversation_dict["createdAt"]
+                current_app.add_background_task(
+                    update_conversation_title,
+                    cosmos_conversation_client,
+                    user_id,
+                    conversation_id,
+                    request_json["messages"],
+                    history_metadata,
+                )
 
             messages = request_json["messages"]
             if len(messages) > 0 and messages[-1]["role"] == "user":
@@ -500,17 +1311,193 @@ def create_app():
             else:
                 raise Exception("No user message found")
 
-            await cosmos_conversation_client.cosmosdb_client.close()
+            async def save_reply(reply_messages):
+                if not reply_messages:
+                    return
+                ## the answer and its citations are stored together, in the same kind of batch as the question
+                result = await cosmos_conversation_client.create_messages(conversation_id, user_id, reply_messages)
+                if result == "Conversation not found":
+                    logging.warning(f"Conversation {conversation_id} was deleted before its reply was stored")
 
             request_body = await request.get_json()
             history_metadata["conversation_id"] = conversation_id
             request_body["history_metadata"] = history_metadata
-            return await conversation_internal(request_body)
+            return await conversation_internal(request_body, on_complete=save_reply)
 
         except Exception as e:
             logging.exception("Exception in /history/generate")
             return jsonify({"error": str(e)}), 500
 
+    @main_bp.route("/history/message_feedback", methods=["POST"])
+    async def update_message_feedback():
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user["user_principal_id"]
+
+        request_json = await request.get_json()
+        message_id = request_json.get("message_id", None)
+        message_feedback = request_json.get("message_feedback", None)
+        if not message_id:
+            return jsonify({"error": "message_id is required"}), 400
+        if not message_feedback:
+            return jsonify({"error": "message_feedback is required"}), 400
+
+        try:
+            cosmos_conversation_client = await get_cosmosdb_client()
+            if not cosmos_conversation_client:
+                raise Exception("CosmosDB is not configured or not working")
+
+            ## with write-behind, a message that turns out not to exist is only found when the feedback is flushed
+            updated_message = await cosmos_conversation_client.update_message_feedback(user_id, message_id, message_feedback)
+            if not updated_message:
+                return jsonify({"error": f"Unable to update message {message_id}. It either does not exist or the user does not have access to it."}), 404
+            return jsonify({"message": f"Successfully updated message with feedback {message_feedback}", "message_id": message_id}), 200
+
+        except Exception as e:
+            logging.exception("Exception in /history/message_feedback")
+            return jsonify({"error": str(e)}), 500
+
+    @main_bp.route("/history/list", methods=["GET"])
+    async def list_conversations():
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user["user_principal_id"]
+
+        ## pages are walked with the opaque cursor from the previous page's X-Continuation-Token header
+        try:
+            limit = min(int(request.args.get("limit", AZURE_COSMOSDB_LIST_PAGE_SIZE)), AZURE_COSMOSDB_LIST_MAX_PAGE_SIZE)
+            cursor = request.args.get("continuation_token")
+            continuation_token = decode_continuation_token(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+
+        try:
+            cosmos_conversation_client = await get_cosmosdb_client()
+            if not cosmos_conversation_client:
+                raise Exception("CosmosDB is not configured or not working")
+
+            conversations, continuation_token = await cosmos_conversation_client.get_conversations_page(
+                user_id, limit=limit, continuation_token=continuation_token
+            )
+            response = jsonify(conversations)
+            if continuation_token:
+                response.headers["X-Continuation-Token"] = encode_continuation_token(continuation_token)
+            return response, 200
+
+        except Exception as e:
+            logging.exception("Exception in /history/list")
+            return jsonify({"error": str(e)}), 500
+
+    @main_bp.route("/history/read", methods=["POST"])
+    async def get_conversation():
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user["user_principal_id"]
+
+        request_json = await request.get_json()
+        conversation_id = request_json.get("conversation_id", None)
+        if not conversation_id:
+            return jsonify({"error": "conversation_id is required"}), 400
+
+        try:
+            cosmos_conversation_client = await get_cosmosdb_client()
+            if not cosmos_conversation_client:
+                raise Exception("CosmosDB is not configured or not working")
+
+            ## a point read of the conversation, then its messages from the worker's cache when they are current
+            conversation = await cosmos_conversation_client.get_conversation(user_id, conversation_id)
+            if not conversation:
+                return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+
+            conversation_messages = await cosmos_conversation_client.get_messages(
+                user_id, conversation_id, updated_at=conversation.get("updatedAt"), messages_version=conversation.get("messagesVersion", 0)
+            )
+            messages = [{
+                "id": message["id"],
+                "role": message["role"],
+                "content": message["content"],
+                "createdAt": message["createdAt"],
+                "feedback": message.get("feedback"),
+            } for message in conversation_messages]
+            return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+
+        except Exception as e:
+            logging.exception("Exception in /history/read")
+            return jsonify({"error": str(e)}), 500
+
+    @main_bp.route("/history/delete", methods=["DELETE"])
+    async def delete_conversation():
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user["user_principal_id"]
+
+        request_json = await request.get_json()
+        conversation_id = request_json.get("conversation_id", None)
+        if not conversation_id:
+            return jsonify({"error": "conversation_id is required"}), 400
+
+        try:
+            cosmos_conversation_client = await get_cosmosdb_client()
+            if not cosmos_conversation_client:
+                raise Exception("CosmosDB is not configured or not working")
+
+            ## messages first, so a failure never leaves messages without their conversation
+            deleted_messages = await cosmos_conversation_client.delete_messages(conversation_id, user_id)
+            deleted_conversation = await cosmos_conversation_client.delete_conversation(user_id, conversation_id)
+            return jsonify({
+                "message": "Successfully deleted conversation and messages",
+                "conversation_id": conversation_id,
+                "deleted": {"conversations": int(deleted_conversation), "messages": deleted_messages},
+            }), 200
+
+        except Exception as e:
+            logging.exception("Exception in /history/delete")
+            return jsonify({"error": str(e)}), 500
+
+    @main_bp.route("/history/delete_all", methods=["DELETE"])
+    async def delete_all_conversations():
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user["user_principal_id"]
+
+        try:
+            cosmos_conversation_client = await get_cosmosdb_client()
+            if not cosmos_conversation_client:
+                raise Exception("CosmosDB is not configured or not working")
+
+            deleted = await cosmos_conversation_client.delete_all_conversations(user_id)
+            return jsonify({
+                "message": f"Successfully deleted conversation and messages for user {user_id}",
+                "deleted": deleted,
+            }), 200
+
+        except Exception as e:
+            logging.exception("Exception in /history/delete_all")
+            return jsonify({"error": str(e)}), 500
+
+    @main_bp.route("/history/clear", methods=["POST"])
+    async def clear_messages():
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user["user_principal_id"]
+
+        request_json = await request.get_json()
+        conversation_id = request_json.get("conversation_id", None)
+        if not conversation_id:
+            return jsonify({"error": "conversation_id is required"}), 400
+
+        try:
+            cosmos_conversation_client = await get_cosmosdb_client()
+            if not cosmos_conversation_client:
+                raise Exception("CosmosDB is not configured or not working")
+
+            deleted_messages = await cosmos_conversation_client.delete_messages(conversation_id, user_id)
+            return jsonify({
+                "message": "Successfully deleted messages in conversation",
+                "conversation_id": conversation_id,
+                "deleted": {"messages": deleted_messages},
+            }), 200
+
+        except Exception as e:
+            logging.exception("Exception in /history/clear")
+            return jsonify({"error": str(e)}), 500
+
     # Register blueprints
     app.register_blueprint(main_bp)
     app.register_blueprint(user_bp)
@@ -0,0 +1,238 @@
+import re
+import time
+import asyncio
+from collections import deque
+from backend import metrics
+
+ADMISSION_QUEUE_DEPTH = metrics.gauge("aoai_admission_queue_depth", "Chat requests waiting for an upstream slot")
+ADMISSION_IN_FLIGHT = metrics.gauge("aoai_admission_in_flight", "Chat requests holding an upstream slot")
+ADMISSION_WAIT_SECONDS = metrics.histogram("aoai_admission_wait_seconds", "Time chat requests waited for an upstream slot")
+ADMISSION_REJECTED = metrics.counter("aoai_admission_rejected_total", "Chat requests rejected before reaching Azure OpenAI, by reason", ("reason",))
+RATELIMIT_REMAINING_REQUESTS = metrics.gauge("aoai_ratelimit_remaining_requests", "Last x-ratelimit-remaining-requests reported by Azure OpenAI")
+RATELIMIT_REMAINING_TOKENS = metrics.gauge("aoai_ratelimit_remaining_tokens", "Last x-ratelimit-remaining-tokens reported by Azure OpenAI")
+UPSTREAM_THROTTLED = metrics.counter("aoai_upstream_throttled_total", "429 responses received from Azure OpenAI")
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    """Parses ``Retry-After``/``x-ratelimit-reset-*`` values such as ``"12"``, ``"1.5"``, ``"20ms"`` or ``"6m0s"`` into seconds."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after_from_headers(headers):
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        seconds = parse_duration(retry_after_ms)
+        return seconds / 1000 if seconds is not None else None
+    return parse_duration(headers.get("retry-after"))
+
+
+class AdmissionRejected(Exception):
+    """Raised instead of calling Azure OpenAI when the request could not be served in time."""
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: float = None, reason: str = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class RateLimitState():
+    """Remaining request/token budget as last reported by the upstream rate-limit headers."""
+
+    def __init__(self):
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.updated_at = None
+        self.blocked_until = 0.0
+
+    def update(self, headers, status_code: int = 200):
+        now = time.monotonic()
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            self.remaining_requests = int(float(remaining_requests))
+            RATELIMIT_REMAINING_REQUESTS.set(self.remaining_requests)
+        if remaining_tokens is not None:
+            self.remaining_tokens = int(float(remaining_tokens))
+            RATELIMIT_REMAINING_TOKENS.set(self.remaining_tokens)
+        if remaining_requests is not None or remaining_tokens is not None:
+            self.updated_at = now
+
+        blocked_for = None
+        if status_code == 429:
+            UPSTREAM_THROTTLED.inc()
+            blocked_for = retry_after_from_headers(headers)
+        elif self.remaining_requests == 0 or self.remaining_tokens == 0:
+            ## budget exhausted; only block when the upstream says for how long
+            resets = [parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+            resets = [reset for reset in resets if reset is not None]
+            blocked_for = max(resets) if resets else None
+        if blocked_for:
+            self.blocked_until = max(self.blocked_until, now + blocked_for)
+
+    def retry_after(self) -> float:
+        return max(self.blocked_until - time.monotonic(), 0.0)
+
+
+class AdmissionSlot():
+
+    def __init__(self, controller, acquired_at: float):
+        self._controller = controller
+        self._acquired_at = acquired_at
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._acquired_at)
+
+
+class SlotStream():
+    """A streamed response holding an admission slot until it is exhausted, fails or is closed.
+
+    Not an async generator: closing one that was never iterated skips its
+    ``finally``, while ``aclose`` here releases the slot either way.
+    """
+
+    def __init__(self, stream, slot: AdmissionSlot):
+        self._stream = stream
+        self._slot = slot
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self._slot.release()
+            raise
+
+    async def aclose(self):
+        self._slot.release()
+        await self._stream.aclose()
+
+
+class AdmissionController():
+    """Per-worker gate in front of chat completion calls.
+
+    At most ``max_concurrency`` requests hold an upstream slot (0 means no
+    limit); up to ``max_queue`` more wait in FIFO order for at most
+    ``queue_timeout`` seconds. A request is rejected with ``AdmissionRejected``
+    right away when the queue is full, when the expected wait (from the
+    average time a slot is held) exceeds its deadline, or while the upstream
+    has told us to back off for longer than the deadline.
+    """
+
+    ## weight of the latest sample in the moving average of slot hold times
+    HOLD_TIME_SMOOTHING = 0.2
+
+    def __init__(self, max_concurrency: int = 0, max_queue: int = 100, queue_timeout: float = 10.0, rate_limit=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        ## anything with retry_after(): a RateLimitState, or the deployment router
+        self.rate_limit = rate_limit or RateLimitState()
+        self.in_flight = 0
+        self.hold_time = None
+        self._waiters = deque()
+
+    def _reject(self, reason: str, retry_after: float, message: str):
+        ADMISSION_REJECTED.inc(reason=reason)
+        raise AdmissionRejected(message, retry_after=max(retry_after, 1.0), reason=reason)
+
+    def estimated_wait(self) -> float:
+        if not self.max_concurrency or self.in_flight < self.max_concurrency or self.hold_time is None:
+            return 0.0
+        return self.hold_time * (len(self._waiters) + 1) / self.max_concurrency
+
+    def _grant(self) -> AdmissionSlot:
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        return AdmissionSlot(self, time.monotonic())
+
+    async def acquire(self) -> AdmissionSlot:
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+
+        retry_after = self.rate_limit.retry_after()
+        if retry_after > self.queue_timeout:
+            self._reject("rate_limited", retry_after, "Azure OpenAI is rate limiting requests, try again later")
+        if retry_after:
+            await asyncio.sleep(retry_after)
+
+        if not self.max_concurrency or (self.in_flight < self.max_concurrency and not self._waiters):
+            ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+            return self._grant()
+
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full", self.estimated_wait(), "Too many requests are waiting for Azure OpenAI, try again later")
+        estimated_wait = self.estimated_wait()
+        if estimated_wait > deadline - time.monotonic():
+            self._reject("deadline", estimated_wait, "Azure OpenAI is busy, try again later")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        timed_out = False
+
+        def expire():
+            nonlocal timed_out
+            timed_out = waiter.cancel()
+
+        ## not asyncio.wait_for, which can swallow the caller's cancellation once the slot is handed over
+        timer = loop.call_later(max(deadline - time.monotonic(), 0), expire)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                ## the slot was handed over just as we gave up; pass it on
+                self._release(None)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+            if not timed_out:
+                raise
+            self._reject("deadline", self.estimated_wait(), "Timed out waiting for Azure OpenAI, try again later")
+        finally:
+            timer.cancel()
+
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+        return AdmissionSlot(self, time.monotonic())
+
+    def _release(self, held_seconds):
+        if held_seconds is not None:
+            if self.hold_time is None:
+                self.hold_time = held_seconds
+            else:
+                self.hold_time += self.HOLD_TIME_SMOOTHING * (held_seconds - self.hold_time)
+
+        ## hand the slot straight to the next live waiter so in_flight never dips below the limit
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+                return
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+
+    def throttled(self, error) -> AdmissionRejected:
+        """Converts an upstream 429 into an ``AdmissionRejected`` carrying its Retry-After."""
+        retry_after = retry_after_from_headers(error.response.headers) or self.rate_limit.retry_after()
+        return AdmissionRejected(str(error), retry_after=max(retry_after, 1.0), reason="upstream")
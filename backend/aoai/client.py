@@ -0,0 +1,113 @@
+import time
+import asyncio
+import logging
+import httpx
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+SEARCH_SCOPE = "https://search.azure.com/.default"
+
+
+class AzureADTokenProvider():
+    """Caches an Azure AD access token and refreshes it before it expires.
+
+    Instances are callable and can be passed directly as the
+    ``azure_ad_token_provider`` of an ``AsyncAzureOpenAI`` client. Once
+    ``start()`` has been awaited a background task renews the token
+    ``refresh_margin`` seconds ahead of expiry, so requests never wait on
+    token acquisition. A token issued for less than ``refresh_margin`` is
+    renewed halfway through its remaining lifetime instead, and never more
+    often than every ``min_refresh_interval`` seconds.
+    """
+
+    def __init__(self, credential, scope: str = COGNITIVE_SERVICES_SCOPE, refresh_margin: float = 300, retry_interval: float = 30,
+                 min_refresh_interval: float = 10):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.min_refresh_interval = min_refresh_interval
+        self._token = None
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    async def __call__(self) -> str:
+        token = self._token
+        if token is None or token.expires_on <= time.time():
+            token = await self.refresh()
+        return token.token
+
+    async def refresh(self):
+        async with self._lock:
+            ## another caller may have refreshed while we waited on the lock
+            if self._token is not None and self._token.expires_on - time.time() > self.refresh_margin:
+                return self._token
+            self._token = await self.credential.get_token(self.scope)
+            return self._token
+
+    async def start(self):
+        await self.refresh()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            remaining = self._token.expires_on - time.time()
+            delay = remaining - self.refresh_margin if remaining > self.refresh_margin else remaining / 2
+            await asyncio.sleep(max(delay, self.min_refresh_interval))
+            try:
+                self._token = await self.credential.get_token(self.scope)
+            except Exception:
+                logging.exception("Failed to refresh Azure AD token, retrying in %ss", self.retry_interval)
+                await asyncio.sleep(self.retry_interval)
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        close = getattr(self.credential, "close", None)
+        if close:
+            await close()
+
+
+def create_http_client(
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 30.0,
+    http2: bool = True,
+    connect_timeout: float = 5.0,
+    read_timeout: float = 600.0,
+    event_hooks: dict = None,
+) -> httpx.AsyncClient:
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning("HTTP/2 requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2, event_hooks=event_hooks)
+
+
+async def warmup_connections(http_client: httpx.AsyncClient, endpoint: str, connections: int = 1):
+    """Opens ``connections`` pooled connections to ``endpoint`` ahead of the first request.
+
+    Any HTTP status counts as success, the point is only to complete the
+    TCP/TLS handshake so the connection is parked in the keep-alive pool.
+    """
+    async def ping():
+        try:
+            await http_client.get(endpoint)
+        except httpx.HTTPError as e:
+            logging.warning(f"Connection warmup to {endpoint} failed: {e}")
+
+    await asyncio.gather(*(ping() for _ in range(connections)))
@@ -0,0 +1,37 @@
+from urllib.parse import parse_qs, urlparse
+from openai import AsyncAzureOpenAI
+
+
+def parse_embedding_endpoint(endpoint: str):
+    """Splits a deployment URL such as
+    ``https://<resource>.openai.azure.com/openai/deployments/<deployment>/embeddings?api-version=2023-05-15``
+    into ``(base_url, deployment, api_version)``.
+    """
+    try:
+        base_url, path = endpoint.split("/openai/deployments/", 1)
+        deployment = path.split("/embeddings")[0]
+        api_version = parse_qs(urlparse(endpoint).query)["api-version"][0]
+    except (ValueError, KeyError, IndexError):
+        raise ValueError(f"Invalid embedding endpoint '{endpoint}', expected .../openai/deployments/<deployment>/embeddings?api-version=<version>")
+    return base_url, deployment, api_version
+
+
+class EmbeddingClient():
+
+    def __init__(self, endpoint: str, api_key: str = None, ad_token_provider=None, http_client=None, default_headers: dict = None):
+        base_url, self.deployment, api_version = parse_embedding_endpoint(endpoint)
+        self.client = AsyncAzureOpenAI(
+            api_version=api_version,
+            api_key=api_key,
+            azure_ad_token_provider=ad_token_provider,
+            azure_endpoint=base_url,
+            http_client=http_client,
+            default_headers=default_headers,
+        )
+
+    async def embed(self, text: str) -> list:
+        response = await self.client.embeddings.create(model=self.deployment, input=text)
+        return response.data[0].embedding
+
+    async def close(self):
+        await self.client.close()
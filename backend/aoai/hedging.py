@@ -0,0 +1,65 @@
+import math
+from collections import deque
+from backend import metrics
+
+HEDGE_ELIGIBLE = metrics.counter("aoai_hedge_eligible_requests_total", "Streamed chat requests that could have been hedged")
+HEDGE_STARTED = metrics.counter("aoai_hedge_requests_total", "Duplicate chat requests started because the first token was late")
+HEDGE_BUDGET_EXHAUSTED = metrics.counter("aoai_hedge_budget_exhausted_total", "Late chat requests not hedged because the hedge budget was spent")
+HEDGE_WINS = metrics.counter("aoai_hedge_wins_total", "Hedged chat requests by which request produced the first token", ("winner",))
+HEDGE_DELAY_SECONDS = metrics.gauge("aoai_hedge_delay_seconds", "Current wait for a first token before a chat request is hedged")
+
+
+class HedgePolicy():
+    """Decides when a streamed chat request gets a duplicate on another deployment.
+
+    The hedge delay is either fixed or the ``percentile`` of recently
+    observed times to first token. Hedges are paid for from a token bucket
+    that earns ``budget_percent`` / 100 of a hedge per request, so they never
+    exceed that share of traffic.
+    """
+
+    ## delay used until enough times to first token have been observed
+    DEFAULT_DELAY = 1.0
+    MIN_SAMPLES = 20
+    ## unused budget carried over, in hedges
+    MAX_BURST = 10
+
+    def __init__(self, delay: float = None, percentile: float = 90, budget_percent: float = 10, window: int = 500):
+        if not 0 < percentile < 100:
+            raise ValueError("The hedge percentile must be between 0 and 100")
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.budget_percent = budget_percent
+        self._samples = deque(maxlen=window)
+        self._delay = None
+        ## in percent of a hedge, so whole-number budgets add up exactly
+        self._credit = 0.0
+
+    def observe(self, ttft: float):
+        self._samples.append(ttft)
+        self._delay = None
+
+    def delay(self) -> float:
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        if self._delay is None:
+            if len(self._samples) < self.MIN_SAMPLES:
+                self._delay = self.DEFAULT_DELAY
+            else:
+                samples = sorted(self._samples)
+                self._delay = samples[math.ceil(self.percentile / 100 * len(samples)) - 1]
+            HEDGE_DELAY_SECONDS.set(self._delay)
+        return self._delay
+
+    def request(self):
+        """Counts an eligible request and earns its share of hedge budget."""
+        HEDGE_ELIGIBLE.inc()
+        self._credit = min(self._credit + self.budget_percent, self.MAX_BURST * 100)
+
+    def try_hedge(self) -> bool:
+        if self._credit < 100:
+            HEDGE_BUDGET_EXHAUSTED.inc()
+            return False
+        self._credit -= 100
+        HEDGE_STARTED.inc()
+        return True
@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from backend import metrics
+
+PROMPT_TOKENS_TRIMMED = metrics.histogram(
+    "prompt_tokens_trimmed",
+    "Conversation history tokens left out of a chat request to fit the prompt budget",
+    buckets=(0, 100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000),
+)
+PROMPT_MESSAGES_TRIMMED = metrics.counter("prompt_messages_trimmed_total", "Conversation history messages left out of chat requests")
+HISTORY_SUMMARIES = metrics.counter("history_summaries_total", "Rolling conversation summaries generated, by outcome", ("outcome",))
+
+## Roughly 4 characters per token for English text, used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def tiktoken_model_name(model_name: str) -> str:
+    ## Azure model names drop the dot, e.g. gpt-35-turbo-16k
+    return model_name.replace("gpt-35", "gpt-3.5")
+
+
+def messages_digest(messages) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        digest.update(message["role"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(str(message["content"]).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TokenCounter():
+    """Counts chat prompt tokens the way the chat completions API bills them.
+
+    Per-message counts are cached by content digest, since every turn of a
+    conversation resends all of the earlier messages.
+    """
+    TOKENS_PER_MESSAGE = 3
+    REPLY_PRIMING_TOKENS = 3
+
+    def __init__(self, model_name: str, max_cached_messages: int = 10000, encoding=None):
+        self.model_name = model_name
+        self.max_cached_messages = max_cached_messages
+        self.encoding = encoding
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads the tiktoken encoding for the model; may download it on first use, so call off the event loop."""
+        if self.encoding is not None:
+            return
+        try:
+            import tiktoken
+            try:
+                self.encoding = tiktoken.encoding_for_model(tiktoken_model_name(self.model_name))
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.warning(f"Could not load a tokenizer for {self.model_name}, estimating token counts: {e}")
+
+    def count_text(self, text: str) -> int:
+        if self.encoding is None:
+            return -(-len(text) // CHARS_PER_TOKEN)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message) -> int:
+        content = str(message.get("content") or "")
+        key = (message["role"], hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest())
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+
+        count = self.TOKENS_PER_MESSAGE + self.count_text(message["role"]) + self.count_text(content)
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_cached_messages:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_messages(self, messages) -> int:
+        return sum(self.count_message(message) for message in messages) + self.REPLY_PRIMING_TOKENS
+
+
+class HistoryTrim():
+    """What ``HistoryAssembler.assemble`` left out of a request."""
+
+    def __init__(self, tokens: int = 0, messages: int = 0, summarized: int = 0, summary_update=None):
+        self.tokens = tokens
+        self.messages = messages
+        ## number of dropped messages covered by the summary included in the prompt
+        self.summarized = summarized
+        ## (conversation_key, history, covered) when the rolling summary needs to be extended
+        self.summary_update = summary_update
+
+
+class HistoryAssembler():
+    """Keeps the newest conversation turns that fit in a prompt token budget.
+
+    With the ``summarize`` strategy the dropped turns are replaced by a rolling
+    summary cached per conversation. Summaries are produced in the background
+    by ``update_summary``, so a request never waits for one; until it is
+    ready the older turns are simply dropped.
+    """
+    STRATEGIES = ("drop", "summarize")
+
+    def __init__(self, token_counter: TokenCounter, max_prompt_tokens: int, strategy: str = "drop", summarize=None, max_summaries: int = 1000):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown history trim strategy '{strategy}', expected one of {', '.join(self.STRATEGIES)}")
+        if strategy == "summarize" and summarize is None:
+            raise ValueError("The summarize strategy needs a summarize function")
+        self.token_counter = token_counter
+        self.max_prompt_tokens = max_prompt_tokens
+        self.strategy = strategy
+        self.summarize = summarize
+        self.max_summaries = max_summaries
+        self._summaries = OrderedDict()
+        self._summarizing = set()
+
+    @staticmethod
+    def conversation_key(history, conversation_id=None) -> str:
+        ## without a stored conversation, its first message identifies it across turns
+        return conversation_id or messages_digest(history[:1])
+
+    def _cached_summary(self, conversation_key, history):
+        entry = self._summaries.get(conversation_key)
+        if entry is None or entry["covered"] >= len(history) or entry["digest"] != messages_digest(history[:entry["covered"]]):
+            return None
+        self._summaries.move_to_end(conversation_key)
+        return entry
+
+    def assemble(self, system_messages, history, conversation_id=None):
+        """Returns ``(messages, HistoryTrim)`` with the system messages, the summary if any and the newest history that fits."""
+        counts = [self.token_counter.count_message(message) for message in history]
+        budget = self.max_prompt_tokens - self.token_counter.count_messages(system_messages)
+
+        ## walk back from the newest message; the latest one is always kept
+        start = len(history)
+        used = 0
+        while start > 0 and (start == len(history) or used + counts[start - 1] <= budget):
+            start -= 1
+            used += counts[start]
+
+        def start_at_user_turn(start, used):
+            while start < len(history) - 1 and history[start]["role"] != "user":
+                used -= counts[start]
+                start += 1
+            return start, used
+
+        if start > 0:
+            start, used = start_at_user_turn(start, used)
+
+        summary_messages = []
+        trim = HistoryTrim()
+        if self.strategy == "summarize" and start > 0:
+            key = self.conversation_key(history, conversation_id)
+            entry = self._cached_summary(key, history)
+            if entry is not None:
+                ## never resend turns the summary already covers
+                if entry["covered"] > start:
+                    used -= sum(counts[start:entry["covered"]])
+                    start = entry["covered"]
+                summary_message = {"role": "system", "content": SUMMARY_PREFIX + entry["summary"]}
+                summary_tokens = self.token_counter.count_message(summary_message)
+                while start < len(history) - 1 and used + summary_tokens > budget:
+                    used -= counts[start]
+                    start += 1
+                start, used = start_at_user_turn(start, used)
+                summary_messages.append(summary_message)
+                trim.summarized = entry["covered"]
+            covered = entry["covered"] if entry is not None else 0
+            if covered < start and key not in self._summarizing:
+                trim.summary_update = (key, history[:start], covered)
+
+        trim.messages = start
+        trim.tokens = sum(counts[:start])
+        if trim.messages:
+            PROMPT_MESSAGES_TRIMMED.inc(trim.messages)
+        PROMPT_TOKENS_TRIMMED.observe(trim.tokens)
+        return list(system_messages) + summary_messages + history[start:], trim
+
+    def _fit_summary_input(self, messages):
+        ## the summarizer sees the newest dropped messages that fit in the prompt budget
+        budget = self.max_prompt_tokens
+        start = len(messages)
+        while start > 0 and self.token_counter.count_message(messages[start - 1]) <= budget:
+            start -= 1
+            budget -= self.token_counter.count_message(messages[start])
+        return messages[start:]
+
+    async def update_summary(self, conversation_key, dropped_history, covered):
+        """Extends the cached summary of ``conversation_key`` to cover all of ``dropped_history``."""
+        if conversation_key in self._summarizing:
+            return
+        self._summarizing.add(conversation_key)
+        try:
+            entry = self._summaries.get(conversation_key)
+            previous_summary = entry["summary"] if entry is not None and covered else None
+            new_messages = self._fit_summary_input(dropped_history[covered:])
+            try:
+                summary = await self.summarize(new_messages, previous_summary)
+            except Exception as e:
+                logging.warning(f"Failed to summarize conversation history: {e}")
+                HISTORY_SUMMARIES.inc(outcome="error")
+                return
+            if not summary:
+                HISTORY_SUMMARIES.inc(outcome="empty")
+                return
+
+            HISTORY_SUMMARIES.inc(outcome="success")
+            self._summaries[conversation_key] = {
+                "covered": len(dropped_history),
+                "digest": messages_digest(dropped_history),
+                "summary": summary,
+            }
+            self._summaries.move_to_end(conversation_key)
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+        finally:
+            self._summarizing.discard(conversation_key)
@@ -0,0 +1,366 @@
+import time
+import random
+import asyncio
+import logging
+import httpx
+from urllib.parse import urlparse
+from openai import APIConnectionError, APIStatusError
+from backend import metrics
+from backend.aoai.admission import RateLimitState
+from backend.aoai.hedging import HEDGE_WINS
+
+ROUTER_REQUESTS = metrics.counter("aoai_router_requests_total", "Chat completion attempts per deployment, by outcome", ("deployment", "outcome"))
+ROUTER_FAILOVERS = metrics.counter("aoai_router_failovers_total", "Chat requests retried on another deployment before the first token")
+ROUTER_TTFT_SECONDS = metrics.histogram("aoai_router_ttft_seconds", "Time to first token per deployment", ("deployment",))
+ROUTER_CIRCUIT_OPEN = metrics.gauge("aoai_router_circuit_open", "1 while a deployment is ejected by its circuit breaker", ("deployment",))
+
+
+def is_retryable(error) -> bool:
+    """Throttling, server errors and connection failures are worth trying elsewhere; other 4xx are not."""
+    ## a stream cut off mid-read surfaces as the raw httpx error
+    if isinstance(error, (APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker():
+    """Ejects a deployment after ``failure_threshold`` consecutive failures.
+
+    After ``reset_timeout`` seconds one request is let through as a probe
+    (half-open); its success closes the circuit, its failure reopens it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def available(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not self._probing
+
+    def begin(self):
+        """Called when a request is sent; moves an expired open circuit to half-open."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self._probing = True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def abandon(self):
+        """Called when a request is cancelled before it succeeded or failed."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class Deployment():
+    """One Azure OpenAI deployment the router can send chat requests to."""
+
+    ## weight of the latest sample in the moving average of time to first token
+    TTFT_SMOOTHING = 0.2
+
+    def __init__(self, name: str, endpoint: str, deployment: str, client, circuit_breaker: CircuitBreaker = None):
+        self.name = name
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.client = client
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.rate_limit = RateLimitState()
+        self.ttft = None
+        self._netloc = urlparse(endpoint).netloc
+        self._path = f"/openai/deployments/{deployment}/"
+
+    def matches(self, url) -> bool:
+        return url.netloc.decode("ascii") == self._netloc and self._path in url.path
+
+    def observe_ttft(self, seconds: float):
+        ROUTER_TTFT_SECONDS.observe(seconds, deployment=self.name)
+        if self.ttft is None:
+            self.ttft = seconds
+        else:
+            self.ttft += self.TTFT_SMOOTHING * (seconds - self.ttft)
+
+
+def has_content(chunk) -> bool:
+    return bool(chunk.choices) and bool(getattr(chunk.choices[0].delta, "content", None))
+
+
+class FirstTokenStream():
+    """A chat completion stream whose chunks up to the first token were already read.
+
+    ``aclose`` releases the upstream connection even if iteration never started.
+    """
+
+    def __init__(self, buffered, stream):
+        self._buffered = buffered
+        self._stream = stream
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        try:
+            for chunk in self._buffered:
+                yield chunk
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        await self._stream.response.aclose()
+
+
+class DeploymentRouter():
+    """Spreads chat requests over several deployments of the same model.
+
+    A deployment is picked at random, weighted by the inverse of its observed
+    time to first token and by its remaining rate-limit budget; ejected
+    deployments are skipped. If the chosen deployment fails before the first
+    token is streamed, the request moves to the next one.
+
+    With a ``hedge_policy``, a streamed request whose first token is late
+    is duplicated on a second deployment; whichever answers first is used
+    and the other is cancelled.
+    """
+
+    ## remaining budget at or above which a deployment gets its full weight
+    REQUESTS_HEADROOM = 10
+    TOKENS_HEADROOM = 10000
+    ## weight floor so throttled-looking deployments still see some traffic
+    MIN_BUDGET_FACTOR = 0.05
+
+    def __init__(self, deployments, max_attempts: int = None, rng: random.Random = None, hedge_policy=None):
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        self.deployments = list(deployments)
+        self.max_attempts = max_attempts or len(self.deployments)
+        self.rng = rng or random.Random()
+        self.hedge_policy = hedge_policy
+
+    @property
+    def primary(self) -> Deployment:
+        return self.deployments[0]
+
+    def budget_factor(self, deployment: Deployment) -> float:
+        rate_limit = deployment.rate_limit
+        if rate_limit.retry_after() > 0:
+            return 0.0
+        factor = 1.0
+        if rate_limit.remaining_requests is not None:
+            factor = min(factor, rate_limit.remaining_requests / self.REQUESTS_HEADROOM)
+        if rate_limit.remaining_tokens is not None:
+            factor = min(factor, rate_limit.remaining_tokens / self.TOKENS_HEADROOM)
+        return max(factor, self.MIN_BUDGET_FACTOR)
+
+    def weight(self, deployment: Deployment) -> float:
+        known = [d.ttft for d in self.deployments if d.ttft]
+        ## unmeasured deployments are treated as average so they get sampled
+        ttft = deployment.ttft or (sum(known) / len(known) if known else 1.0)
+        return self.budget_factor(deployment) / max(ttft, 0.001)
+
+    def select(self, exclude=()) -> Deployment:
+        candidates = [d for d in self.deployments if d not in exclude and d.circuit_breaker.available()]
+        weights = [self.weight(d) for d in candidates]
+        if not candidates or not any(weights):
+            ## everything is ejected or backing off: fall back to whichever frees up first
+            remaining = [d for d in self.deployments if d not in exclude]
+            if not remaining:
+                return None
+            return min(remaining, key=lambda d: (d.rate_limit.retry_after(), d.circuit_breaker.opened_at))
+        return self.rng.choices(candidates, weights=weights)[0]
+
+    def retry_after(self) -> float:
+        """Seconds until some deployment stops backing off; used by the admission controller."""
+        return min(d.rate_limit.retry_after() for d in self.deployments)
+
+    async def observe_response(self, response):
+        """httpx response hook recording the rate-limit headers of each deployment."""
+        if "/chat/completions" not in response.request.url.path:
+            return
+        for deployment in self.deployments:
+            if deployment.matches(response.request.url):
+                try:
+                    deployment.rate_limit.update(response.headers, response.status_code)
+                except ValueError as e:
+                    logging.debug(f"Ignoring malformed rate-limit headers from {deployment.name}: {e}")
+                return
+
+    def _observe_ttft(self, deployment: Deployment, seconds: float):
+        deployment.observe_ttft(seconds)
+        if self.hedge_policy is not None:
+            self.hedge_policy.observe(seconds)
+
+    async def _start(self, deployment: Deployment, model_args: dict):
+        """Sends the request; for streams, reads up to the first token so early failures can fail over."""
+        started = time.monotonic()
+        response = await deployment.client.chat.completions.create(**{**model_args, "model": deployment.deployment})
+        if not model_args.get("stream"):
+            self._observe_ttft(deployment, time.monotonic() - started)
+            return response
+
+        buffered = []
+        try:
+            while not buffered or not has_content(buffered[-1]):
+                try:
+                    buffered.append(await response.__anext__())
+                except StopAsyncIteration:
+                    break
+        except BaseException:
+            await response.response.aclose()
+            raise
+        self._observe_ttft(deployment, time.monotonic() - started)
+        return FirstTokenStream(buffered, response)
+
+    async def _attempt(self, deployment: Deployment, model_args: dict):
+        """``_start`` with the circuit breaker and metrics bookkeeping."""
+        deployment.circuit_breaker.begin()
+        try:
+            response = await self._start(deployment, model_args)
+        except asyncio.CancelledError:
+            deployment.circuit_breaker.abandon()
+            ROUTER_REQUESTS.inc(deployment=deployment.name, outcome="cancelled")
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                ## the request itself is at fault, the deployment is fine
+                deployment.circuit_breaker.record_success()
+                ROUTER_REQUESTS.inc(deployment=deployment.name, outcome="error")
+                raise
+            deployment.circuit_breaker.record_failure()
+            ROUTER_CIRCUIT_OPEN.set(int(deployment.circuit_breaker.state == CircuitBreaker.OPEN), deployment=deployment.name)
+            ROUTER_REQUESTS.inc(deployment=deployment.name, outcome="failed")
+            raise
+
+        deployment.circuit_breaker.record_success()
+        ROUTER_CIRCUIT_OPEN.set(0, deployment=deployment.name)
+        ROUTER_REQUESTS.inc(deployment=deployment.name, outcome="success")
+        return response
+
+    async def create(self, model_args: dict):
+        """Returns the chat completion (or a stream of chunks) from the first deployment that answers."""
+        tried = []
+        last_error = None
+        if self.hedge_policy is not None and model_args.get("stream") and len(self.deployments) > 1:
+            response, last_error = await self._create_hedged(model_args, tried)
+            if response is not None:
+                return response
+
+        while len(tried) < self.max_attempts:
+            deployment = self.select(exclude=tried)
+            if deployment is None:
+                break
+            if tried:
+                ROUTER_FAILOVERS.inc()
+                logging.warning(f"Failing over chat request to deployment {deployment.name}: {last_error}")
+            tried.append(deployment)
+            try:
+                return await self._attempt(deployment, model_args)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+
+        raise last_error
+
+    def _hedge_target(self, exclude):
+        deployment = self.select(exclude=exclude)
+        if deployment is None or not deployment.circuit_breaker.available() or not self.budget_factor(deployment):
+            return None
+        return deployment
+
+    async def _create_hedged(self, model_args: dict, tried: list):
+        """Races the first deployment against a second one started after the hedge delay.
+
+        Returns ``(response, None)`` from whichever streams a token first, or
+        ``(None, last_error)`` when every attempt failed in a way worth
+        failing over from; the deployments used are appended to ``tried``.
+        """
+        hedge_policy = self.hedge_policy
+        hedge_policy.request()
+        primary = self.select()
+        tried.append(primary)
+        attempts = {asyncio.ensure_future(self._attempt(primary, model_args)): primary}
+        hedge = None
+        last_error = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_policy.delay())
+            if not done:
+                hedge = self._hedge_target(tried)
+                if hedge is not None and hedge_policy.try_hedge():
+                    logging.debug(f"No first token from {primary.name} after {hedge_policy.delay():.2f}s, hedging on {hedge.name}")
+                    tried.append(hedge)
+                    attempts[asyncio.ensure_future(self._attempt(hedge, model_args))] = hedge
+                else:
+                    hedge = None
+
+            while attempts:
+                done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    deployment = attempts.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if winner is None:
+                            winner = (deployment, task.result())
+                        else:
+                            ## both answered at once; only one stream is used
+                            await task.result().aclose()
+                    elif not is_retryable(error):
+                        raise error
+                    else:
+                        last_error = error
+                if winner is not None:
+                    if hedge is not None:
+                        HEDGE_WINS.inc(winner="hedge" if winner[0] is hedge else "primary")
+                    return winner[1], None
+        finally:
+            for task in attempts:
+                task.cancel()
+            ## a loser may have finished just before it was cancelled
+            for result in await asyncio.gather(*attempts, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    await result.aclose()
+
+        return None, last_error
+
+
+def parse_deployments(config, default_deployment: str = None):
+    """Validates ``AZURE_OPENAI_DEPLOYMENTS`` entries: a list of ``{endpoint, deployment?, key?, name?}`` objects."""
+    if not isinstance(config, list) or not config:
+        raise ValueError("AZURE_OPENAI_DEPLOYMENTS must be a non-empty JSON list")
+    entries = []
+    for i, entry in enumerate(config):
+        if not isinstance(entry, dict) or not entry.get("endpoint"):
+            raise ValueError(f"AZURE_OPENAI_DEPLOYMENTS[{i}] needs an endpoint")
+        deployment = entry.get("deployment") or default_deployment
+        if not deployment:
+            raise ValueError(f"AZURE_OPENAI_DEPLOYMENTS[{i}] needs a deployment, or set AZURE_OPENAI_MODEL")
+        entries.append({
+            "name": entry.get("name") or f"{deployment}@{urlparse(entry['endpoint']).netloc}",
+            "endpoint": entry["endpoint"],
+            "deployment": deployment,
+            "key": entry.get("key"),
+        })
+    return entries
@@ -0,0 +1,107 @@
+import time
+import asyncio
+from backend import metrics
+
+COMPLETED = "completed"
+ABORTED = "aborted"
+ERROR = "error"
+
+STREAM_UPSTREAM_WAIT_SECONDS = metrics.histogram(
+    "chat_stream_upstream_wait_seconds", "Time from receiving a streamed chat request to calling Azure OpenAI"
+)
+STREAM_FIRST_CHUNK_SECONDS = metrics.histogram(
+    "chat_stream_first_chunk_seconds", "Time from calling Azure OpenAI to its first stream chunk"
+)
+STREAM_FIRST_FLUSH_SECONDS = metrics.histogram(
+    "chat_stream_first_flush_seconds", "Time from the first upstream chunk to the first bytes sent to the client",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+STREAM_CHUNK_GAP_SECONDS = metrics.histogram(
+    "chat_stream_chunk_gap_seconds", "Time between consecutive upstream stream chunks",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+STREAM_TOKENS = metrics.histogram(
+    "chat_stream_tokens", "Answer tokens per stream, one per upstream chunk carrying content",
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2000, 4000, 8000),
+)
+STREAM_TOKENS_PER_SECOND = metrics.histogram(
+    "chat_stream_tokens_per_second", "Answer tokens per second, from the first to the last upstream chunk",
+    buckets=(5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500),
+)
+STREAM_DURATION_SECONDS = metrics.histogram(
+    "chat_stream_duration_seconds", "Time from receiving a streamed chat request to the end of its stream, by outcome", ("outcome",),
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 230.0),
+)
+STREAMS = metrics.counter("chat_streams_total", "Streamed chat answers by outcome: completed, aborted by the client or failed", ("outcome",))
+
+
+class StreamTimer():
+    """Timings of one streamed chat answer, observed into the ``chat_stream_*`` histograms.
+
+    Call ``upstream_call`` before calling Azure OpenAI, ``chunk`` for every
+    chunk it streams back and pass the response body through ``timed``. A
+    stream replayed from a cache never calls upstream and is not recorded.
+    Inter-chunk gaps are kept on the timer and observed once the stream ends.
+    """
+
+    def __init__(self, received_at: float = None):
+        self.received_at = time.perf_counter() if received_at is None else received_at
+        self.called_at = None
+        self.first_chunk_at = None
+        self.last_chunk_at = None
+        self.flushed_at = None
+        self.tokens = 0
+        self.gaps = []
+        self.outcome = None
+
+    def upstream_call(self):
+        self.called_at = time.perf_counter()
+        STREAM_UPSTREAM_WAIT_SECONDS.observe(self.called_at - self.received_at)
+
+    def chunk(self, has_content: bool):
+        now = time.perf_counter()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+            if self.called_at is not None:
+                STREAM_FIRST_CHUNK_SECONDS.observe(now - self.called_at)
+        else:
+            self.gaps.append(now - self.last_chunk_at)
+        self.last_chunk_at = now
+        if has_content:
+            self.tokens += 1
+
+    def flushed(self):
+        if self.flushed_at is not None or self.first_chunk_at is None:
+            return
+        self.flushed_at = time.perf_counter()
+        STREAM_FIRST_FLUSH_SECONDS.observe(self.flushed_at - self.first_chunk_at)
+
+    def finish(self, outcome: str):
+        """Records the end of the stream; only the first call counts."""
+        if self.outcome is not None or self.called_at is None:
+            return
+        self.outcome = outcome
+        for gap in self.gaps:
+            STREAM_CHUNK_GAP_SECONDS.observe(gap)
+        STREAM_TOKENS.observe(self.tokens)
+        if self.tokens > 1 and self.last_chunk_at > self.first_chunk_at:
+            STREAM_TOKENS_PER_SECOND.observe(self.tokens / (self.last_chunk_at - self.first_chunk_at))
+        STREAM_DURATION_SECONDS.observe(time.perf_counter() - self.received_at, outcome=outcome)
+        STREAMS.inc(outcome=outcome)
+
+    async def timed(self, body):
+        """Yields ``body``, noting when the first bytes have been sent and how the stream ended."""
+        try:
+            async for data in body:
+                yield data
+                ## resumed once the server has written what was yielded
+                self.flushed()
+        except (GeneratorExit, asyncio.CancelledError):
+            self.finish(ABORTED)
+            raise
+        except Exception:
+            self.finish(ERROR)
+            raise
+        finally:
+            await body.aclose()
+        self.finish(COMPLETED)
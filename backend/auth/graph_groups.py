@@ -0,0 +1,174 @@
+import re
+import time
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from backend import metrics
+from backend import serialization
+from backend.auth.sample_user import sample_user
+
+GRAPH_ENDPOINT = "https://graph.microsoft.com"
+## the largest page Graph serves for directory object collections
+GRAPH_MAX_PAGE_SIZE = 999
+
+_GROUP_FILTER = re.compile(r"^(\w+)/any\(g:search\.in\(g, '([^']*)'\)\)$")
+
+GROUP_LOOKUPS = metrics.counter("graph_group_lookups_total", "Group membership lookups for security trimming, by result", ("result",))
+GROUP_LOOKUP_SECONDS = metrics.histogram("graph_group_lookup_seconds", "Time to fetch a user's group memberships from Microsoft Graph")
+GROUP_REFRESHES = metrics.counter("graph_group_refreshes_total", "Group memberships refreshed in the background before they expired")
+
+
+class GraphError(Exception):
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Microsoft Graph returned {status_code}: {message}")
+        self.status_code = status_code
+
+
+class GraphClient():
+    """Async Microsoft Graph client for the signed-in user's group memberships.
+
+    Requests share one pooled connection. Graph pages through
+    ``@odata.nextLink`` tokens that are only known once the previous page
+    arrives, so pages are requested at the maximum size to keep the number
+    of round trips down.
+    """
+
+    def __init__(self, http_client, endpoint: str = GRAPH_ENDPOINT, page_size: int = GRAPH_MAX_PAGE_SIZE):
+        self.http_client = http_client
+        self.endpoint = endpoint.rstrip("/")
+        self.page_size = page_size
+
+    async def fetch_group_ids(self, user_token: str) -> list:
+        url = f"{self.endpoint}/v1.0/me/transitiveMemberOf"
+        params = {"$select": "id", "$top": str(self.page_size)}
+        headers = {"Authorization": f"bearer {user_token}"}
+        group_ids = []
+        while url:
+            response = await self.http_client.get(url, params=params, headers=headers)
+            if response.status_code != 200:
+                raise GraphError(response.status_code, response.text)
+            page = serialization.loads(response.content)
+            group_ids.extend(obj["id"] for obj in page["value"])
+            ## the next link already carries the query
+            url = page.get("@odata.nextLink")
+            params = None
+        return group_ids
+
+    async def close(self):
+        await self.http_client.aclose()
+
+
+def build_group_filter(column: str, group_ids) -> str:
+    return f"{column}/any(g:search.in(g, '{', '.join(group_ids)}'))"
+
+
+def group_filter_key(user_principal_id: str, user_token: str) -> str:
+    """The ``GroupFilterCache`` key of a caller.
+
+    Without Easy Auth every request gets the sample user's principal id, so
+    the token itself has to tell callers apart.
+    """
+    if user_principal_id and user_principal_id != sample_user["X-Ms-Client-Principal-Id"]:
+        return user_principal_id
+    return hashlib.sha256(user_token.encode()).hexdigest()
+
+
+def parse_group_filter(search_filter: str):
+    """Inverse of ``build_group_filter``: returns ``(column, set of group ids)``."""
+    match = _GROUP_FILTER.match(search_filter)
+    if not match:
+        raise ValueError(f"Unsupported search filter '{search_filter}'")
+    column, group_ids = match.groups()
+    return column, {group_id.strip() for group_id in group_ids.split(",") if group_id.strip()}
+
+
+class GroupFilterCache():
+    """Per-user cache of group memberships and the search filter built from them.
+
+    Concurrent lookups for the same user share a single Graph call. Once an
+    entry is within ``refresh_margin`` seconds of expiring, the next lookup
+    is still answered from the cache while a background task refreshes it
+    with the caller's token. A failed lookup is never cached; it yields a
+    filter that matches no groups.
+    """
+
+    def __init__(self, graph_client: GraphClient, column: str, ttl: float = 300, refresh_margin: float = 60, max_entries: int = 10000):
+        self.graph_client = graph_client
+        self.column = column
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._refreshing = set()
+
+    def _load(self, user_key: str, user_token: str) -> asyncio.Task:
+        task = self._loading.get(user_key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_key, user_token))
+            self._loading[user_key] = task
+            task.add_done_callback(lambda task: self._loaded(user_key, task))
+        return task
+
+    def _loaded(self, user_key: str, task: asyncio.Task):
+        self._loading.pop(user_key, None)
+        ## retrieve the error even when every waiter has gone away
+        if not task.cancelled() and task.exception() is not None and user_key in self._refreshing:
+            logging.warning(f"Background refresh of user groups failed: {task.exception()}")
+        self._refreshing.discard(user_key)
+
+    async def _fetch(self, user_key: str, user_token: str) -> dict:
+        started = time.monotonic()
+        group_ids = await self.graph_client.fetch_group_ids(user_token)
+        GROUP_LOOKUP_SECONDS.observe(time.monotonic() - started)
+        if not group_ids:
+            logging.debug("No user groups found")
+
+        now = time.monotonic()
+        entry = {
+            "group_ids": group_ids,
+            "filter": build_group_filter(self.column, group_ids),
+            "refresh_at": now + self.ttl - self.refresh_margin,
+            "expires_at": now + self.ttl,
+        }
+        self._entries[user_key] = entry
+        self._entries.move_to_end(user_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def get(self, user_key: str, user_token: str) -> dict:
+        now = time.monotonic()
+        entry = self._entries.get(user_key)
+        if entry is not None and entry["expires_at"] > now:
+            GROUP_LOOKUPS.inc(result="hit")
+            self._entries.move_to_end(user_key)
+            if entry["refresh_at"] <= now and user_key not in self._loading:
+                GROUP_REFRESHES.inc()
+                self._refreshing.add(user_key)
+                self._load(user_key, user_token)
+            return entry
+
+        GROUP_LOOKUPS.inc(result="coalesced" if user_key in self._loading else "miss")
+        ## shielded so one caller going away does not cancel the lookup for the others
+        return await asyncio.shield(self._load(user_key, user_token))
+
+    async def get_group_ids(self, user_key: str, user_token: str) -> list:
+        return (await self.get(user_key, user_token))["group_ids"]
+
+    async def get_filter(self, user_key: str, user_token: str) -> str:
+        if not user_token:
+            return build_group_filter(self.column, [])
+        try:
+            return (await self.get(user_key, user_token))["filter"]
+        except Exception as e:
+            GROUP_LOOKUPS.inc(result="error")
+            logging.error(f"Exception fetching user groups: {e}")
+            return build_group_filter(self.column, [])
+
+    async def close(self):
+        for task in list(self._loading.values()):
+            task.cancel()
+        await self.graph_client.close()
@@ -0,0 +1,222 @@
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from backend import metrics, serialization
+
+CACHE_HITS = metrics.counter("response_cache_hits_total", "Chat requests answered from the response cache", ("backend",))
+CACHE_MISSES = metrics.counter("response_cache_misses_total", "Chat requests not found in the response cache", ("backend",))
+CACHE_EVICTIONS = metrics.counter("response_cache_evictions_total", "Response cache entries evicted to respect the size limit", ("backend",))
+
+## model args that change how a response is delivered but not what it says
+UNCACHED_MODEL_ARGS = ("stream",)
+
+
+def normalize_messages(messages):
+    return [
+        {"role": message["role"], "content": " ".join(str(message["content"]).split())}
+        for message in messages
+    ]
+
+
+def make_cache_key(model_args: dict) -> str:
+    key_args = {k: v for k, v in model_args.items() if k not in UNCACHED_MODEL_ARGS}
+    key_args["messages"] = normalize_messages(model_args.get("messages", []))
+    payload = json.dumps(key_args, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class InMemoryCacheBackend():
+    """LRU + TTL cache local to one worker process."""
+    name = "memory"
+    blocking = False
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """Stores ``value`` and returns the number of entries evicted to make room."""
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self._entries.clear()
+
+
+class SQLiteCacheBackend():
+    """LRU + TTL cache in a SQLite database in WAL mode, shared by every worker on the node."""
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 1000, busy_timeout_ms: int = 2000):
+        self.path = path
+        self.max_entries = max_entries
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        ## opened lazily so each forked worker gets its own connection
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS response_cache_last_access ON response_cache (last_access)")
+            self._connection = connection
+        return self._connection
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+            return serialization.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, serialization.dumps(value), now + ttl, now),
+                )
+                connection.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+                evicted = connection.execute(
+                    "DELETE FROM response_cache WHERE key IN ("
+                    "SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            return evicted
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class ResponseCache():
+    """Exact-match cache of chat responses keyed on the normalized model args.
+
+    Values are the response frames as produced by ``format_stream_response``
+    (or the single non-streaming response), so a hit can be replayed through
+    the normal NDJSON path.
+    """
+
+    def __init__(self, backend, ttl: float = 3600):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def _call(self, func, *args):
+        ## keep disk I/O off the event loop
+        if self.backend.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def get(self, key):
+        value = await self._call(self.backend.get, key)
+        if value is None:
+            CACHE_MISSES.inc(backend=self.backend.name)
+        else:
+            CACHE_HITS.inc(backend=self.backend.name)
+        return value
+
+    async def set(self, key, value):
+        evicted = await self._call(self.backend.set, key, value, self.ttl)
+        if evicted:
+            CACHE_EVICTIONS.inc(evicted, backend=self.backend.name)
+
+    def close(self):
+        self.backend.close()
+
+
+def cacheable_response(response_obj, frames):
+    """Builds the cache value from the first formatted frame and the messages of every frame."""
+    return {
+        "id": response_obj["id"],
+        "model": response_obj["model"],
+        "object": response_obj["object"],
+        "frames": frames,
+    }
+
+
+def _replayed_frame(cached, messages, history_metadata):
+    return {
+        "id": cached["id"],
+        "model": cached["model"],
+        "created": int(time.time()),
+        "object": cached["object"],
+        "choices": [{"messages": messages}],
+        "history_metadata": history_metadata,
+    }
+
+
+async def replay_stream_response(cached, history_metadata):
+    for messages in cached["frames"]:
+        yield _replayed_frame(cached, messages, history_metadata)
+
+
+def merge_frames(frames):
+    """Collapses the messages of every frame of an answer into one of each: tool messages as sent, the assistant's content deltas joined."""
+    messages = []
+    content = []
+    for frame in frames:
+        for message in frame:
+            if message["role"] == "assistant":
+                content.append(message.get("content") or "")
+            else:
+                messages.append(message)
+    if content:
+        messages.append({"role": "assistant", "content": "".join(content)})
+    return messages
+
+
+def replay_response(cached, history_metadata):
+    ## an answer cached from a stream has one frame per chunk
+    return _replayed_frame(cached, merge_frames(cached["frames"]), history_metadata)
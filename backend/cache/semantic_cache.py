@@ -0,0 +1,142 @@
+import time
+import logging
+import numpy as np
+from backend import metrics
+from backend.cache.response_cache import make_cache_key
+
+SEMANTIC_CACHE_HITS = metrics.counter("semantic_cache_hits_total", "Chat requests answered from the semantic cache")
+SEMANTIC_CACHE_MISSES = metrics.counter("semantic_cache_misses_total", "Eligible chat requests with no similar cached question")
+SEMANTIC_CACHE_EVICTIONS = metrics.counter("semantic_cache_evictions_total", "Semantic cache entries evicted to make room")
+SEMANTIC_CACHE_LOOKUP_SECONDS = metrics.histogram("semantic_cache_lookup_seconds", "Time to embed the question and search the semantic cache")
+SEMANTIC_CACHE_SAVED_SECONDS = metrics.histogram(
+    "semantic_cache_saved_seconds",
+    "Upstream response time avoided by semantic cache hits",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+
+def conversation_turns(model_args):
+    return [message for message in model_args.get("messages", []) if message["role"] in ("user", "assistant")]
+
+
+def latest_user_message(model_args):
+    for message in reversed(model_args.get("messages", [])):
+        if message["role"] == "user":
+            return message["content"]
+    return None
+
+
+def semantic_cache_namespace(model_args):
+    ## answers are only shared between requests with the same system message and model settings
+    key_args = dict(model_args)
+    key_args["messages"] = [message for message in model_args.get("messages", []) if message["role"] == "system"]
+    return make_cache_key(key_args)
+
+
+class SemanticCache():
+    """Bounded store of recent question embeddings and their answers.
+
+    Embeddings are kept as unit-length rows of a preallocated float32 matrix
+    so a lookup is one matrix-vector product. Expired entries are skipped
+    and reused first; otherwise the least recently used entry is evicted.
+    """
+
+    def __init__(self, embedding_client, max_entries: int = 1000, threshold: float = 0.95, ttl: float = 3600, max_turns: int = 1):
+        self.embedding_client = embedding_client
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self._matrix = None
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_access = np.zeros(max_entries, dtype=np.float64)
+        self._namespaces = np.empty(max_entries, dtype=object)
+        self._values = [None] * max_entries
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def is_eligible(self, model_args):
+        turns = conversation_turns(model_args)
+        return 0 < len(turns) <= self.max_turns and turns[-1]["role"] == "user"
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, namespace):
+        """Returns ``(value, similarity)`` for the closest live entry above the threshold, else ``None``."""
+        if self._size == 0:
+            return None
+
+        now = time.time()
+        query = self._normalize(embedding)
+        similarities = self._matrix[:self._size] @ query
+        live = (self._expires_at[:self._size] > now) & (self._namespaces[:self._size] == namespace)
+        similarities = np.where(live, similarities, -np.inf)
+        index = int(np.argmax(similarities))
+        similarity = float(similarities[index])
+        if similarity < self.threshold:
+            return None
+
+        self._last_access[index] = now
+        return self._values[index], similarity
+
+    def add(self, embedding, namespace, value):
+        vector = self._normalize(embedding)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+        now = time.time()
+        if self._size < self.max_entries:
+            index = self._size
+            self._size += 1
+        else:
+            expired = np.flatnonzero(self._expires_at <= now)
+            if len(expired):
+                index = int(expired[0])
+            else:
+                index = int(np.argmin(self._last_access))
+                SEMANTIC_CACHE_EVICTIONS.inc()
+
+        self._matrix[index] = vector
+        self._expires_at[index] = now + self.ttl
+        self._last_access[index] = now
+        self._namespaces[index] = namespace
+        self._values[index] = value
+
+    async def get(self, model_args):
+        """Returns ``(cached_response, embedding)``.
+
+        ``embedding`` is the embedding of the latest user message when the
+        request was eligible but missed, to be passed to ``set`` once the
+        fresh response is complete; otherwise ``None``.
+        """
+        if not self.is_eligible(model_args):
+            return None, None
+
+        started = time.monotonic()
+        try:
+            embedding = await self.embedding_client.embed(latest_user_message(model_args))
+        except Exception as e:
+            logging.warning(f"Semantic cache lookup failed: {e}")
+            return None, None
+
+        match = self.lookup(embedding, semantic_cache_namespace(model_args))
+        lookup_seconds = time.monotonic() - started
+        SEMANTIC_CACHE_LOOKUP_SECONDS.observe(lookup_seconds)
+        if match is None:
+            SEMANTIC_CACHE_MISSES.inc()
+            return None, embedding
+
+        value, similarity = match
+        logging.debug(f"Semantic cache hit with similarity {similarity:.4f}")
+        SEMANTIC_CACHE_HITS.inc()
+        SEMANTIC_CACHE_SAVED_SECONDS.observe(max(value["response_seconds"] - lookup_seconds, 0))
+        return value["response"], None
+
+    def set(self, embedding, model_args, response, response_seconds: float):
+        self.add(embedding, semantic_cache_namespace(model_args), {"response": response, "response_seconds": response_seconds})
@@ -0,0 +1,138 @@
+"""Request charge, latency and throttling of CosmosDB operations.
+
+Classes decorated with ``instrument`` record, per public coroutine method
+(the operation), the RU it consumed, its client and server latency, how
+many of its requests were retried and how many were throttled. A method
+called from within another instrumented method counts towards the outer
+one, so every request is attributed to the operation the app asked for.
+
+The per-request figures come from the response headers, read by the
+``response_hook`` installed as the CosmosClient's ``raw_response_hook``: it
+runs for every HTTP response, including those the SDK retries.
+"""
+import time
+import asyncio
+import inspect
+import logging
+import functools
+import contextvars
+from backend import metrics
+
+## statuses the SDK retries: timeout, throttled, retry-with and unavailable
+RETRIED_STATUSES = (408, 429, 449, 503)
+## requests made outside any instrumented operation
+UNSCOPED_OPERATION = "other"
+
+OPERATION_REQUEST_CHARGE = metrics.histogram(
+    "cosmos_operation_request_charge", "Request units consumed per CosmosDB operation", ("container", "operation"),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2500, 5000),
+)
+OPERATION_SECONDS = metrics.histogram("cosmos_operation_seconds", "Client time of a CosmosDB operation, retries included", ("container", "operation"))
+OPERATION_SERVER_SECONDS = metrics.histogram(
+    "cosmos_operation_server_seconds", "Time the CosmosDB service spent on an operation's requests", ("container", "operation"),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+OPERATION_RETRIES = metrics.histogram(
+    "cosmos_operation_retries", "Requests of a CosmosDB operation that were retried", ("container", "operation"), buckets=(0, 1, 2, 3, 5, 10, 20),
+)
+OPERATIONS = metrics.counter("cosmos_operations_total", "CosmosDB operations, by outcome (ok, error or cancelled)", ("container", "operation", "outcome"))
+THROTTLED_REQUESTS = metrics.counter("cosmos_throttled_requests_total", "CosmosDB requests throttled with 429", ("container", "operation"))
+
+_operation = contextvars.ContextVar("cosmos_operation", default=None)
+
+
+class OperationStats():
+    """Totals of the requests made by one operation."""
+
+    def __init__(self):
+        self.request_charge = 0.0
+        self.server_seconds = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def add(self, status_code: int, headers):
+        self.requests += 1
+        self.request_charge += float(headers.get("x-ms-request-charge") or 0)
+        self.server_seconds += float(headers.get("x-ms-request-duration-ms") or 0) / 1000
+        if status_code in RETRIED_STATUSES:
+            self.retries += 1
+        if status_code == 429:
+            self.throttled += 1
+
+
+def response_hook(container: str, raw_response_hook=None):
+    """A ``raw_response_hook`` adding each response to the running operation, then calling ``raw_response_hook`` if given."""
+
+    def hook(response):
+        http_response = response.http_response
+        stats = _operation.get()
+        if stats is not None:
+            stats.add(http_response.status_code, http_response.headers)
+        else:
+            stats = OperationStats()
+            stats.add(http_response.status_code, http_response.headers)
+            OPERATION_REQUEST_CHARGE.observe(stats.request_charge, container=container, operation=UNSCOPED_OPERATION)
+            if stats.throttled:
+                THROTTLED_REQUESTS.inc(container=container, operation=UNSCOPED_OPERATION)
+        if raw_response_hook is not None:
+            raw_response_hook(response)
+
+    return hook
+
+
+def _record(container: str, operation: str, stats: OperationStats, seconds: float, outcome: str, log: bool):
+    labels = {"container": container, "operation": operation}
+    OPERATION_REQUEST_CHARGE.observe(stats.request_charge, **labels)
+    OPERATION_SECONDS.observe(seconds, **labels)
+    OPERATION_SERVER_SECONDS.observe(stats.server_seconds, **labels)
+    OPERATION_RETRIES.observe(stats.retries, **labels)
+    OPERATIONS.inc(outcome=outcome, **labels)
+    if stats.throttled:
+        THROTTLED_REQUESTS.inc(stats.throttled, **labels)
+    if log:
+        logging.info(
+            f"CosmosDB {container}.{operation} {outcome}: {stats.request_charge:.2f} RU, {1000 * seconds:.1f} ms "
+            f"(server {1000 * stats.server_seconds:.1f} ms), {stats.requests} requests, {stats.retries} retried, {stats.throttled} throttled"
+        )
+
+
+def _instrument_method(container: str, operation: str, method):
+
+    @functools.wraps(method)
+    async def instrumented(self, *args, **kwargs):
+        if _operation.get() is not None:
+            return await method(self, *args, **kwargs)
+        stats = OperationStats()
+        token = _operation.set(stats)
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await method(self, *args, **kwargs)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            _operation.reset(token)
+            _record(container, operation, stats, time.perf_counter() - started, outcome, getattr(self, "log_operations", False))
+
+    return instrumented
+
+
+def instrument(container: str):
+    """Class decorator recording every public coroutine method the class defines as a CosmosDB operation of ``container``.
+
+    Instances with a true ``log_operations`` attribute also log each operation.
+    """
+
+    def decorate(cls):
+        for name, attribute in list(vars(cls).items()):
+            if name.startswith("_") or name == "close" or not inspect.iscoroutinefunction(attribute):
+                continue
+            setattr(cls, name, _instrument_method(container, name, attribute))
+        return cls
+
+    return decorate
@@ -0,0 +1,247 @@
+"""Document-per-conversation storage for chat history.
+
+By default each message is an item of its own next to its conversation item,
+so reading a conversation is a query over its messages and deleting it one
+delete per message. In the document layout the messages of a conversation
+are embedded, in order, in a few bucket documents:
+
+    {"id": "<conversation id>:0", "type": "messages", "conversationId": ..., "bucket": 0, "messages": [...]}
+
+The conversation item records how many buckets there are, the approximate
+size of the last one and the number of messages. Messages are appended to
+the last bucket with patch ``add`` operations, and a new bucket is started
+before the last one nears the 2 MB item size limit. Reading a conversation
+is a point read per bucket and clearing it a single transactional batch.
+
+Conversations not converted yet by ``backend.history.migrate`` keep being
+read and written one item per message.
+"""
+import json
+import asyncio
+from collections import OrderedDict
+from azure.cosmos import exceptions
+from backend import cosmos_metrics
+from backend.history.cosmosdbservice import CosmosConversationClient, MESSAGES_VERSION_PATCH, TRANSACTIONAL_BATCH_LIMIT
+
+LAYOUT = "document"
+## Cosmos DB items are limited to 2 MB, a bucket is closed well before that
+BUCKET_MAX_BYTES = 1536 * 1024
+## Cosmos DB applies at most 10 operations in one patch
+PATCH_OPERATION_LIMIT = 10
+## an append that raced with another writer of the conversation is retried on its new state
+MAX_APPEND_ATTEMPTS = 5
+
+
+def bucket_id(conversation_id, bucket: int) -> str:
+    return f"{conversation_id}:{bucket}"
+
+
+def message_size(message: dict) -> int:
+    return len(json.dumps(message, separators=(',', ':')).encode())
+
+
+def pack_buckets(messages: list, max_bytes: int = BUCKET_MAX_BYTES) -> list:
+    """Splits ``messages`` into consecutive buckets of at most ``max_bytes`` each (a larger message gets its own)."""
+    buckets = []
+    size = 0
+    for message in messages:
+        if not buckets or size + message_size(message) > max_bytes:
+            buckets.append([])
+            size = 0
+        buckets[-1].append(message)
+        size += message_size(message)
+    return buckets
+
+
+def bucket_document(user_id, conversation_id, bucket: int, messages: list) -> dict:
+    return {
+        'id': bucket_id(conversation_id, bucket),
+        'type': 'messages',
+        'userId': user_id,
+        'conversationId': conversation_id,
+        'bucket': bucket,
+        'messages': messages,
+    }
+
+
+@cosmos_metrics.instrument("conversations")
+class DocumentConversationClient(CosmosConversationClient):
+    """``CosmosConversationClient`` storing each conversation's messages embedded in bucket documents."""
+
+    def __init__(self, *args, tail_cache_size: int = 10000, **kwargs):
+        super().__init__(*args, **kwargs)
+        ## bucket count and last bucket size of recently used conversations, so an append does not need to read the conversation first
+        self.tail_cache_size = tail_cache_size
+        self._tails = OrderedDict()
+
+    def _remember_tail(self, user_id, conversation_id, buckets: int, tail_bytes: int):
+        self._tails[(user_id, conversation_id)] = (buckets, tail_bytes)
+        self._tails.move_to_end((user_id, conversation_id))
+        while len(self._tails) > self.tail_cache_size:
+            self._tails.popitem(last=False)
+
+    def build_conversation(self, user_id, title = ''):
+        conversation = super().build_conversation(user_id, title)
+        conversation.update({'layout': LAYOUT, 'buckets': 0, 'tailBytes': 0, 'messageCount': 0})
+        return conversation
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = await super().create_conversation(user_id, title)
+        if conversation:
+            self._remember_tail(user_id, conversation['id'], 0, 0)
+        return conversation
+
+    @staticmethod
+    def _append_operations(user_id, conversation_id, buckets: int, messages: list, size: int, roll_over: bool) -> list:
+        """Batch operations adding ``messages`` to the last of ``buckets``, or to a new bucket with ``roll_over``.
+
+        The patch of the conversation only applies if it still has ``buckets``
+        buckets (and, when appending, room for ``size`` more bytes), so a
+        stale view of the conversation fails the batch instead of overfilling
+        or skipping a bucket.
+        """
+        updated_at = {'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}
+        message_count = {'op': 'incr', 'path': '/messageCount', 'value': len(messages)}
+        if roll_over:
+            return [
+                ('create', (bucket_document(user_id, conversation_id, buckets, messages),)),
+                ('patch', (conversation_id, [
+                    {'op': 'set', 'path': '/buckets', 'value': buckets + 1},
+                    {'op': 'set', 'path': '/tailBytes', 'value': size},
+                    message_count,
+                    updated_at,
+                ]), {'filter_predicate': f"FROM c WHERE c.buckets = {buckets}"}),
+            ]
+
+        tail = bucket_id(conversation_id, buckets - 1)
+        operations = [
+            ('patch', (tail, [{'op': 'add', 'path': '/messages/-', 'value': message} for message in messages[start:start + PATCH_OPERATION_LIMIT]]))
+            for start in range(0, len(messages), PATCH_OPERATION_LIMIT)
+        ]
+        operations.append(('patch', (conversation_id, [
+            {'op': 'incr', 'path': '/tailBytes', 'value': size},
+            message_count,
+            updated_at,
+        ]), {'filter_predicate': f"FROM c WHERE c.buckets = {buckets} AND c.tailBytes <= {BUCKET_MAX_BYTES - size}"}))
+        return operations
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, message_ids: list = None):
+        """Appends ``input_messages`` to the conversation's last bucket, and moves its ``updatedAt``, in one transactional batch.
+
+        Returns the stored messages, or "Conversation not found" when the
+        conversation does not exist.
+        """
+        messages = self.build_messages(conversation_id, user_id, input_messages, message_ids)
+        size = sum(message_size(message) for message in messages)
+        tail = self._tails.get((user_id, conversation_id))
+
+        for attempt in range(MAX_APPEND_ATTEMPTS):
+            if tail is None:
+                conversation = await self.get_conversation(user_id, conversation_id)
+                if conversation is None:
+                    return "Conversation not found"
+                if conversation.get('layout') != LAYOUT:
+                    return await super().create_messages(conversation_id, user_id, input_messages, [message['id'] for message in messages])
+                tail = (conversation['buckets'], conversation['tailBytes'])
+            buckets, tail_bytes = tail
+            roll_over = buckets == 0 or tail_bytes + size > BUCKET_MAX_BYTES
+
+            try:
+                operations = self._append_operations(user_id, conversation_id, buckets, messages, size, roll_over)
+                await self.execute_batch(user_id, operations + self.index_operations(conversation_id, messages[-1]['createdAt']))
+            except exceptions.CosmosBatchOperationError as e:
+                ## 412: the conversation moved on, 409: another writer started the bucket, 404: it was cleared
+                if e.status_code not in (404, 409, 412):
+                    raise
+                self._tails.pop((user_id, conversation_id), None)
+                tail = None
+                continue
+
+            if roll_over:
+                self._remember_tail(user_id, conversation_id, buckets + 1, size)
+            else:
+                self._remember_tail(user_id, conversation_id, buckets, tail_bytes + size)
+            if self.message_cache is not None:
+                self.message_cache.add_messages(user_id, conversation_id, messages)
+            return messages
+
+        raise Exception(f"Conversation {conversation_id} kept changing while appending messages")
+
+    async def _read_bucket(self, user_id, conversation_id, bucket: int) -> list:
+        try:
+            document = await self.container_client.read_item(item=bucket_id(conversation_id, bucket), partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            ## cleared since the conversation was read
+            return []
+        return document['messages']
+
+    async def _read_messages(self, user_id, conversation_id):
+        conversation = await self.get_conversation(user_id, conversation_id)
+        if conversation is None:
+            return []
+        if conversation.get('layout') != LAYOUT:
+            return await self.query_message_items(user_id, conversation_id)
+        self._remember_tail(user_id, conversation_id, conversation['buckets'], conversation['tailBytes'])
+        buckets = await asyncio.gather(*(self._read_bucket(user_id, conversation_id, bucket) for bucket in range(conversation['buckets'])))
+        return [message for messages in buckets for message in messages]
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        parameters = [
+            {
+                'name': '@messageId',
+                'value': message_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id, c.conversationId, c.messages FROM c WHERE c.userId = @userId AND c.type = 'messages' AND ARRAY_CONTAINS(c.messages, {\"id\": @messageId}, true)"
+        async for document in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            index = next(i for i, message in enumerate(document['messages']) if message['id'] == message_id)
+            ## messages are only ever appended, so the index stays valid
+            try:
+                resp = await self.container_client.patch_item(
+                    item=document['id'],
+                    partition_key=user_id,
+                    patch_operations=[{'op': 'set', 'path': f'/messages/{index}/feedback', 'value': feedback}]
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                return False
+            if self.message_cache is not None:
+                self.message_cache.set_feedback(user_id, message_id, feedback)
+                await self._messages_changed(user_id, document['conversationId'])
+            return resp['messages'][index]
+        return await super().update_message_feedback(user_id, message_id, feedback)
+
+    async def delete_messages(self, conversation_id, user_id):
+        """Deletes the conversation's buckets and resets it to no messages; returns how many messages were deleted."""
+        conversation = await self.get_conversation(user_id, conversation_id)
+        if conversation is None or conversation.get('layout') != LAYOUT:
+            return await super().delete_messages(conversation_id, user_id)
+
+        self._tails.pop((user_id, conversation_id), None)
+        if self.message_cache is not None:
+            self.message_cache.invalidate(user_id, conversation_id)
+        deletes = [('delete', (bucket_id(conversation_id, bucket),)) for bucket in range(conversation['buckets'])]
+        reset = ('patch', (conversation_id, [
+            {'op': 'set', 'path': '/buckets', 'value': 0},
+            {'op': 'set', 'path': '/tailBytes', 'value': 0},
+            {'op': 'set', 'path': '/messageCount', 'value': 0},
+            MESSAGES_VERSION_PATCH,
+        ]))
+        if len(deletes) < TRANSACTIONAL_BATCH_LIMIT:
+            await self.execute_batch(user_id, deletes + [reset])
+        else:
+            await self._delete_items(user_id, [operation[1][0] for operation in deletes])
+            await self.execute_batch(user_id, [reset])
+        return conversation['messageCount']
+
+    async def delete_conversation(self, user_id, conversation_id):
+        self._tails.pop((user_id, conversation_id), None)
+        return await super().delete_conversation(user_id, conversation_id)
+
+    async def delete_all_conversations(self, user_id):
+        for key in [key for key in self._tails if key[0] == user_id]:
+            del self._tails[key]
+        return await super().delete_all_conversations(user_id)
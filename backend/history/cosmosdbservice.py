@@ -1,18 +1,84 @@
+import copy
+import json
 import uuid
-from datetime import datetime
+import base64
+import random
+import asyncio
+import logging
+import binascii
+import aiohttp
+from datetime import datetime, timedelta
+from azure.core import MatchConditions
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from backend import cosmos_metrics
+from backend.history.message_cache import MessageCache
+
+## Cosmos DB executes at most 100 operations in one transactional batch
+TRANSACTIONAL_BATCH_LIMIT = 100
+## retries of a batch still throttled (429) after the SDK's own retries, and the longest wait between them
+MAX_THROTTLE_RETRIES = 5
+MAX_THROTTLE_BACKOFF = 30
+## id of the document in each user's partition listing their most recent conversations
+CONVERSATION_INDEX_ID = 'conversation-index'
+## continuation tokens of pages after those served from the conversation index start with this
+KEYSET_TOKEN_PREFIX = 'before:'
+## moves the conversation's messagesVersion, which deleting messages and setting feedback change instead of updatedAt
+MESSAGES_VERSION_PATCH = {'op': 'incr', 'path': '/messagesVersion', 'value': 1}
+
+
+def encode_continuation_token(continuation_token: str) -> str:
+    """Wraps a Cosmos continuation token into an opaque, URL-safe cursor."""
+    return base64.urlsafe_b64encode(continuation_token.encode()).decode().rstrip('=')
+
+
+def decode_continuation_token(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor + '=' * (-len(cursor) % 4), altchars=b'-_', validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid continuation token") from e
+
+
+def message_operations(conversation_id, messages: list) -> list:
+    """Batch operations storing ``messages`` and moving their conversation's ``updatedAt`` to the last one."""
+    operations = [('upsert', (message,)) for message in messages]
+    operations.append(('patch', (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}])))
+    return operations
+
   
+@cosmos_metrics.instrument("conversations")
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False,
+                 preferred_locations: list = None, max_connections: int = None, max_connections_per_host: int = None,
+                 delete_concurrency: int = 4, delete_by_partition_key: bool = False, message_cache_size: int = 0,
+                 conversation_index_size: int = 0, log_operations: bool = False, **client_kwargs):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.delete_concurrency = delete_concurrency
+        self.delete_by_partition_key = delete_by_partition_key
+        self.message_cache = MessageCache(message_cache_size) if message_cache_size else None
+        self.conversation_index_size = conversation_index_size
+        self.log_operations = log_operations
+
+        ## anything else is passed on to the CosmosClient, e.g. connection_verify for the emulator
+        client_options = dict(client_kwargs)
+        ## request charge and latency of every response, see backend/cosmos_metrics.py
+        client_options['raw_response_hook'] = cosmos_metrics.response_hook("conversations", client_kwargs.get('raw_response_hook'))
+        if preferred_locations:
+            client_options['preferred_locations'] = preferred_locations
+        if max_connections is not None or max_connections_per_host is not None:
+            ## the client is long-lived, so size its aiohttp connection pool explicitly
+            connector = aiohttp.TCPConnector(limit=max_connections or 0, limit_per_host=max_connections_per_host or 0)
+            session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(), auto_decompress=False)
+            client_options['transport'] = AioHttpTransport(session=session, session_owner=True)
+
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential, **client_options)
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -46,15 +112,28 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
-    async def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
+    async def close(self):
+        await self.cosmosdb_client.close()
+        ## token credentials (as opposed to account keys) hold their own HTTP sessions
+        if hasattr(self.credential, 'close'):
+            await self.credential.close()
+
+    def build_conversation(self, user_id, title = ''):
+        now = datetime.utcnow().isoformat()
+        return {
+            'id': str(uuid.uuid4()),
             'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
+            'createdAt': now,
+            'updatedAt': now,
             'userId': user_id,
             'title': title
         }
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = self.build_conversation(user_id, title)
+        if self.conversation_index_size:
+            results = await self.execute_batch(user_id, [('upsert', (conversation,))] + self.index_operations(conversation['id'], conversation['updatedAt'], title))
+            return results[0].get('resourceBody', conversation)
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = await self.container_client.upsert_item(conversation)  
         if resp:
@@ -69,72 +148,324 @@ class CosmosConversationClient():
         else:
             return False
 
-    async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        if self.conversation_index_size:
+            rename = ('patch', (conversation_id, [{'op': 'set', 'path': '/title', 'value': title}]))
+            results = await self.execute_batch(user_id, [rename] + self.index_operations(conversation_id, title=title))
+            return results[0].get('resourceBody', True)
+        resp = await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{'op': 'set', 'path': '/title', 'value': title}]
+        )
+        if resp:
             return resp
         else:
-            return True
+            return False
 
-        
-    async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+    @staticmethod
+    def _throttle_delay(error, attempt: int) -> float:
+        headers = getattr(error, 'headers', None) or {}
+        retry_after = float(headers.get('x-ms-retry-after-ms') or 0) / 1000
+        backoff = min(MAX_THROTTLE_BACKOFF, 2 ** attempt * 0.1 * (1 + random.random()))
+        return max(retry_after, backoff)
+
+    async def execute_batch(self, user_id, operations: list) -> list:
+        """Runs one transactional batch, backing off while the container is throttled.
+
+        A delete of an item that is already gone fails the whole batch, so it is
+        dropped and the rest of the batch retried.
+        """
+        attempt = 0
+        while operations:
+            try:
+                ## the SDK pops the options (filter_predicate, if_match_etag) off the operations it sends, so every attempt gets its own copy
+                results = await self.container_client.execute_item_batch(batch_operations=copy.deepcopy(operations), partition_key=user_id)
+                await self._update_message_cache(user_id, operations, results)
+                return results
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code == 404 and operations[e.error_index][0] == 'delete':
+                    operations = operations[:e.error_index] + operations[e.error_index + 1:]
+                    continue
+                if e.status_code == 404 and operations[e.error_index][1][0] == CONVERSATION_INDEX_ID:
+                    ## the user's conversation index is built on first use
+                    await self._build_conversation_index(user_id)
+                    continue
+                error = e
+            except exceptions.CosmosHttpResponseError as e:
+                error = e
+            if error.status_code != 429 or attempt >= MAX_THROTTLE_RETRIES:
+                raise error
+            delay = self._throttle_delay(error, attempt)
+            logging.warning(f"CosmosDB batch throttled, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+        return []
+
+    def index_operations(self, conversation_id, updated_at: str = None, title: str = None, deleted: bool = False) -> list:
+        """Batch operations recording a conversation write in the user's conversation index, if it is enabled.
+
+        Entries are keyed by conversation id, so they are set without reading
+        the index first. A deleted conversation is set to None until the index
+        is next trimmed.
+        """
+        if not self.conversation_index_size:
+            return []
+        patches = []
+        if updated_at is not None or deleted:
+            patches.append({'op': 'set', 'path': f'/updated/{conversation_id}', 'value': None if deleted else updated_at})
+        if title is not None or deleted:
+            patches.append({'op': 'set', 'path': f'/titles/{conversation_id}', 'value': None if deleted else title})
+        return [('patch', (CONVERSATION_INDEX_ID, patches))]
+
+    async def _build_conversation_index(self, user_id) -> dict:
+        conversations, continuation_token = await self._query_conversations_page(user_id, self.conversation_index_size)
+        index = {
+            'id': CONVERSATION_INDEX_ID,
+            'type': 'conversationIndex',
+            'userId': user_id,
+            ## whether every conversation of the user is in the index, as opposed to the most recent ones
+            'complete': continuation_token is None,
+            'updated': {conversation['id']: conversation['updatedAt'] for conversation in conversations},
+            'titles': {conversation['id']: conversation['title'] for conversation in conversations},
+        }
+        try:
+            return await self.container_client.create_item(index)
+        except exceptions.CosmosResourceExistsError:
+            ## built meanwhile by another request, which may have added to it already
+            return await self.container_client.read_item(item=CONVERSATION_INDEX_ID, partition_key=user_id)
+
+    async def _trim_conversation_index(self, user_id, index: dict, entries: list):
+        """Drops deleted conversations and all but the most recent ones, unless the index changed since it was read."""
+        kept = entries[:self.conversation_index_size]
+        trimmed = dict(
+            {key: value for key, value in index.items() if not key.startswith('_')},
+            complete=index['complete'] and len(kept) == len(entries),
+            updated={entry['id']: entry['updatedAt'] for entry in kept},
+            titles={entry['id']: index['titles'].get(entry['id']) for entry in kept},
+        )
+        try:
+            await self.container_client.replace_item(
+                item=CONVERSATION_INDEX_ID, body=trimmed, etag=index['_etag'], match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            ## written to meanwhile; the next read trims it
+            pass
+
+    async def _conversations_from_index(self, user_id, limit):
+        try:
+            index = await self.container_client.read_item(item=CONVERSATION_INDEX_ID, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            index = await self._build_conversation_index(user_id)
+
+        entries = sorted(
+            ({'id': conversation_id, 'title': index['titles'].get(conversation_id), 'updatedAt': updated_at}
+             for conversation_id, updated_at in index['updated'].items() if updated_at is not None),
+            key=lambda entry: entry['updatedAt'], reverse=True
+        )
+        if len(index['updated']) > 2 * self.conversation_index_size:
+            await self._trim_conversation_index(user_id, index, entries)
+
+        page = entries[:limit]
+        ## conversations written to after being trimmed from the index come back without their title
+        untitled = [entry for entry in page if entry['title'] is None]
+        conversations = await asyncio.gather(*(self.get_conversation(user_id, entry['id']) for entry in untitled))
+        for entry, conversation in zip(untitled, conversations):
+            entry['title'] = conversation['title'] if conversation else None
+        page = [entry for entry in page if entry['title'] is not None]
+
+        if len(entries) <= limit and index['complete']:
+            return page, None
+        return page, KEYSET_TOKEN_PREFIX + json.dumps({'before': page[-1]['updatedAt'] if page else None})
+
+    async def _update_message_cache(self, user_id, operations: list, results: list):
+        ## every message write goes through a batch, whether written directly or behind the journal, and so does feedback written behind it
+        if self.message_cache is None:
+            return
+        stored = {}
+        edited = set()
+        for (operation, args, *_), result in zip(operations, results):
+            if operation == 'upsert' and args[0].get('type') == 'message':
+                stored.setdefault(args[0]['conversationId'], []).append(args[0])
+            elif operation == 'patch':
+                for patch in args[1]:
+                    if patch['path'] == '/feedback':
+                        self.message_cache.set_feedback(user_id, args[0], patch['value'])
+                        edited.add((result.get('resourceBody') or {}).get('conversationId'))
+        for conversation_id, messages in stored.items():
+            self.message_cache.add_messages(user_id, conversation_id, messages)
+        for conversation_id in edited - {None}:
+            await self._messages_changed(user_id, conversation_id)
+
+    async def _messages_changed(self, user_id, conversation_id):
+        """Moves the conversation's ``messagesVersion`` once some of its stored messages were deleted or edited.
+
+        Neither moves ``updatedAt``, so this is how other workers' message
+        caches notice; without a message cache there is nothing to tell.
+        """
+        if self.message_cache is None:
+            return
+        try:
+            conversation = await self.container_client.patch_item(item=conversation_id, partition_key=user_id, patch_operations=[MESSAGES_VERSION_PATCH])
+        except exceptions.CosmosResourceNotFoundError:
+            return
+        self.message_cache.advance(user_id, conversation_id, conversation['messagesVersion'])
+
+    async def _delete_items(self, user_id, item_ids: list) -> int:
+        """Deletes items of one partition in transactional batches, ``delete_concurrency`` batches at a time.
+
+        Returns how many items were deleted.
+        """
+        semaphore = asyncio.Semaphore(self.delete_concurrency)
+
+        async def delete_batch(batch_ids):
+            async with semaphore:
+                return len(await self.execute_batch(user_id, [('delete', (item_id,)) for item_id in batch_ids]))
 
+        deleted = await asyncio.gather(*(
+            delete_batch(item_ids[start:start + TRANSACTIONAL_BATCH_LIMIT])
+            for start in range(0, len(item_ids), TRANSACTIONAL_BATCH_LIMIT)
+        ))
+        return sum(deleted)
 
-    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+    async def _query_ids(self, user_id, query, parameters) -> list:
+        items = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            items.append(item)
+        return items
+
+    async def delete_conversation(self, user_id, conversation_id):
+        if self.message_cache is not None:
+            self.message_cache.invalidate(user_id, conversation_id)
+        if self.conversation_index_size:
+            ## a delete of an item already gone is dropped from the batch, leaving only the index update
+            results = await self.execute_batch(user_id, [('delete', (conversation_id,))] + self.index_operations(conversation_id, deleted=True))
+            return len(results) == 2
+        try:
+            await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        """Deletes every message of the conversation and returns how many were deleted."""
         parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        if limit is not None:
-            query += f" offset {offset} limit {limit}" 
-        
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
-        
-        return conversations
+        query = "SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        if self.message_cache is not None:
+            self.message_cache.invalidate(user_id, conversation_id)
+        messages = await self._query_ids(user_id, query, parameters)
+        deleted = await self._delete_items(user_id, [message['id'] for message in messages])
+        await self._messages_changed(user_id, conversation_id)
+        return deleted
 
-    async def get_conversation(self, user_id, conversation_id):
+    async def delete_all_conversations(self, user_id):
+        """Deletes every conversation and message of the user and returns the counts.
+
+        Everything of a user lives in the ``userId`` partition. With
+        ``delete_by_partition_key``, the partition is emptied by the service's
+        background delete-by-partition-key operation, which needs the feature
+        enabled on the account. Otherwise the items are deleted in batches.
+        """
         parameters = [
             {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        if self.message_cache is not None:
+            self.message_cache.invalidate(user_id)
+        items = await self._query_ids(user_id, "SELECT c.id, c.type, c.messageCount FROM c WHERE c.userId = @userId", parameters)
+        ## conversations stored as documents (see conversationdocuments.py) carry their message count
+        counts = {
+            'conversations': sum(item.get('type') == 'conversation' for item in items),
+            'messages': sum(item.get('type') == 'message' for item in items) + sum(item.get('messageCount') or 0 for item in items),
+        }
+        if self.delete_by_partition_key:
+            await self.container_client.delete_all_items_by_partition_key(user_id)
+            return counts
+
+        ## messages first, so an interrupted delete never leaves messages without their conversation
+        await self._delete_items(user_id, [item['id'] for item in items if item.get('type') != 'conversation'])
+        await self._delete_items(user_id, [item['id'] for item in items if item.get('type') == 'conversation'])
+        return counts
+
+    async def get_conversations_page(self, user_id, limit, continuation_token = None, sort_order = 'DESC'):
+        """One page of the user's conversations and the continuation token of the next page, None after the last.
+
+        The query resumes from the token instead of skipping ``OFFSET`` rows, so
+        a deep page costs the same as the first, and reads only the fields the
+        sidebar shows. With the conversation index enabled, the first page is
+        a point read of the index and later pages query conversations older
+        than its last entry.
+        """
+        if sort_order not in ('ASC', 'DESC'):
+            raise ValueError(f"Invalid sort order '{sort_order}'")
+        if continuation_token is None and sort_order == 'DESC' and 0 < limit <= self.conversation_index_size:
+            return await self._conversations_from_index(user_id, limit)
+
+        before = None
+        if continuation_token and continuation_token.startswith(KEYSET_TOKEN_PREFIX):
+            try:
+                position = json.loads(continuation_token[len(KEYSET_TOKEN_PREFIX):])
+                before, continuation_token = position['before'], position.get('continuation')
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError("Invalid continuation token") from e
+        conversations, continuation_token = await self._query_conversations_page(user_id, limit, continuation_token, sort_order, before)
+        if before is not None and continuation_token is not None:
+            continuation_token = KEYSET_TOKEN_PREFIX + json.dumps({'before': before, 'continuation': continuation_token})
+        return conversations, continuation_token
+
+    async def _query_conversations_page(self, user_id, limit, continuation_token = None, sort_order = 'DESC', before = None):
+        parameters = [
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+        condition = ""
+        if before is not None:
+            parameters.append({'name': '@before', 'value': before})
+            condition = " AND c.updatedAt < @before"
+        query = f"SELECT c.id, c.title, c.updatedAt FROM c WHERE c.userId = @userId AND c.type='conversation'{condition} ORDER BY c.updatedAt {sort_order}"
+        pages = self.container_client.query_items(
+            query=query, parameters=parameters, partition_key=user_id, max_item_count=limit
+        ).by_page(continuation_token)
+
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        try:
+            page = await pages.__anext__()
+        except StopAsyncIteration:
+            return conversations, None
+        async for item in page:
             conversations.append(item)
+        return conversations, pages.continuation_token
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    async def get_conversation(self, user_id, conversation_id):
+        ## a point read by id and partition key, cheaper than querying for it
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return None
-        else:
-            return conversations[0]
+        if conversation.get('type') != 'conversation':
+            return None
+        return conversation
  
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+    def _message_item(self, message_id, conversation_id, user_id, input_message: dict, created_at: str):
         message = {
-            'id': uuid,
+            'id': message_id,
             'type': 'message',
             'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
+            'createdAt': created_at,
+            'updatedAt': created_at,
             'conversationId' : conversation_id,
             'role': input_message['role'],
             'content': input_message['content']
@@ -142,29 +473,80 @@ class CosmosConversationClient():
 
         if self.enable_message_feedback:
             message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+        return message
+
+    def build_messages(self, conversation_id, user_id, input_messages: list, message_ids: list = None) -> list:
+        message_ids = message_ids or [str(uuid.uuid4()) for _ in input_messages]
+        ## messages of one batch get increasing timestamps so they read back in order
+        now = datetime.utcnow()
+        return [
+            self._message_item(message_id, conversation_id, user_id, input_message, (now + timedelta(microseconds=i)).isoformat())
+            for i, (message_id, input_message) in enumerate(zip(message_ids, input_messages))
+        ]
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, message_ids: list = None):
+        """Stores ``input_messages`` and moves the conversation's ``updatedAt`` in one transactional batch.
+
+        Messages and their conversation share the ``userId`` partition, so the
+        upserts and the patch of the conversation are a single round trip that
+        either fully applies or not at all. Returns the stored messages, or
+        "Conversation not found" when the conversation does not exist.
+        """
+        messages = self.build_messages(conversation_id, user_id, input_messages, message_ids)
+        try:
+            results = await self.execute_batch(user_id, message_operations(conversation_id, messages) + self.index_operations(conversation_id, messages[-1]['createdAt']))
+        except exceptions.CosmosBatchOperationError as e:
+            if e.error_index == len(messages) and e.status_code == 404:
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
+            raise
+        return [result.get('resourceBody', message) for result, message in zip(results, messages)]
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        resp = await self.create_messages(conversation_id, user_id, [input_message], message_ids=[uuid])
+        if isinstance(resp, str):
             return resp
-        else:
-            return False
+        return resp[0]
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
-            return resp
-        else:
+        try:
+            message = await self.container_client.patch_item(
+                item=message_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/feedback', 'value': feedback}]
+            )
+        except exceptions.CosmosResourceNotFoundError:
             return False
+        if self.message_cache is not None:
+            self.message_cache.set_feedback(user_id, message_id, feedback)
+            await self._messages_changed(user_id, message['conversationId'])
+        return message
+
+    async def get_messages(self, user_id, conversation_id, updated_at = None, messages_version = None):
+        """Messages of the conversation, oldest first, from the message cache when the conversation was read recently.
 
-    async def get_messages(self, user_id, conversation_id):
+        Pass the conversation's ``updatedAt`` and ``messagesVersion`` (0 when
+        it has none) to skip cached messages that another worker has since
+        added to, deleted or given feedback.
+        """
+        if self.message_cache is None:
+            return await self._read_messages(user_id, conversation_id)
+        messages = self.message_cache.get(user_id, conversation_id, updated_at, messages_version)
+        if messages is not None:
+            return messages
+        self.message_cache.reserve(user_id, conversation_id)
+        try:
+            messages = await self._read_messages(user_id, conversation_id)
+        except Exception:
+            self.message_cache.release(user_id, conversation_id)
+            raise
+        self.message_cache.fill(user_id, conversation_id, messages, messages_version)
+        return messages
+
+    async def _read_messages(self, user_id, conversation_id):
+        return await self.query_message_items(user_id, conversation_id)
+
+    async def query_message_items(self, user_id, conversation_id):
+        """Messages stored as items of their own, oldest first."""
         parameters = [
             {
                 'name': '@conversationId',
@@ -175,10 +557,9 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        ## served from the partition's range index on createdAt; see the composite index in infra/db.bicep
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
             messages.append(item)
-
         return messages
-
@@ -0,0 +1,499 @@
+"""Write-behind chat history: writes are journaled locally and flushed to CosmosDB in batches.
+
+Every write is first appended to a SQLite journal in WAL mode, shared by
+the workers of a node, and is only removed once CosmosDB has stored it, so
+a crashed or recycled worker loses nothing: its entries are claimed and
+flushed by another worker. Entries carry fully built items (ids and
+timestamps included), which makes flushing one twice harmless.
+
+Reads merge the user's entries still in the journal over what CosmosDB
+returns, so a user always sees their own writes.
+"""
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import weakref
+import threading
+from backend import metrics, serialization
+from backend.history.cosmosdbservice import TRANSACTIONAL_BATCH_LIMIT, message_operations
+from azure.cosmos import exceptions
+
+QUEUE_DEPTH = metrics.gauge("history_write_queue_depth", "History writes accepted by this worker and not yet stored in CosmosDB")
+FLUSH_SECONDS = metrics.histogram("history_flush_seconds", "Time to flush one batch of history writes to CosmosDB")
+FLUSH_ENTRIES = metrics.histogram("history_flush_entries", "History writes stored per flush", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+FLUSH_FAILURES = metrics.counter("history_flush_failures_total", "Flushes of a user's history writes that failed and will be retried")
+DROPPED_WRITES = metrics.counter("history_dropped_writes_total", "History writes dropped because their conversation or message no longer exists")
+RECOVERED_WRITES = metrics.counter("history_recovered_writes_total", "History writes left in the journal by another worker and flushed by this one")
+
+## journal entry kinds
+CONVERSATION = "conversation"
+MESSAGES = "messages"
+TITLE = "title"
+FEEDBACK = "feedback"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class HistoryJournal():
+    """Durable, ordered log of history writes not yet stored in CosmosDB.
+
+    Each entry is owned by the worker that will flush it, which refreshes its
+    claim while it keeps retrying. Entries of a worker that has exited, or
+    whose claim has not been refreshed for ``stale_after`` seconds, can be
+    claimed by another worker.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 2000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        ## opened lazily so each forked worker gets its own connection
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            ## a committed entry survives the process crashing, which is what the journal is for
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS history_journal ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, owner INTEGER NOT NULL, claimed_at REAL NOT NULL, "
+                "user_id TEXT NOT NULL, conversation_id TEXT, kind TEXT NOT NULL, payload TEXT NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS history_journal_user ON history_journal (user_id, conversation_id)")
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    def _entry(row) -> dict:
+        return {"seq": row[0], "user_id": row[1], "conversation_id": row[2], "kind": row[3], "payload": serialization.loads(row[4])}
+
+    def append(self, owner: int, user_id: str, conversation_id: str, kind: str, payload) -> dict:
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO history_journal (owner, claimed_at, user_id, conversation_id, kind, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                (owner, time.time(), user_id, conversation_id, kind, serialization.dumps(payload)),
+            )
+        return {"seq": cursor.lastrowid, "user_id": user_id, "conversation_id": conversation_id, "kind": kind, "payload": payload}
+
+    def pending(self, user_id: str, conversation_id: str = None) -> list:
+        query = "SELECT seq, user_id, conversation_id, kind, payload FROM history_journal WHERE user_id = ?"
+        parameters = [user_id]
+        if conversation_id is not None:
+            query += " AND conversation_id = ?"
+            parameters.append(conversation_id)
+        with self._lock:
+            rows = self._connect().execute(query + " ORDER BY seq", parameters).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def existing(self, seqs: list) -> set:
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT seq FROM history_journal WHERE seq IN ({','.join('?' * len(seqs))})", seqs
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def remove(self, seqs: list):
+        with self._lock:
+            self._connect().execute(f"DELETE FROM history_journal WHERE seq IN ({','.join('?' * len(seqs))})", seqs)
+
+    def discard(self, user_id: str, conversation_id: str = None, kinds: tuple = None) -> int:
+        query = "DELETE FROM history_journal WHERE user_id = ?"
+        parameters = [user_id]
+        if conversation_id is not None:
+            query += " AND conversation_id = ?"
+            parameters.append(conversation_id)
+        if kinds:
+            query += f" AND kind IN ({','.join('?' * len(kinds))})"
+            parameters.extend(kinds)
+        with self._lock:
+            return self._connect().execute(query, parameters).rowcount
+
+    def refresh(self, owner: int):
+        """Renews ``owner``'s claim on its entries, so they are not taken as stale while it is alive and flushing."""
+        with self._lock:
+            self._connect().execute("UPDATE history_journal SET claimed_at = ? WHERE owner = ?", (time.time(), owner))
+
+    def claim(self, owner: int, stale_after: float, include_own: bool = False) -> list:
+        """Takes over the entries of exited workers and stale ones, and returns them in order.
+
+        ``include_own`` also claims entries already recorded under ``owner``,
+        which at startup can only be left by an earlier process with the same pid.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                owners = [row[0] for row in connection.execute("SELECT DISTINCT owner FROM history_journal").fetchall()]
+                orphaned = [other for other in owners if (other == owner and include_own) or (other != owner and not _alive(other))]
+                rows = connection.execute(
+                    "SELECT seq, user_id, conversation_id, kind, payload FROM history_journal "
+                    f"WHERE owner IN ({','.join('?' * len(orphaned))}) OR (owner != ? AND claimed_at < ?) ORDER BY seq",
+                    orphaned + [owner, now - stale_after],
+                ).fetchall()
+                if rows:
+                    connection.execute(
+                        f"UPDATE history_journal SET owner = ?, claimed_at = ? WHERE seq IN ({','.join('?' * len(rows))})",
+                        [owner, now] + [row[0] for row in rows],
+                    )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return [self._entry(row) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM history_journal").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def entry_operations(entry: dict) -> list:
+    """The transactional batch operations that store a journal entry."""
+    payload = entry["payload"]
+    if entry["kind"] == CONVERSATION:
+        return [("upsert", (payload,))]
+    if entry["kind"] == MESSAGES:
+        return message_operations(entry["conversation_id"], payload["messages"])
+    if entry["kind"] == TITLE:
+        return [("patch", (entry["conversation_id"], [{"op": "set", "path": "/title", "value": payload["title"]}]))]
+    if entry["kind"] == FEEDBACK:
+        return [("patch", (payload["message_id"], [{"op": "set", "path": "/feedback", "value": payload["feedback"]}]))]
+    raise ValueError(f"Unknown history journal entry kind '{entry['kind']}'")
+
+
+class WriteBehindConversationClient():
+    """``CosmosConversationClient`` whose writes return once journaled and are stored by a background flusher.
+
+    The flusher takes entries off an in-process queue, waiting up to
+    ``flush_interval`` seconds to gather more, and stores each user's
+    entries in order, packed into transactional batches. A user whose flush
+    fails keeps their entries, in order, for a retry after a backoff; writes
+    of other users are not held up. Every ``recovery_interval`` seconds,
+    which must be shorter than ``stale_after``, the worker refreshes its
+    claim on its own entries and claims other workers' orphaned ones.
+    """
+
+    def __init__(self, client, journal: HistoryJournal, flush_interval: float = 0.05, max_flush_entries: int = 500,
+                 recovery_interval: float = 30, stale_after: float = 120, max_retry_backoff: float = 30):
+        self.client = client
+        self.journal = journal
+        self.flush_interval = flush_interval
+        self.max_flush_entries = max_flush_entries
+        self.recovery_interval = recovery_interval
+        self.stale_after = stale_after
+        self.max_retry_backoff = max_retry_backoff
+        self.owner = os.getpid()
+        self._queue = asyncio.Queue()
+        ## entries taken off the queue and not yet stored, by user, in journal order
+        self._pending = {}
+        self._failures = {}
+        self._retry_at = {}
+        self._locks = weakref.WeakValueDictionary()
+        self._flusher = None
+        self._recovery = None
+
+    def __getattr__(self, name):
+        ## everything not overridden here goes straight to CosmosDB
+        return getattr(self.client, name)
+
+    async def start(self):
+        self._enqueue(await asyncio.to_thread(self.journal.claim, self.owner, self.stale_after, True), recovered=True)
+        self._flusher = asyncio.create_task(self._run())
+        self._recovery = asyncio.create_task(self._recover())
+
+    def _lock(self, user_id: str) -> asyncio.Lock:
+        ## a user's lock lives as long as something holds or waits on it
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    def _depth(self) -> int:
+        return self._queue.qsize() + sum(len(entries) for entries in self._pending.values())
+
+    def _enqueue(self, entries: list, recovered: bool = False):
+        if recovered:
+            ## a claim can return entries this worker already holds, e.g. its own ones at startup
+            self._collect()
+            held = {entry["seq"] for user_entries in self._pending.values() for entry in user_entries}
+            entries = [entry for entry in entries if entry["seq"] not in held]
+        for entry in entries:
+            self._queue.put_nowait(entry)
+        if recovered and entries:
+            RECOVERED_WRITES.inc(len(entries))
+            logging.info(f"Recovered {len(entries)} history writes from the journal")
+        QUEUE_DEPTH.set(self._depth())
+
+    async def _append(self, user_id: str, conversation_id: str, kind: str, payload):
+        entry = await asyncio.to_thread(self.journal.append, self.owner, user_id, conversation_id, kind, payload)
+        self._enqueue([entry])
+
+    # Writes
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = self.client.build_conversation(user_id, title)
+        await self._append(user_id, conversation["id"], CONVERSATION, conversation)
+        return conversation
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, message_ids: list = None):
+        messages = self.client.build_messages(conversation_id, user_id, input_messages, message_ids)
+        await self._append(user_id, conversation_id, MESSAGES, {"messages": messages})
+        return messages
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        return (await self.create_messages(conversation_id, user_id, [input_message], message_ids=[uuid]))[0]
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        await self._append(user_id, conversation_id, TITLE, {"title": title})
+        return True
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        await self._append(user_id, None, FEEDBACK, {"message_id": message_id, "feedback": feedback})
+        return True
+
+    # Deletes drop the writes still pending for what they delete, so a later flush cannot bring it back
+
+    def _collect(self):
+        while not self._queue.empty():
+            entry = self._queue.get_nowait()
+            self._pending.setdefault(entry["user_id"], []).append(entry)
+
+    async def _discard(self, user_id, conversation_id=None, kinds=None):
+        self._collect()
+        self._pending[user_id] = [
+            entry for entry in self._pending.get(user_id, [])
+            if not ((conversation_id is None or entry["conversation_id"] == conversation_id) and (not kinds or entry["kind"] in kinds))
+        ]
+        await asyncio.to_thread(self.journal.discard, user_id, conversation_id, kinds)
+        QUEUE_DEPTH.set(self._depth())
+
+    async def delete_conversation(self, user_id, conversation_id):
+        async with self._lock(user_id):
+            await self._discard(user_id, conversation_id)
+            return await self.client.delete_conversation(user_id, conversation_id)
+
+    async def delete_messages(self, conversation_id, user_id):
+        async with self._lock(user_id):
+            await self._discard(user_id, conversation_id, kinds=(MESSAGES,))
+            return await self.client.delete_messages(conversation_id, user_id)
+
+    async def delete_all_conversations(self, user_id):
+        async with self._lock(user_id):
+            await self._discard(user_id)
+            return await self.client.delete_all_conversations(user_id)
+
+    # Reads see the user's pending writes
+
+    async def get_conversation(self, user_id, conversation_id):
+        entries = await asyncio.to_thread(self.journal.pending, user_id, conversation_id)
+        created = next((entry["payload"] for entry in entries if entry["kind"] == CONVERSATION), None)
+        conversation = created or await self.client.get_conversation(user_id, conversation_id)
+        if conversation is None:
+            return None
+        return self._overlay_conversation(dict(conversation), entries)
+
+    @staticmethod
+    def _overlay_conversation(conversation: dict, entries: list) -> dict:
+        for entry in entries:
+            if entry["conversation_id"] != conversation["id"]:
+                continue
+            if entry["kind"] == MESSAGES:
+                conversation["updatedAt"] = max(conversation.get("updatedAt") or "", entry["payload"]["messages"][-1]["createdAt"])
+            elif entry["kind"] == TITLE:
+                conversation["title"] = entry["payload"]["title"]
+        return conversation
+
+    async def get_conversations_page(self, user_id, limit, continuation_token = None, sort_order = 'DESC'):
+        conversations, continuation_token_out = await self.client.get_conversations_page(user_id, limit, continuation_token, sort_order)
+        entries = await asyncio.to_thread(self.journal.pending, user_id)
+        if not entries:
+            return conversations, continuation_token_out
+
+        stored = {conversation["id"] for conversation in conversations}
+        conversations = [self._overlay_conversation(dict(conversation), entries) for conversation in conversations]
+        if continuation_token is None:
+            ## conversations not stored yet are the newest, they go on the first page
+            conversations.extend(
+                self._overlay_conversation({key: entry["payload"][key] for key in ("id", "title", "updatedAt")}, entries)
+                for entry in entries if entry["kind"] == CONVERSATION and entry["conversation_id"] not in stored
+            )
+        conversations.sort(key=lambda conversation: conversation.get("updatedAt") or "", reverse=sort_order == 'DESC')
+        return conversations, continuation_token_out
+
+    async def get_messages(self, user_id, conversation_id, updated_at = None, messages_version = None):
+        messages = await self.client.get_messages(user_id, conversation_id, updated_at, messages_version)
+        entries = await asyncio.to_thread(self.journal.pending, user_id)
+        stored = {message["id"] for message in messages}
+        messages.extend(
+            message for entry in entries if entry["kind"] == MESSAGES and entry["conversation_id"] == conversation_id
+            for message in entry["payload"]["messages"] if message["id"] not in stored
+        )
+        feedback = {entry["payload"]["message_id"]: entry["payload"]["feedback"] for entry in entries if entry["kind"] == FEEDBACK}
+        for message in messages:
+            if message["id"] in feedback:
+                message["feedback"] = feedback[message["id"]]
+        return messages
+
+    # Flushing
+
+    async def _run(self):
+        while True:
+            try:
+                await self._flush_ready()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Unexpected error flushing history writes")
+
+    async def _flush_ready(self):
+        ## wait for a write, or for the next retry, then give more writes a moment to arrive
+        if not self._queue.qsize():
+            timeout = None
+            ready_at = [self._retry_at.get(user_id, 0) for user_id, entries in self._pending.items() if entries]
+            if ready_at:
+                timeout = max(0, min(ready_at) - time.monotonic())
+            try:
+                entry = await asyncio.wait_for(self._queue.get(), timeout)
+                self._pending.setdefault(entry["user_id"], []).append(entry)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.sleep(self.flush_interval)
+        self._collect()
+
+        now = time.monotonic()
+        users = [
+            user_id for user_id, entries in self._pending.items()
+            if entries and self._retry_at.get(user_id, 0) <= now
+        ]
+        await asyncio.gather(*(self._flush_user(user_id) for user_id in users))
+        for user_id in [user_id for user_id, entries in self._pending.items() if not entries]:
+            del self._pending[user_id]
+        QUEUE_DEPTH.set(self._depth())
+
+    async def _flush_user(self, user_id: str):
+        async with self._lock(user_id):
+            entries = self._pending.get(user_id, [])[:self.max_flush_entries]
+            if not entries:
+                return
+            started = time.monotonic()
+            try:
+                ## another worker may have deleted the conversation and discarded the entries meanwhile
+                existing = await asyncio.to_thread(self.journal.existing, [entry["seq"] for entry in entries])
+                stored = await self._store(user_id, [entry for entry in entries if entry["seq"] in existing])
+            except Exception as e:
+                failures = self._failures.get(user_id, 0) + 1
+                self._failures[user_id] = failures
+                delay = min(self.max_retry_backoff, 0.5 * 2 ** (failures - 1))
+                self._retry_at[user_id] = time.monotonic() + delay
+                FLUSH_FAILURES.inc()
+                logging.warning(f"Storing history writes failed, retrying in {delay:.1f}s: {e}")
+                return
+
+            done = {entry["seq"] for entry in entries}
+            self._pending[user_id] = [entry for entry in self._pending[user_id] if entry["seq"] not in done]
+            self._failures.pop(user_id, None)
+            self._retry_at.pop(user_id, None)
+            await asyncio.to_thread(self.journal.remove, list(done))
+            FLUSH_SECONDS.observe(time.monotonic() - started)
+            FLUSH_ENTRIES.observe(stored)
+
+    def _entry_operations(self, entry: dict) -> list:
+        ## the user's conversation index is updated in the same batch, when the client keeps one
+        payload = entry["payload"]
+        if entry["kind"] == CONVERSATION:
+            index = self.client.index_operations(entry["conversation_id"], payload["updatedAt"], payload["title"])
+        elif entry["kind"] == MESSAGES:
+            index = self.client.index_operations(entry["conversation_id"], payload["messages"][-1]["createdAt"])
+        elif entry["kind"] == TITLE:
+            index = self.client.index_operations(entry["conversation_id"], title=payload["title"])
+        else:
+            index = []
+        return entry_operations(entry) + index
+
+    async def _store(self, user_id: str, entries: list) -> int:
+        """Stores ``entries`` in order, as few transactional batches as they fit in; returns how many were stored."""
+        stored = 0
+        batch = []
+        for entry in entries:
+            operations = self._entry_operations(entry)
+            if batch and sum(len(operations) for _, operations in batch) + len(operations) > TRANSACTIONAL_BATCH_LIMIT:
+                stored += await self._store_batch(user_id, batch)
+                batch = []
+            batch.append((entry, operations))
+        if batch:
+            stored += await self._store_batch(user_id, batch)
+        return stored
+
+    async def _store_batch(self, user_id: str, batch: list) -> int:
+        while batch:
+            operations = [operation for _, entry_operations in batch for operation in entry_operations]
+            try:
+                await self.client.execute_batch(user_id, operations)
+                return len(batch)
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code != 404:
+                    raise
+                ## the entry patching an item that no longer exists is dropped and the rest retried
+                offset = 0
+                for index, (entry, entry_operations) in enumerate(batch):
+                    offset += len(entry_operations)
+                    if e.error_index < offset:
+                        break
+                DROPPED_WRITES.inc()
+                logging.warning(f"Dropped a history {entry['kind']} write, its conversation or message no longer exists")
+                batch = batch[:index] + batch[index + 1:]
+        return 0
+
+    async def _recover(self):
+        while True:
+            await asyncio.sleep(self.recovery_interval)
+            try:
+                await asyncio.to_thread(self.journal.refresh, self.owner)
+                self._enqueue(await asyncio.to_thread(self.journal.claim, self.owner, self.stale_after), recovered=True)
+            except Exception:
+                logging.exception("Failed to recover history writes from the journal")
+
+    async def flush(self, timeout: float = None):
+        """Stores everything pending now, giving up after ``timeout`` seconds; what is left stays journaled."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._collect()
+        while self._depth() and (deadline is None or time.monotonic() < deadline):
+            self._retry_at.clear()
+            for user_id in list(self._pending):
+                await self._flush_user(user_id)
+            self._collect()
+            if self._depth():
+                await asyncio.sleep(min(1, max(0, deadline - time.monotonic())) if deadline is not None else 1)
+        QUEUE_DEPTH.set(self._depth())
+
+    async def close(self, timeout: float = 10):
+        for task in (self._recovery, self._flusher):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        try:
+            await self.flush(timeout)
+        finally:
+            await asyncio.to_thread(self.journal.close)
+            await self.client.close()
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+from backend import metrics
+
+CACHE_HITS = metrics.counter("history_message_cache_hits_total", "Conversation reads answered from the message cache")
+CACHE_MISSES = metrics.counter("history_message_cache_misses_total", "Conversation reads that queried CosmosDB")
+CACHE_EVICTIONS = metrics.counter("history_message_cache_evictions_total", "Conversations evicted from the message cache to respect the size limit")
+
+
+class MessageCache():
+    """LRU cache of the messages of recently read conversations, local to one worker process.
+
+    This worker's writes of messages and feedback are applied to cached
+    conversations, so entries stay current without expiring. A read that misses is reserved
+    before querying and only filled if no write to the conversation happened
+    meanwhile, so a slow query cannot cache a list missing a newer message.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        ## the conversation's messagesVersion each entry was read at, None when not known
+        self._versions = {}
+        ## conversations being loaded: number of loads, and whether a write came in meanwhile
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, conversation_id, updated_at: str = None, messages_version: int = None):
+        """Cached messages of the conversation, oldest first.
+
+        Other workers write to the conversation without updating this cache.
+        Given the conversation's ``updatedAt``, which every message write moves
+        to the newest message's ``createdAt``, an entry missing newer messages
+        is dropped rather than returned. Deleting messages and setting feedback
+        leave ``updatedAt`` alone and move the conversation's ``messagesVersion``
+        instead; given it, an entry read at another version is dropped too.
+        """
+        key = (user_id, conversation_id)
+        with self._lock:
+            messages = self._entries.get(key)
+            if messages is not None and (
+                (updated_at and (not messages or (messages[-1].get("createdAt") or "") < updated_at))
+                or (messages_version is not None and self._versions.get(key) != messages_version)
+            ):
+                del self._entries[key]
+                self._versions.pop(key, None)
+                messages = None
+            if messages is None:
+                CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            CACHE_HITS.inc()
+            return [dict(message) for message in messages]
+
+    def reserve(self, user_id, conversation_id):
+        with self._lock:
+            loads, written = self._loading.get((user_id, conversation_id), (0, False))
+            self._loading[(user_id, conversation_id)] = (loads + 1, written)
+
+    def _release(self, key) -> bool:
+        loads, written = self._loading.pop(key, (1, True))
+        if loads > 1:
+            self._loading[key] = (loads - 1, written)
+        return written
+
+    def release(self, user_id, conversation_id):
+        """Ends a load started with ``reserve`` that failed."""
+        with self._lock:
+            self._release((user_id, conversation_id))
+
+    def fill(self, user_id, conversation_id, messages: list, messages_version: int = None):
+        """Caches the result of a load started with ``reserve``, unless the conversation was written to since.
+
+        ``messages_version`` is the conversation's ``messagesVersion`` as read before the messages.
+        """
+        key = (user_id, conversation_id)
+        with self._lock:
+            if self._release(key):
+                return
+            self._entries[key] = [dict(message) for message in messages]
+            self._entries.move_to_end(key)
+            self._versions[key] = messages_version
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._versions.pop(evicted, None)
+                CACHE_EVICTIONS.inc()
+
+    def add_messages(self, user_id, conversation_id, messages: list):
+        key = (user_id, conversation_id)
+        with self._lock:
+            if key in self._loading:
+                self._loading[key] = (self._loading[key][0], True)
+            cached = self._entries.get(key)
+            if cached is None:
+                return
+            ids = {message["id"] for message in messages}
+            cached[:] = [message for message in cached if message["id"] not in ids] + [dict(message) for message in messages]
+            cached.sort(key=lambda message: message.get("createdAt") or "")
+
+    def set_feedback(self, user_id, message_id, feedback):
+        with self._lock:
+            for (cached_user_id, _), messages in self._entries.items():
+                if cached_user_id != user_id:
+                    continue
+                for message in messages:
+                    if message["id"] == message_id:
+                        message["feedback"] = feedback
+                        return
+
+    def advance(self, user_id, conversation_id, messages_version: int):
+        """Follows this worker's own bump of ``messagesVersion``, for a change already applied to the cached messages.
+
+        The entry stays current only if it was at the version just before, so
+        a change another worker made in between still drops it.
+        """
+        key = (user_id, conversation_id)
+        with self._lock:
+            if key in self._entries and self._versions.get(key) == messages_version - 1:
+                self._versions[key] = messages_version
+
+    def invalidate(self, user_id, conversation_id=None):
+        with self._lock:
+            for key in [key for key in list(self._entries) + list(self._loading) if key[0] == user_id and conversation_id in (None, key[1])]:
+                self._entries.pop(key, None)
+                self._versions.pop(key, None)
+                if key in self._loading:
+                    self._loading[key] = (self._loading[key][0], True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self._entries.clear()
+        self._versions.clear()
@@ -0,0 +1,169 @@
+"""Converts chat history between the item-per-message and document-per-conversation layouts.
+
+Run from the repository root with the app's CosmosDB settings in the
+environment:
+
+    python -m backend.history.migrate --to document
+
+Switch the app to AZURE_COSMOSDB_STORAGE_LAYOUT=document before migrating in
+either direction: that client reads and writes conversations of both layouts,
+so the app keeps working while conversations are converted one at a time.
+Converting a conversation takes three steps:
+
+1. its messages are written in the target layout,
+2. the conversation item is switched to the target layout, only if nothing
+   was written to it since step 1 (otherwise it is converted again),
+3. the messages in the old layout are deleted.
+
+Converting a conversation again is harmless, so an interrupted run is
+restarted as is.
+"""
+import os
+import asyncio
+import argparse
+from azure.cosmos import exceptions
+from azure.identity.aio import DefaultAzureCredential
+from backend.history.conversationdocuments import LAYOUT, DocumentConversationClient, bucket_document, message_size, pack_buckets
+
+ITEMS = "items"
+## fields the document layout adds to a conversation item
+LAYOUT_FIELDS = ('layout', 'buckets', 'tailBytes', 'messageCount')
+## attempts at converting a conversation that keeps being written to
+MAX_ATTEMPTS = 5
+
+
+def _body(item: dict) -> dict:
+    ## without the system properties Cosmos DB adds
+    return {key: value for key, value in item.items() if not key.startswith('_')}
+
+
+async def _upsert_all(client, items: list):
+    ## one by one: a bucket can be close to the 2 MB request limit of a transactional batch
+    semaphore = asyncio.Semaphore(client.delete_concurrency)
+
+    async def upsert(item):
+        async with semaphore:
+            await client.container_client.upsert_item(item)
+
+    await asyncio.gather(*(upsert(item) for item in items))
+
+
+async def _switch(client, conversation: dict, switched: dict):
+    await client.execute_batch(conversation['userId'], [('replace', (conversation['id'], switched), {'if_match_etag': conversation['_etag']})])
+
+
+async def to_documents(client: DocumentConversationClient, conversation: dict) -> int:
+    """Moves the conversation's messages into bucket documents; returns how many were moved."""
+    user_id, conversation_id = conversation['userId'], conversation['id']
+    messages = await client.query_message_items(user_id, conversation_id)
+    moved = 0
+    if conversation.get('layout') != LAYOUT:
+        buckets = pack_buckets([_body(message) for message in messages])
+        await _upsert_all(client, [bucket_document(user_id, conversation_id, bucket, bucket_messages) for bucket, bucket_messages in enumerate(buckets)])
+        await _switch(client, conversation, dict(
+            _body(conversation),
+            layout=LAYOUT,
+            buckets=len(buckets),
+            tailBytes=sum(message_size(message) for message in buckets[-1]) if buckets else 0,
+            messageCount=len(messages),
+        ))
+        moved = len(messages)
+    await client._delete_items(user_id, [message['id'] for message in messages])
+    return moved
+
+
+async def to_items(client: DocumentConversationClient, conversation: dict) -> int:
+    """Moves the conversation's messages out of its bucket documents into items of their own; returns how many were moved."""
+    user_id, conversation_id = conversation['userId'], conversation['id']
+    moved = 0
+    if conversation.get('layout') == LAYOUT:
+        buckets = await asyncio.gather(*(client._read_bucket(user_id, conversation_id, bucket) for bucket in range(conversation['buckets'])))
+        messages = [message for bucket_messages in buckets for message in bucket_messages]
+        await _upsert_all(client, messages)
+        await _switch(client, conversation, {key: value for key, value in _body(conversation).items() if key not in LAYOUT_FIELDS})
+        moved = len(messages)
+    parameters = [
+        {
+            'name': '@conversationId',
+            'value': conversation_id
+        },
+        {
+            'name': '@userId',
+            'value': user_id
+        }
+    ]
+    query = "SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type = 'messages' AND c.userId = @userId"
+    buckets = await client._query_ids(user_id, query, parameters)
+    await client._delete_items(user_id, [bucket['id'] for bucket in buckets])
+    return moved
+
+
+async def migrate_user(client: DocumentConversationClient, user_id, to: str, dry_run: bool = False) -> dict:
+    """Converts every conversation of the user to the ``to`` layout and returns what was converted."""
+    parameters = [
+        {
+            'name': '@userId',
+            'value': user_id
+        }
+    ]
+    conversations = await client._query_ids(user_id, "SELECT * FROM c WHERE c.userId = @userId AND c.type = 'conversation'", parameters)
+    pending = [conversation for conversation in conversations if (conversation.get('layout') == LAYOUT) != (to == LAYOUT)]
+    counts = {'conversations': len(pending), 'messages': 0}
+    if dry_run:
+        return counts
+
+    convert = to_documents if to == LAYOUT else to_items
+    ## conversations already in the target layout may still have messages left in the old one by an interrupted run
+    for conversation in conversations:
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                counts['messages'] += await convert(client, conversation)
+                break
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code != 412 or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                ## written to while converting, start over from its current state
+                conversation = await client.get_conversation(user_id, conversation['id'])
+                if conversation is None:
+                    break
+    return counts
+
+
+async def user_ids(client: DocumentConversationClient) -> list:
+    query = "SELECT DISTINCT VALUE c.userId FROM c WHERE c.type = 'conversation'"
+    return [user_id async for user_id in client.container_client.query_items(query=query)]
+
+
+async def run(args):
+    credential = args.key or DefaultAzureCredential()
+    client = DocumentConversationClient(
+        cosmosdb_endpoint=args.endpoint,
+        credential=credential,
+        database_name=args.database,
+        container_name=args.container,
+        delete_concurrency=args.concurrency,
+    )
+    try:
+        totals = {'conversations': 0, 'messages': 0}
+        for user_id in args.user_id or await user_ids(client):
+            counts = await migrate_user(client, user_id, args.to, dry_run=args.dry_run)
+            totals = {key: totals[key] + counts[key] for key in totals}
+            print(f"{user_id}: {counts['conversations']} conversations, {counts['messages']} messages")
+        action = "Would convert" if args.dry_run else "Converted"
+        print(f"{action} {totals['conversations']} conversations to the {args.to} layout, moving {totals['messages']} messages")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    account = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
+    parser = argparse.ArgumentParser(description="Convert chat history between the items and document storage layouts")
+    parser.add_argument("--to", required=True, choices=[LAYOUT, ITEMS])
+    parser.add_argument("--endpoint", default=f"https://{account}.documents.azure.com:443/" if account else None, required=not account)
+    parser.add_argument("--key", default=os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY"), help="Account key; Entra ID is used when empty")
+    parser.add_argument("--database", default=os.environ.get("AZURE_COSMOSDB_DATABASE"))
+    parser.add_argument("--container", default=os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"))
+    parser.add_argument("--user_id", action="append", help="Only convert this user's history; repeat for several. Default: every user")
+    parser.add_argument("--concurrency", type=int, default=4, help="Writes and delete batches in flight at once")
+    parser.add_argument("--dry_run", action="store_true", help="Only count what would be converted")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,342 @@
+import os
+import copy
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import sqlite3
+import threading
+from backend import serialization
+
+## every sample is labelled with the node, and with the worker process it comes from unless summed by SharedMetrics
+NODE = socket.gethostname()
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def worker_labels() -> list:
+    ## read on every use, gunicorn forks the workers after the app may have been imported
+    return [("node", NODE), ("worker", str(os.getpid()))]
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+class Metric():
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(labelvalues), copy.deepcopy(value)] for labelvalues, value in self._values.items()]
+
+    @staticmethod
+    def add(total, value):
+        return total + value
+
+    def collect(self, extra_labels: list = (), values: dict = None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labelvalues, value in sorted((self._values if values is None else values).items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues, extra_labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                ## per-bucket (non-cumulative) counts, sum, count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def get(self, **labels):
+        """Returns ``(count, sum)`` for the given labels."""
+        state = self._values.get(self._key(labels))
+        return (state[2], state[1]) if state else (0, 0.0)
+
+    @staticmethod
+    def add(total, value):
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1], total[2] + value[2]]
+
+    def collect(self, extra_labels: list = (), values: dict = None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        extra_labels = list(extra_labels)
+        for labelvalues, (bucket_counts, total, count) in sorted((self._values if values is None else values).items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, extra_labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, extra_labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues, extra_labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues, extra_labels)} {count}")
+        return lines
+
+
+class MetricsRegistry():
+    """Per-process metrics rendered in the Prometheus text exposition format.
+
+    gunicorn runs several workers, each with its own registry, and a scrape
+    of ``/metrics`` reaches any one of them. On its own a registry renders
+    its samples with ``node`` (host name) and ``worker`` (process id)
+    labels; ``render(snapshots)`` renders the sum of several workers'
+    snapshots with the ``node`` label only, see SharedMetrics.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        if {"node", "worker"} & set(metric.labelnames):
+            raise ValueError(f"Metric {metric.name} cannot use the node and worker labels, every sample gets them")
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered with a different type or labels")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def snapshot(self) -> dict:
+        """The values of every metric, in a JSON serializable form."""
+        with self._lock:
+            registered = dict(self._metrics)
+        return {name: {"type": metric.type_name, "values": metric.snapshot()} for name, metric in registered.items()}
+
+    def merge(self, snapshots: list) -> dict:
+        """Sums snapshots, skipping metrics this registry doesn't know or knows with another type."""
+        merged = {}
+        for snapshot in snapshots:
+            for name, entry in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None or metric.type_name != entry["type"]:
+                    continue
+                values = merged.setdefault(name, {})
+                for labelvalues, value in entry["values"]:
+                    key = tuple(labelvalues)
+                    values[key] = metric.add(values[key], value) if key in values else value
+        return {name: {"type": self._metrics[name].type_name, "values": [[list(key), value] for key, value in values.items()]}
+                for name, values in merged.items()}
+
+    def render(self, snapshots: list = None) -> str:
+        lines = []
+        if snapshots is None:
+            extra_labels = worker_labels()
+            merged = None
+        else:
+            extra_labels = [("node", NODE)]
+            merged = self.merge(snapshots)
+        for name in sorted(self._metrics):
+            if merged is None:
+                lines.extend(self._metrics[name].collect(extra_labels))
+            else:
+                values = {tuple(labelvalues): value for labelvalues, value in merged.get(name, {"values": []})["values"]}
+                lines.extend(self._metrics[name].collect(extra_labels, values))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedMetrics():
+    """The metrics of every worker on a node, summed through a SQLite database in WAL mode.
+
+    Each worker publishes a snapshot of its registry every
+    ``publish_interval`` seconds and whenever it is scraped, and a scrape
+    renders the sum of the latest snapshots, so whichever worker answers
+    reports the node's totals. When a worker exits, its counters and
+    histograms are folded into a row of retired totals, so the node's
+    counters don't go back down; its gauges describe a live process and
+    are dropped. A worker killed without shutting down is folded in by the
+    next scrape, losing what it counted after its last publish.
+    """
+
+    ## pid of the row holding the totals of exited workers
+    RETIRED = 0
+
+    def __init__(self, path: str, registry: MetricsRegistry = REGISTRY, publish_interval: float = 15, busy_timeout_ms: int = 2000):
+        self.path = path
+        self.registry = registry
+        self.publish_interval = publish_interval
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection = None
+        self._pid = None
+        self._token = None
+        self._publisher = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        ## opened lazily so each forked worker gets its own connection
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metrics_snapshots ("
+                "pid INTEGER PRIMARY KEY, token TEXT NOT NULL, published_at REAL NOT NULL, snapshot TEXT NOT NULL)"
+            )
+            self._connection = connection
+        return self._connection
+
+    def _identity(self):
+        ## a recycled pid gets a new token, so the row of the exited process it replaces is retired, not overwritten
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid, self._token = pid, uuid.uuid4().hex
+        return self._pid, self._token
+
+    def _retire(self, connection, snapshot: dict):
+        row = connection.execute("SELECT snapshot FROM metrics_snapshots WHERE pid = ?", (self.RETIRED,)).fetchone()
+        kept = {name: entry for name, entry in snapshot.items() if entry["type"] != "gauge"}
+        retired = self.registry.merge(([serialization.loads(row[0])] if row else []) + [kept])
+        connection.execute(
+            "INSERT OR REPLACE INTO metrics_snapshots (pid, token, published_at, snapshot) VALUES (?, '', ?, ?)",
+            (self.RETIRED, time.time(), serialization.dumps(retired)),
+        )
+
+    def _write(self, snapshot: dict, exiting: bool = False):
+        pid, token = self._identity()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute("SELECT pid, token, snapshot FROM metrics_snapshots WHERE pid != ?", (self.RETIRED,)).fetchall()
+            for other, other_token, other_snapshot in rows:
+                if (other == pid and other_token != token) or (other != pid and not _alive(other)):
+                    self._retire(connection, serialization.loads(other_snapshot))
+                    connection.execute("DELETE FROM metrics_snapshots WHERE pid = ?", (other,))
+            if exiting:
+                self._retire(connection, snapshot)
+                connection.execute("DELETE FROM metrics_snapshots WHERE pid = ?", (pid,))
+            else:
+                connection.execute(
+                    "INSERT OR REPLACE INTO metrics_snapshots (pid, token, published_at, snapshot) VALUES (?, ?, ?, ?)",
+                    (pid, token, time.time(), serialization.dumps(snapshot)),
+                )
+            snapshots = [serialization.loads(row[0]) for row in connection.execute("SELECT snapshot FROM metrics_snapshots").fetchall()]
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return snapshots
+
+    def publish(self) -> list:
+        """Stores this worker's snapshot, retires exited workers, and returns the snapshots of the node."""
+        with self._lock:
+            return self._write(self.registry.snapshot())
+
+    def render(self) -> str:
+        return self.registry.render(self.publish())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            try:
+                await asyncio.to_thread(self.publish)
+            except Exception:
+                logging.exception("Failed to publish this worker's metrics")
+
+    async def start(self):
+        await asyncio.to_thread(self.publish)
+        self._publisher = asyncio.create_task(self._run())
+
+    def retire(self):
+        """Folds this worker's counters into the retired totals, as it exits."""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._write(self.registry.snapshot(), exiting=True)
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def close(self):
+        if self._publisher is not None:
+            self._publisher.cancel()
+            await asyncio.gather(self._publisher, return_exceptions=True)
+            self._publisher = None
+        await asyncio.to_thread(self.retire)
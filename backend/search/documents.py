@@ -0,0 +1,85 @@
+"""Chunk input and per-row metadata shared by the local search indexes."""
+import os
+import mmap
+import logging
+import dataclasses
+import numpy as np
+from backend import serialization
+from backend.auth.graph_groups import parse_group_filter
+
+METADATA_FILE = "metadata.jsonl"
+METADATA_OFFSETS_FILE = "metadata_offsets.npy"
+
+
+def load_jsonl(path: str):
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield serialization.loads(line)
+
+
+def _as_dict(document) -> dict:
+    if isinstance(document, dict):
+        return document
+    if dataclasses.is_dataclass(document):
+        return dataclasses.asdict(document)
+    return vars(document)
+
+
+def iter_chunks(source):
+    """Yields chunks as dicts from a ``ChunkingResult``, an iterable of ``Document`` chunks or dicts, or a JSONL path."""
+    if isinstance(source, str):
+        source = load_jsonl(source)
+    for document in getattr(source, "chunks", source):
+        yield _as_dict(document)
+
+
+def write_metadata(path: str, documents):
+    """Writes one JSON object per row plus the byte offset of each row, for ``MetadataStore``."""
+    offsets = [0]
+    with open(os.path.join(path, METADATA_FILE), "wb") as f:
+        for document in documents:
+            line = serialization.dumps_bytes(document) + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.save(os.path.join(path, METADATA_OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+
+
+class MetadataStore():
+    """Row metadata read on demand from a memory-mapped JSONL file."""
+
+    def __init__(self, path: str):
+        self._offsets = np.load(os.path.join(path, METADATA_OFFSETS_FILE), mmap_mode="r")
+        self._file = open(os.path.join(path, METADATA_FILE), "rb")
+        self._metadata = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getitem__(self, row: int) -> dict:
+        return serialization.loads(self._metadata[self._offsets[row]:self._offsets[row + 1]])
+
+    def close(self):
+        self._metadata.close()
+        self._file.close()
+
+
+def search_results(metadata: MetadataStore, scores, rows, top: int, search_filter: str = None) -> list:
+    """Turns ranked ``(scores, rows)`` into search results shaped like Azure AI Search's, applying a group filter."""
+    group_filter = parse_group_filter(search_filter) if search_filter else None
+    results = []
+    for score, row in zip(scores, rows):
+        if row < 0:
+            break
+        document = metadata[int(row)]
+        if group_filter is not None:
+            column, groups = group_filter
+            if not groups & set(document.get(column) or []):
+                continue
+        document["@search.score"] = float(score)
+        results.append(document)
+        if len(results) == top:
+            break
+    return results
+
+
+def log_skipped(skipped: int, reason: str):
+    if skipped:
+        logging.warning(f"Skipped {skipped} chunks {reason}")
@@ -0,0 +1,219 @@
+"""Local BM25 inverted index for keyword retrieval without a search service.
+
+An index is a directory holding:
+
+- ``vocabulary.json``: every term with its document frequency, in term id order;
+- ``postings_offsets.npy``: where each term's postings start, so the postings
+  of term ``t`` are ``[offsets[t], offsets[t + 1])``;
+- ``postings_rows.npy`` and ``postings_tf.npy``: the rows containing each
+  term and the term's frequency in them, sorted by term id;
+- ``doc_lengths.npy``: the number of terms in each row;
+- ``metadata.jsonl`` and ``metadata_offsets.npy``: the chunk fields, as in
+  the vector index;
+- ``index.json``: the manifest.
+
+The arrays are opened with ``mmap_mode="r"`` so every worker shares the same
+pages and loading costs only the vocabulary. Build one from the chunks
+written by ``scripts/data_preparation.py`` (embedded or not) with
+``python -m backend.search.keyword_index --input chunks.jsonl --output index_dir``.
+"""
+import os
+import re
+import json
+import time
+import argparse
+import numpy as np
+from collections import Counter
+from backend import metrics
+from backend.search.documents import MetadataStore, iter_chunks, log_skipped, search_results, write_metadata
+
+LOCAL_SEARCH_SECONDS = metrics.histogram("local_keyword_search_seconds", "Time to search the local keyword index")
+
+INDEX_VERSION = 1
+MANIFEST_FILE = "index.json"
+VOCABULARY_FILE = "vocabulary.json"
+POSTINGS_OFFSETS_FILE = "postings_offsets.npy"
+POSTINGS_ROWS_FILE = "postings_rows.npy"
+POSTINGS_TF_FILE = "postings_tf.npy"
+DOC_LENGTHS_FILE = "doc_lengths.npy"
+
+## fields dropped from the stored metadata, they are not needed to serve keyword results
+VECTOR_FIELDS = ("contentVector", "titleVector")
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list:
+    return _TOKEN.findall(text.lower())
+
+
+def build_keyword_index(source, path: str, fields=("title", "content"), k1: float = 1.2, b: float = 0.75):
+    """Writes an index for ``source`` to the directory ``path`` and returns it loaded.
+
+    ``source`` is a ``ChunkingResult``, an iterable of ``Document`` chunks or
+    of dicts, or the path of a JSONL file of chunks. The text of ``fields``
+    is indexed; chunks with none of it are skipped.
+    """
+    vocabulary = {}
+    term_ids = []
+    term_counts = []
+    doc_lengths = []
+    metadata = []
+    skipped = 0
+    for document in iter_chunks(source):
+        tokens = [token for field in fields for token in tokenize(document.get(field) or "")]
+        if not tokens:
+            skipped += 1
+            continue
+        counts = Counter(tokens)
+        term_ids.append(np.fromiter((vocabulary.setdefault(term, len(vocabulary)) for term in counts), dtype=np.int32, count=len(counts)))
+        term_counts.append(np.fromiter(counts.values(), dtype=np.int32, count=len(counts)))
+        doc_lengths.append(len(tokens))
+        metadata.append({key: value for key, value in document.items() if key not in VECTOR_FIELDS})
+    if not metadata:
+        raise ValueError(f"No chunks with text in {', '.join(fields)} to index")
+    log_skipped(skipped, f"without text in {', '.join(fields)}")
+
+    ## invert (row, term) pairs into postings grouped by term, rows ascending within a term
+    terms = np.concatenate(term_ids)
+    rows = np.repeat(np.arange(len(metadata), dtype=np.int32), [len(ids) for ids in term_ids])
+    frequencies = np.concatenate(term_counts)
+    order = np.argsort(terms, kind="stable")
+    document_frequency = np.bincount(terms, minlength=len(vocabulary))
+    offsets = np.concatenate([[0], np.cumsum(document_frequency)]).astype(np.int64)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, POSTINGS_OFFSETS_FILE), offsets)
+    np.save(os.path.join(path, POSTINGS_ROWS_FILE), rows[order])
+    np.save(os.path.join(path, POSTINGS_TF_FILE), frequencies[order].astype(np.float32))
+    np.save(os.path.join(path, DOC_LENGTHS_FILE), np.asarray(doc_lengths, dtype=np.float32))
+    with open(os.path.join(path, VOCABULARY_FILE), "w") as f:
+        json.dump(list(vocabulary), f)
+    write_metadata(path, metadata)
+    manifest = {
+        "version": INDEX_VERSION,
+        "count": len(metadata),
+        "terms": len(vocabulary),
+        "fields": list(fields),
+        "average_length": float(np.mean(doc_lengths)),
+        "k1": k1,
+        "b": b,
+    }
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+    return KeywordIndex.load(path)
+
+
+class KeywordIndex():
+    """BM25 ranking over memory-mapped postings.
+
+    A query scores only the postings of its terms, accumulating into one
+    dense score array per query, so the cost grows with the number of rows
+    containing the query terms rather than with the corpus.
+    """
+
+    def __init__(self, path: str, manifest: dict, vocabulary: dict, offsets, rows, frequencies, doc_lengths, metadata: MetadataStore):
+        self.path = path
+        self.manifest = manifest
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.rows = rows
+        self.frequencies = frequencies
+        self.metadata = metadata
+        k1, b = manifest["k1"], manifest["b"]
+        ## the per-row part of the BM25 denominator, so scoring a posting is one gather
+        self._length_norm = (k1 * (1 - b + b * np.asarray(doc_lengths) / manifest["average_length"])).astype(np.float32)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported keyword index version {manifest.get('version')} in {path}")
+        with open(os.path.join(path, VOCABULARY_FILE)) as f:
+            vocabulary = {term: term_id for term_id, term in enumerate(json.load(f))}
+        return cls(
+            path,
+            manifest,
+            vocabulary,
+            np.load(os.path.join(path, POSTINGS_OFFSETS_FILE), mmap_mode="r"),
+            np.load(os.path.join(path, POSTINGS_ROWS_FILE), mmap_mode="r"),
+            np.load(os.path.join(path, POSTINGS_TF_FILE), mmap_mode="r"),
+            np.load(os.path.join(path, DOC_LENGTHS_FILE), mmap_mode="r"),
+            MetadataStore(path),
+        )
+
+    def __len__(self):
+        return self.manifest["count"]
+
+    def document(self, row: int) -> dict:
+        return self.metadata[row]
+
+    def idf(self, document_frequency):
+        return np.log(1 + (len(self) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def search(self, query: str, k: int = 5):
+        """Returns ``(scores, rows)`` of the best ``k`` rows containing a query term, best first."""
+        term_ids = {self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}
+        if not term_ids:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        k1 = self.manifest["k1"]
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows = self.rows[start:end]
+            frequencies = self.frequencies[start:end]
+            scores[rows] += self.idf(end - start) * frequencies * (k1 + 1) / (frequencies + self._length_norm[rows])
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return scores[candidates], candidates
+
+    def close(self):
+        self.metadata.close()
+
+
+class KeywordSearchClient():
+    """Serves ``Retriever`` search requests from a ``KeywordIndex``.
+
+    Takes the same request body as the Azure AI Search client and answers in
+    the same shape, ranking by the ``search`` text; vector queries are
+    ignored, so a request without text finds nothing. Group filters are
+    applied to an over-fetched candidate list.
+    """
+
+    ## candidates fetched per requested result when a filter has to be applied
+    FILTER_OVERFETCH = 10
+
+    def __init__(self, index: KeywordIndex):
+        self.index = index
+
+    async def search(self, body: dict) -> list:
+        query = body.get("search")
+        if not query:
+            ## a vector-only request (AZURE_SEARCH_QUERY_TYPE=vector) has nothing to rank by keyword
+            return []
+
+        top = body.get("top", 5)
+        started = time.monotonic()
+        scores, rows = self.index.search(query, k=top * self.FILTER_OVERFETCH if body.get("filter") else top)
+        results = search_results(self.index.metadata, scores, rows, top, body.get("filter"))
+        LOCAL_SEARCH_SECONDS.observe(time.monotonic() - started)
+        return results
+
+    async def close(self):
+        self.index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local BM25 keyword index from document chunks")
+    parser.add_argument("--input", required=True, help="JSONL of chunks, e.g. written by scripts/data_preparation.py or scripts/embed_documents.py")
+    parser.add_argument("--output", required=True, help="Directory to write the index to")
+    parser.add_argument("--fields", default="title,content", help="Comma-separated fields to index")
+    args = parser.parse_args()
+
+    index = build_keyword_index(args.input, args.output, fields=args.fields.split(","))
+    print(f"Indexed {len(index)} chunks with {index.manifest['terms']} terms in {args.output}")
@@ -0,0 +1,286 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from backend import metrics
+from backend import serialization
+from backend.aoai.router import CircuitBreaker
+
+RETRIEVAL_SECONDS = metrics.histogram("retrieval_seconds", "Time to embed the question and search the index, cache hits included")
+RETRIEVAL_DOCUMENTS = metrics.histogram("retrieval_documents", "Passages injected into a chat request", buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+QUERY_EMBEDDING_CACHE = metrics.counter("retrieval_embedding_cache_total", "Query embedding lookups, by result", ("result",))
+SEARCH_RESULT_CACHE = metrics.counter("retrieval_search_cache_total", "Search result lookups, by result", ("result",))
+SEARCH_FALLBACKS = metrics.counter("retrieval_search_fallbacks_total", "Searches answered by the fallback index because the search service failed or was ejected")
+
+SEARCH_API_VERSION = "2023-11-01"
+QUERY_TYPES = ("simple", "semantic", "vector", "vectorSimpleHybrid", "vectorSemanticHybrid")
+
+## share of the best score a passage needs to be kept, by AZURE_SEARCH_STRICTNESS (1-5)
+STRICTNESS_SCORE_RATIO = {1: 0.0, 2: 0.2, 3: 0.4, 4: 0.6, 5: 0.8}
+
+## rank constant of reciprocal-rank fusion, the value Azure AI Search uses for hybrid queries
+RRF_K = 60
+
+
+def result_key(result: dict):
+    return result.get("id") or (result.get("filepath"), result.get("content"))
+
+
+def reciprocal_rank_fusion(result_lists, k: int = RRF_K, top: int = None) -> list:
+    """Merges ranked result lists, scoring each result by the sum of ``1 / (k + rank)`` over the lists that have it.
+
+    Only ranks are used, so lists scored on different scales (BM25 and
+    cosine similarity) fuse without normalization. The fused score replaces
+    ``@search.score``.
+    """
+    fused = {}
+    scores = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, 1):
+            key = result_key(result)
+            fused.setdefault(key, result)
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+    ranked = sorted(fused, key=scores.get, reverse=True)[:top]
+    return [{**fused[key], "@search.score": scores[key]} for key in ranked]
+
+
+class SearchClient():
+    """Minimal async client for the Azure AI Search documents search REST API."""
+
+    def __init__(self, endpoint: str, index: str, http_client, api_key: str = None, ad_token_provider=None, api_version: str = SEARCH_API_VERSION):
+        self.url = f"{endpoint.rstrip('/')}/indexes/{index}/docs/search"
+        self.http_client = http_client
+        self.api_key = api_key
+        self.ad_token_provider = ad_token_provider
+        self.api_version = api_version
+
+    async def search(self, body: dict) -> list:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["api-key"] = self.api_key
+        elif self.ad_token_provider is not None:
+            headers["Authorization"] = f"Bearer {await self.ad_token_provider()}"
+        response = await self.http_client.post(
+            self.url,
+            params={"api-version": self.api_version},
+            content=serialization.dumps_bytes(body),
+            headers=headers,
+        )
+        response.raise_for_status()
+        return serialization.loads(response.content)["value"]
+
+    async def close(self):
+        await self.http_client.aclose()
+
+
+class FallbackSearchClient():
+    """Sends searches to ``primary`` and to ``fallback`` when it fails.
+
+    After ``failure_threshold`` consecutive failures the primary is skipped
+    until a probe succeeds, so a degraded service does not add its timeout
+    to every request.
+    """
+
+    def __init__(self, primary, fallback, failure_threshold: int = 3, reset_timeout: float = 30):
+        self.primary = primary
+        self.fallback = fallback
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    async def search(self, body: dict) -> list:
+        if self.circuit_breaker.available():
+            self.circuit_breaker.begin()
+            try:
+                results = await self.primary.search(body)
+            except Exception as e:
+                self.circuit_breaker.record_failure()
+                logging.warning(f"Search service failed, using the fallback index: {e}")
+            else:
+                self.circuit_breaker.record_success()
+                return results
+        SEARCH_FALLBACKS.inc()
+        return await self.fallback.search(body)
+
+    async def close(self):
+        await self.primary.close()
+        await self.fallback.close()
+
+
+class HybridSearchClient():
+    """Sends each search to all ``clients`` concurrently and fuses their results with reciprocal-rank fusion.
+
+    Used to combine the local keyword and vector indexes: each client ranks
+    by the part of the request it understands, the ``search`` text or the
+    ``vectorQueries``.
+    """
+
+    def __init__(self, clients: list, k: int = RRF_K):
+        self.clients = clients
+        self.k = k
+
+    async def search(self, body: dict) -> list:
+        result_lists = await asyncio.gather(*(client.search(body) for client in self.clients))
+        return reciprocal_rank_fusion(result_lists, self.k, body.get("top", 5))
+
+    async def close(self):
+        for client in self.clients:
+            await client.close()
+
+
+class RetrievalResult():
+    """Passages retrieved for a question, and how they are shown to the model and the client."""
+
+    def __init__(self, query: str, documents: list):
+        self.query = query
+        self.documents = documents
+
+    def prompt(self, in_domain: bool = True) -> str:
+        lines = ["Answer using the retrieved documents below. Cite the documents you use as [doc1], [doc2] and so on."]
+        if in_domain:
+            lines.append("If the documents do not contain the answer, reply that the requested information is not available in the retrieved data.")
+        if not self.documents:
+            lines.append("No documents were retrieved.")
+        for i, document in enumerate(self.documents, 1):
+            title = f" title: {document['title']}" if document.get("title") else ""
+            lines.append(f"[doc{i}]{title}\n{document['content']}")
+        return "\n\n".join(lines)
+
+    def tool_message(self) -> dict:
+        citations = [{
+            "content": document["content"],
+            "id": document.get("id"),
+            "title": document.get("title"),
+            "filepath": document.get("filepath"),
+            "url": document.get("url"),
+            "metadata": None,
+            "chunk_id": str(i),
+            "reindex_id": None,
+        } for i, document in enumerate(self.documents)]
+        return {"role": "tool", "content": serialization.dumps({"citations": citations, "intent": serialization.dumps([self.query])})}
+
+
+class Retriever():
+    """Embeds the question, searches the index and keeps the passages relevant enough to ground the answer.
+
+    Query embeddings are kept in an LRU cache, and search results for the
+    same query and filter are reused for ``result_cache_ttl`` seconds.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        embedding_client=None,
+        query_type: str = "simple",
+        top_k: int = 5,
+        strictness: int = 3,
+        content_columns: list = None,
+        title_column: str = None,
+        filename_column: str = None,
+        url_column: str = None,
+        vector_columns: list = None,
+        semantic_configuration: str = None,
+        embedding_cache_size: int = 1000,
+        result_cache_ttl: float = 60,
+        result_cache_size: int = 1000,
+    ):
+        if query_type not in QUERY_TYPES:
+            raise ValueError(f"Unknown AZURE_SEARCH_QUERY_TYPE '{query_type}', expected one of {', '.join(QUERY_TYPES)}")
+        if query_type.startswith("vector") and (embedding_client is None or not vector_columns):
+            raise ValueError(f"AZURE_SEARCH_QUERY_TYPE '{query_type}' needs AZURE_OPENAI_EMBEDDING_ENDPOINT and AZURE_SEARCH_VECTOR_COLUMNS")
+        if strictness not in STRICTNESS_SCORE_RATIO:
+            raise ValueError("AZURE_SEARCH_STRICTNESS must be between 1 and 5")
+        self.search_client = search_client
+        self.embedding_client = embedding_client
+        self.query_type = query_type
+        self.top_k = top_k
+        self.strictness = strictness
+        self.content_columns = content_columns or ["content"]
+        self.title_column = title_column
+        self.filename_column = filename_column
+        self.url_column = url_column
+        self.vector_columns = vector_columns or []
+        self.semantic_configuration = semantic_configuration
+        self.embedding_cache_size = embedding_cache_size
+        self.result_cache_ttl = result_cache_ttl
+        self.result_cache_size = result_cache_size
+        self._embeddings = OrderedDict()
+        self._results = OrderedDict()
+
+    async def embed_query(self, query: str) -> list:
+        embedding = self._embeddings.get(query)
+        if embedding is not None:
+            QUERY_EMBEDDING_CACHE.inc(result="hit")
+            self._embeddings.move_to_end(query)
+            return embedding
+
+        QUERY_EMBEDDING_CACHE.inc(result="miss")
+        embedding = await self.embedding_client.embed(query)
+        self._embeddings[query] = embedding
+        while len(self._embeddings) > self.embedding_cache_size:
+            self._embeddings.popitem(last=False)
+        return embedding
+
+    async def search_body(self, query: str, search_filter: str = None) -> dict:
+        body = {"top": self.top_k}
+        if self.query_type != "vector":
+            body["search"] = query
+        if self.query_type in ("semantic", "vectorSemanticHybrid"):
+            body["queryType"] = "semantic"
+            body["semanticConfiguration"] = self.semantic_configuration
+        if self.query_type.startswith("vector"):
+            body["vectorQueries"] = [{
+                "kind": "vector",
+                "vector": await self.embed_query(query),
+                "fields": ",".join(self.vector_columns),
+                "k": self.top_k,
+            }]
+        if search_filter:
+            body["filter"] = search_filter
+        return body
+
+    async def search(self, query: str, search_filter: str = None) -> list:
+        key = (query, search_filter)
+        entry = self._results.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            SEARCH_RESULT_CACHE.inc(result="hit")
+            self._results.move_to_end(key)
+            return entry[1]
+
+        SEARCH_RESULT_CACHE.inc(result="miss")
+        results = await self.search_client.search(await self.search_body(query, search_filter))
+        self._results[key] = (time.monotonic() + self.result_cache_ttl, results)
+        self._results.move_to_end(key)
+        while len(self._results) > self.result_cache_size:
+            self._results.popitem(last=False)
+        return results
+
+    def score(self, result: dict) -> float:
+        ## the semantic reranker score, when present, is the better relevance signal
+        score = result.get("@search.rerankerScore")
+        return score if score is not None else result.get("@search.score") or 0.0
+
+    def to_document(self, result: dict) -> dict:
+        return {
+            "id": result.get("id"),
+            "content": "\n".join(str(result[column]) for column in self.content_columns if result.get(column)),
+            "title": result.get(self.title_column) if self.title_column else None,
+            "filepath": result.get(self.filename_column) if self.filename_column else None,
+            "url": result.get(self.url_column) if self.url_column else None,
+        }
+
+    async def retrieve(self, query: str, search_filter: str = None) -> RetrievalResult:
+        started = time.monotonic()
+        results = await self.search(query, search_filter)
+
+        documents = []
+        if results:
+            threshold = max(self.score(result) for result in results) * STRICTNESS_SCORE_RATIO[self.strictness]
+            documents = [self.to_document(result) for result in results if self.score(result) >= threshold]
+            documents = [document for document in documents if document["content"]][:self.top_k]
+        logging.debug(f"Retrieved {len(documents)} of {len(results)} passages for the question")
+
+        RETRIEVAL_SECONDS.observe(time.monotonic() - started)
+        RETRIEVAL_DOCUMENTS.observe(len(documents))
+        return RetrievalResult(query, documents)
+
+    async def close(self):
+        await self.search_client.close()
@@ -0,0 +1,248 @@
+"""Local, memory-mapped vector index for retrieval without a search service.
+
+An index is a directory holding:
+
+- ``vectors.npy``: the unit-length float32 embeddings, one row per chunk,
+  opened with ``mmap_mode="r"`` so every worker shares the same pages;
+- ``metadata.jsonl`` and ``metadata_offsets.npy``: the chunk fields (content,
+  title, filepath, url, ...) one JSON object per row, read on demand;
+- ``index.json``: the manifest;
+- with IVF partitioning, ``centroids.npy`` and ``list_offsets.npy``: rows are
+  stored grouped by their nearest centroid so each list is a contiguous slice.
+
+Build one from the JSONL written by ``scripts/embed_documents.py`` with
+``python -m backend.search.vector_index --input embedded.jsonl --output index_dir``.
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from backend import metrics
+from backend.search.documents import MetadataStore, iter_chunks, log_skipped, search_results, write_metadata
+
+LOCAL_SEARCH_SECONDS = metrics.histogram("local_vector_search_seconds", "Time to search the local vector index")
+
+INDEX_VERSION = 1
+MANIFEST_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+CENTROIDS_FILE = "centroids.npy"
+LIST_OFFSETS_FILE = "list_offsets.npy"
+
+## rows scored per matrix product in flat search, bounds the temporary score matrix
+SEARCH_BLOCK_ROWS = 65536
+## sample per centroid used to train the IVF partitioning
+TRAINING_SAMPLE_PER_LIST = 64
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _top_k(scores, rows, k: int):
+    """Best ``k`` columns of each row of ``scores``, sorted by descending score."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(rows, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+def _assign(matrix, centroids):
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+        assignments[start:start + SEARCH_BLOCK_ROWS] = np.argmax(matrix[start:start + SEARCH_BLOCK_ROWS] @ centroids.T, axis=1)
+    return assignments
+
+
+def train_ivf(matrix, lists: int, iterations: int = 10, seed: int = 0):
+    """Spherical k-means over a sample of the rows; returns the unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    lists = min(lists, len(matrix))
+    sample = matrix[rng.choice(len(matrix), min(len(matrix), lists * TRAINING_SAMPLE_PER_LIST), replace=False)]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        ## sum each list's members in one pass over the sample sorted by list
+        counts = np.bincount(assignments, minlength=lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        centroids[filled] = np.add.reduceat(sample[np.argsort(assignments, kind="stable")], starts[filled], axis=0)
+        ## an empty list is reseeded from a random row
+        centroids[~filled] = sample[rng.integers(len(sample), size=int((~filled).sum()))]
+        centroids = _normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+def build_vector_index(source, path: str, vector_field: str = "contentVector", ivf_lists: int = 0, iterations: int = 10, seed: int = 0):
+    """Writes an index for ``source`` to the directory ``path`` and returns it loaded.
+
+    ``source`` is a ``ChunkingResult``, an iterable of ``Document`` chunks or
+    of dicts such as the lines of the JSONL written by ``embed_documents.py``,
+    or the path of that JSONL file. Chunks without an embedding are skipped.
+    """
+    vectors = []
+    metadata = []
+    skipped = 0
+    for document in iter_chunks(source):
+        vector = document.get(vector_field)
+        if vector is None:
+            skipped += 1
+            continue
+        vectors.append(np.asarray(vector, dtype=np.float32))
+        metadata.append({key: value for key, value in document.items() if key != vector_field})
+    if not vectors:
+        raise ValueError(f"No chunks with an embedding in '{vector_field}' to index")
+    log_skipped(skipped, f"without an embedding in '{vector_field}'")
+
+    matrix = _normalize(np.vstack(vectors)).astype(np.float32)
+    os.makedirs(path, exist_ok=True)
+    manifest = {"version": INDEX_VERSION, "count": len(matrix), "dimensions": matrix.shape[1], "ivf_lists": 0}
+
+    if ivf_lists:
+        centroids = train_ivf(matrix, ivf_lists, iterations, seed)
+        assignments = _assign(matrix, centroids)
+        order = np.argsort(assignments, kind="stable")
+        matrix = matrix[order]
+        metadata = [metadata[row] for row in order]
+        list_offsets = np.searchsorted(assignments[order], np.arange(len(centroids) + 1)).astype(np.int64)
+        np.save(os.path.join(path, CENTROIDS_FILE), centroids)
+        np.save(os.path.join(path, LIST_OFFSETS_FILE), list_offsets)
+        manifest["ivf_lists"] = len(centroids)
+
+    np.save(os.path.join(path, VECTORS_FILE), matrix)
+    write_metadata(path, metadata)
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+    return VectorIndex.load(path)
+
+
+class VectorIndex():
+    """Top-k cosine search over a memory-mapped embedding matrix.
+
+    Queries are searched in batches: flat search scores blocks of rows with
+    one matrix product per block, IVF search scores only the ``nprobe``
+    lists nearest to each query, batching the queries that probe a list.
+    """
+
+    def __init__(self, path: str, manifest: dict, vectors, metadata: MetadataStore, centroids=None, list_offsets=None):
+        self.path = path
+        self.manifest = manifest
+        self.vectors = vectors
+        self.metadata = metadata
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+
+    @classmethod
+    def load(cls, path: str):
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported vector index version {manifest.get('version')} in {path}")
+        centroids = list_offsets = None
+        if manifest["ivf_lists"]:
+            centroids = np.load(os.path.join(path, CENTROIDS_FILE))
+            list_offsets = np.load(os.path.join(path, LIST_OFFSETS_FILE))
+        return cls(
+            path,
+            manifest,
+            np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r"),
+            MetadataStore(path),
+            centroids,
+            list_offsets,
+        )
+
+    def __len__(self):
+        return self.manifest["count"]
+
+    @property
+    def dimensions(self) -> int:
+        return self.manifest["dimensions"]
+
+    def document(self, row: int) -> dict:
+        return self.metadata[row]
+
+    def search(self, queries, k: int = 5, nprobe: int = 8):
+        """Returns ``(scores, rows)``, each of shape ``(queries, k)``; missing results have row -1."""
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if queries.shape[1] != self.dimensions:
+            raise ValueError(f"Query has {queries.shape[1]} dimensions, the index has {self.dimensions}")
+        k = min(k, len(self))
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+
+        if self.centroids is None:
+            for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+                block = self.vectors[start:start + SEARCH_BLOCK_ROWS]
+                scores = queries @ block.T
+                rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+                best_scores, best_rows = _top_k(np.hstack([best_scores, scores]), np.hstack([best_rows, rows]), k)
+            return best_scores, best_rows
+
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        for list_id in np.unique(probes):
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if start == end:
+                continue
+            probing = np.flatnonzero((probes == list_id).any(axis=1))
+            scores = queries[probing] @ self.vectors[start:end].T
+            rows = np.broadcast_to(np.arange(start, end), scores.shape)
+            best_scores[probing], best_rows[probing] = _top_k(
+                np.hstack([best_scores[probing], scores]), np.hstack([best_rows[probing], rows]), k
+            )
+        return best_scores, best_rows
+
+    def close(self):
+        self.metadata.close()
+
+
+class LocalSearchClient():
+    """Serves ``Retriever`` search requests from a ``VectorIndex``.
+
+    Takes the same request body as the Azure AI Search client and answers in
+    the same shape, so it can stand in for the search service. Text-only
+    requests are embedded with ``embed``; group filters are applied to an
+    over-fetched candidate list.
+    """
+
+    ## candidates fetched per requested result when a filter has to be applied
+    FILTER_OVERFETCH = 10
+
+    def __init__(self, index: VectorIndex, embed=None, nprobe: int = 8):
+        self.index = index
+        self.embed = embed
+        self.nprobe = nprobe
+
+    async def search(self, body: dict) -> list:
+        vector_queries = body.get("vectorQueries")
+        if vector_queries:
+            vector = vector_queries[0]["vector"]
+        elif self.embed is not None and body.get("search"):
+            vector = await self.embed(body["search"])
+        else:
+            raise ValueError("The local vector index needs a query embedding")
+
+        top = body.get("top", 5)
+        started = time.monotonic()
+        scores, rows = self.index.search(vector, k=top * self.FILTER_OVERFETCH if body.get("filter") else top, nprobe=self.nprobe)
+        results = search_results(self.index.metadata, scores[0], rows[0], top, body.get("filter"))
+        LOCAL_SEARCH_SECONDS.observe(time.monotonic() - started)
+        return results
+
+    async def close(self):
+        self.index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local vector index from embedded chunks")
+    parser.add_argument("--input", required=True, help="JSONL written by scripts/embed_documents.py")
+    parser.add_argument("--output", required=True, help="Directory to write the index to")
+    parser.add_argument("--vector_field", default="contentVector")
+    parser.add_argument("--ivf_lists", type=int, default=0, help="Number of IVF partitions, 0 for exact search")
+    args = parser.parse_args()
+
+    index = build_vector_index(args.input, args.output, vector_field=args.vector_field, ivf_lists=args.ivf_lists)
+    print(f"Indexed {len(index)} chunks of {index.dimensions} dimensions in {args.output}")
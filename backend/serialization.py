@@ -0,0 +1,142 @@
+import os
+import json
+import uuid
+import datetime
+import dataclasses
+import logging
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## "auto" picks the fastest installed backend: orjson, then msgspec, then the standard library
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto").lower()
+
+
+def json_default(o):
+    """Converts the types the fast backends handle natively for the standard library encoder."""
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if numpy is not None and isinstance(o, (numpy.ndarray, numpy.generic)):
+        return o.tolist()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class StdlibSerializer():
+    name = "json"
+
+    def dumps_bytes(self, obj, sort_keys: bool = False) -> bytes:
+        return self.dumps(obj, sort_keys).encode("utf-8")
+
+    def dumps(self, obj, sort_keys: bool = False) -> str:
+        return json.dumps(obj, default=json_default, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonSerializer():
+    name = "orjson"
+
+    def __init__(self):
+        self._options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps_bytes(self, obj, sort_keys: bool = False) -> bytes:
+        options = self._options | orjson.OPT_SORT_KEYS if sort_keys else self._options
+        return orjson.dumps(obj, default=json_default, option=options)
+
+    def dumps(self, obj, sort_keys: bool = False) -> str:
+        return self.dumps_bytes(obj, sort_keys).decode("utf-8")
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgspecSerializer():
+    name = "msgspec"
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder(enc_hook=json_default)
+        self._sorted_encoder = msgspec.json.Encoder(enc_hook=json_default, order="sorted")
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps_bytes(self, obj, sort_keys: bool = False) -> bytes:
+        return (self._sorted_encoder if sort_keys else self._encoder).encode(obj)
+
+    def dumps(self, obj, sort_keys: bool = False) -> str:
+        return self.dumps_bytes(obj, sort_keys).decode("utf-8")
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+
+SERIALIZERS = {
+    "orjson": (OrjsonSerializer, lambda: orjson is not None),
+    "msgspec": (MsgspecSerializer, lambda: msgspec is not None),
+    "json": (StdlibSerializer, lambda: True),
+}
+
+
+def create_serializer(backend: str = "auto"):
+    """Returns a serializer for ``backend``, falling back to the standard library if it is not installed."""
+    if backend == "auto":
+        for name, (serializer_class, available) in SERIALIZERS.items():
+            if available():
+                return serializer_class()
+    if backend not in SERIALIZERS:
+        raise ValueError(f"Unknown JSON_BACKEND '{backend}', expected one of auto, {', '.join(SERIALIZERS)}")
+    serializer_class, available = SERIALIZERS[backend]
+    if not available():
+        logging.warning(f"JSON_BACKEND '{backend}' is not installed, using the standard library json module")
+        return StdlibSerializer()
+    return serializer_class()
+
+
+serializer = create_serializer(JSON_BACKEND)
+
+
+def dumps(obj, sort_keys: bool = False) -> str:
+    """Compact, UTF-8 JSON text; identical output whichever backend is active."""
+    return serializer.dumps(obj, sort_keys)
+
+
+def dumps_bytes(obj, sort_keys: bool = False) -> bytes:
+    return serializer.dumps_bytes(obj, sort_keys)
+
+
+def loads(data):
+    return serializer.loads(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Routes ``jsonify`` and ``request.get_json`` through the active serializer.
+
+    Pretty-printed output (``indent``, used in debug mode) still goes through
+    the standard library.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs.get("indent") is not None:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, sort_keys=kwargs.get("sort_keys", False))
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
@@ -0,0 +1,202 @@
+import logging
+from azure.core import MatchConditions
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos import exceptions
+from azure.cosmos.partition_key import NonePartitionKeyValue
+from backend import cosmos_metrics
+
+## Cosmos DB accepts at most 10 operations in a single patch request
+PATCH_OPERATION_LIMIT = 10
+PROTECTED_FIELDS = ('id', 'userId')
+PARTITION_KEY_PATH = '/userId'
+
+
+def _patch_path(field: str) -> str:
+    ## escape the field name as a JSON pointer segment
+    return '/' + field.replace('~', '~0').replace('/', '~1')
+
+
+@cosmos_metrics.instrument("userdetails")
+class CosmosUserDetailsClient():
+    """User profiles stored one document per user with ``id == userId``, partitioned on ``/userId``.
+
+    Every lookup is a point read and every update is a partial patch, so no
+    call needs a query or a read-modify-write round trip. A container
+    partitioned on another path still works: ``ensure`` notices, and profiles
+    are then found with a cross-partition query before being read or patched.
+    """
+
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, log_operations: bool = False):
+        self.cosmosdb_endpoint = cosmosdb_endpoint
+        self.credential = credential
+        self.database_name = database_name
+        self.container_name = container_name
+        self.log_operations = log_operations
+        ## the container's partition key path, checked by ensure()
+        self.partition_key_path = PARTITION_KEY_PATH
+        try:
+            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential, raw_response_hook=cosmos_metrics.response_hook("userdetails"))
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 401:
+                raise ValueError("Invalid credentials") from e
+            else:
+                raise ValueError("Invalid CosmosDB endpoint") from e
+
+        self.database_client = self.cosmosdb_client.get_database_client(database_name)
+        self.container_client = self.database_client.get_container_client(container_name)
+
+    async def ensure(self):
+        try:
+            await self.database_client.read()
+        except:
+            return False, f"CosmosDB database {self.database_name} on account {self.cosmosdb_endpoint} not found"
+
+        try:
+            container_properties = await self.container_client.read()
+        except:
+            return False, f"CosmosDB container {self.container_name} not found"
+
+        ## point reads and patches pass the user id as the partition key, which only finds documents partitioned on it
+        partition_key_paths = container_properties.get('partitionKey', {}).get('paths') or []
+        if len(partition_key_paths) != 1:
+            return False, f"CosmosDB container {self.container_name} must be partitioned on {PARTITION_KEY_PATH}, not {partition_key_paths}"
+        self.partition_key_path = partition_key_paths[0]
+        if self.partition_key_path != PARTITION_KEY_PATH:
+            logging.warning(
+                f"CosmosDB container {self.container_name} is partitioned on {self.partition_key_path}, so user details are looked up "
+                f"with cross-partition queries; recreate it partitioned on {PARTITION_KEY_PATH} for point reads"
+            )
+
+        return True, "CosmosDB client initialized successfully"
+
+    async def close(self):
+        await self.cosmosdb_client.close()
+        if hasattr(self.credential, 'close'):
+            await self.credential.close()
+
+    def _partition_key(self, document: dict):
+        value = document
+        for part in self.partition_key_path.strip('/').split('/'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return NonePartitionKeyValue if value is None else value
+
+    async def _find_user_details(self, user_id):
+        ## the profile may be in any partition of a container not partitioned on /userId
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.userId = @userId"
+        async for item in self.container_client.query_items(query=query, parameters=parameters, enable_cross_partition_query=True):
+            return item
+        return None
+
+    async def _locate(self, user_id):
+        """The id and partition key of the user's profile."""
+        if self.partition_key_path == PARTITION_KEY_PATH:
+            return user_id, user_id
+        user_profile = await self._find_user_details(user_id)
+        if user_profile is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="User details not found")
+        return user_profile['id'], self._partition_key(user_profile)
+
+    async def get_user_details(self, user_id):
+        if self.partition_key_path != PARTITION_KEY_PATH:
+            return await self._find_user_details(user_id)
+        try:
+            return await self.container_client.read_item(item=user_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return await self._migrate_legacy_user_details(user_id)
+
+    async def _migrate_legacy_user_details(self, user_id):
+        ## profiles created before point reads have a random id; move them to id == userId once
+        if self.partition_key_path != PARTITION_KEY_PATH:
+            ## found by the cross-partition query whatever their id
+            return None
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.userId = @userId"
+        legacy_profile = None
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            legacy_profile = item
+            break
+
+        if not legacy_profile:
+            return None
+
+        user_profile = {k: v for k, v in legacy_profile.items() if not k.startswith('_')}
+        user_profile['id'] = user_id
+        try:
+            created = await self.container_client.create_item(user_profile)
+        except exceptions.CosmosResourceExistsError:
+            return await self.container_client.read_item(item=user_id, partition_key=user_id)
+
+        await self.container_client.delete_item(item=legacy_profile['id'], partition_key=user_id)
+        return created
+
+    async def get_or_create_user_details(self, user_id):
+        """Returns ``(profile, created)``."""
+        user_profile = await self.get_user_details(user_id)
+        if user_profile:
+            return user_profile, False
+
+        new_user_profile = {
+            'id': user_id,
+            'userId': user_id,
+            'answers': []
+        }
+        try:
+            return await self.container_client.create_item(new_user_profile), True
+        except exceptions.CosmosResourceExistsError:
+            return await self.get_user_details(user_id), False
+
+    async def update_user_details(self, user_id, data: dict, etag: str = None):
+        """Sets the top-level fields in ``data`` on the user's profile, creating it if needed.
+
+        When ``etag`` is given the update only applies if the profile has not
+        changed since that version, otherwise ``CosmosAccessConditionFailedError``
+        is raised.
+        """
+        fields = {k: v for k, v in data.items() if k not in PROTECTED_FIELDS and not k.startswith('_')}
+        if not fields:
+            user_profile, _ = await self.get_or_create_user_details(user_id)
+            return user_profile
+
+        operations = [{'op': 'set', 'path': _patch_path(key), 'value': value} for key, value in fields.items()]
+        try:
+            return await self._patch_user_details(user_id, operations, etag)
+        except exceptions.CosmosResourceNotFoundError:
+            if etag:
+                raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="User details no longer exist")
+
+        if await self._migrate_legacy_user_details(user_id):
+            return await self._patch_user_details(user_id, operations)
+
+        try:
+            return await self.container_client.create_item({'id': user_id, 'userId': user_id, **fields})
+        except exceptions.CosmosResourceExistsError:
+            return await self._patch_user_details(user_id, operations)
+
+    async def _patch_user_details(self, user_id, operations, etag=None):
+        item, partition_key = await self._locate(user_id)
+        user_profile = None
+        for start in range(0, len(operations), PATCH_OPERATION_LIMIT):
+            ## chain the etag across requests so a large update can't interleave with another writer
+            if start > 0:
+                etag = user_profile['_etag']
+            options = {}
+            if etag:
+                options = {'etag': etag, 'match_condition': MatchConditions.IfNotModified}
+            user_profile = await self.container_client.patch_item(
+                item=item,
+                partition_key=partition_key,
+                patch_operations=operations[start:start + PATCH_OPERATION_LIMIT],
+                **options
+            )
+        return user_profile
@@ -1,18 +1,14 @@
 import os
 import json
+import asyncio
 import logging
-import requests
 import dataclasses
+from backend import serialization
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
     logging.basicConfig(level=logging.DEBUG)
 
-AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
-    "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
-)
-
-
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if dataclasses.is_dataclass(o):
@@ -23,54 +19,122 @@ class JSONEncoder(json.JSONEncoder):
 async def format_as_ndjson(r):
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            yield serialization.dumps(event) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
 
 
-def parse_multi_columns(columns: str) -> list:
-    if "|" in columns:
-        return columns.split("|")
-    else:
-        return columns.split(",")
+def _compact_dumps(obj):
+    return serialization.dumps(obj) + "\n"
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+async def format_as_delta_ndjson(r, flush_interval: float = 0.03, flush_bytes: int = 64):
+    """Compact alternative to ``format_as_ndjson`` for the frames of a chat stream.
+
+    Emits one header line ``{"h": {id, model, created, object, history_metadata}}``
+    then only what changes: ``{"d": text}`` for assistant content, coalesced
+    until ``flush_bytes`` bytes are buffered or ``flush_interval`` seconds have
+    passed, ``{"tool": content}`` for tool messages and ``{"m": history_metadata}``
+    when the metadata changes mid-stream. Errors are reported as in the
+    default format.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    async def pump():
+        ## read upstream in its own task so buffered content can be flushed while it stalls
+        try:
+            async for event in r:
+                queue.put_nowait(event)
+            queue.put_nowait(done)
+        except Exception as error:
+            queue.put_nowait(error)
+
+    buffer = []
+    buffered_bytes = 0
+    flush_timer = None
+    flush_generation = 0
+    header_sent = False
+    history_metadata = None
 
-    headers = {"Authorization": "bearer " + userToken}
+    def flush():
+        nonlocal buffered_bytes, flush_timer, flush_generation
+        text = "".join(buffer)
+        buffer.clear()
+        buffered_bytes = 0
+        if flush_timer is not None:
+            flush_timer.cancel()
+            flush_timer = None
+        flush_generation += 1
+        return _compact_dumps({"d": text})
+
+    pump_task = asyncio.ensure_future(pump())
     try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
+        while True:
+            event = queue.get_nowait() if not queue.empty() else await queue.get()
 
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
+            if isinstance(event, tuple):
+                ## coalescing window elapsed; ignore timers from windows already flushed
+                if event[1] == flush_generation and buffer:
+                    yield flush()
+                continue
+            if event is done:
+                break
+            if isinstance(event, Exception):
+                raise event
+            if not event or not event.get("choices"):
+                continue
 
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+            if not header_sent:
+                history_metadata = dict(event.get("history_metadata") or {})
+                yield _compact_dumps({"h": {
+                    "id": event.get("id"),
+                    "model": event.get("model"),
+                    "created": event.get("created"),
+                    "object": event.get("object"),
+                    "history_metadata": history_metadata,
+                }})
+                header_sent = True
+            elif event.get("history_metadata") is not None and event["history_metadata"] != history_metadata:
+                if buffer:
+                    yield flush()
+                history_metadata = dict(event["history_metadata"])
+                yield _compact_dumps({"m": history_metadata})
+
+            for message in event["choices"][0]["messages"]:
+                if message["role"] == "tool":
+                    if buffer:
+                        yield flush()
+                    yield _compact_dumps({"tool": message["content"]})
+                elif message.get("content"):
+                    buffer.append(message["content"])
+                    buffered_bytes += len(message["content"].encode("utf-8"))
+                    if flush_timer is None:
+                        flush_timer = loop.call_later(flush_interval, queue.put_nowait, (flush, flush_generation))
 
+            if buffered_bytes >= flush_bytes:
+                yield flush()
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+        if buffer:
+            yield flush()
+    except Exception as error:
+        logging.exception("Exception while generating response stream: %s", error)
+        if buffer:
+            yield flush()
+        yield json.dumps({"error": str(error)})
+    finally:
+        pump_task.cancel()
+        if flush_timer is not None:
+            flush_timer.cancel()
 
-    # Construct filter string
-    if not userGroups:
-        logging.debug("No user groups found")
 
-    group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+def parse_multi_columns(columns: str) -> list:
+    if "|" in columns:
+        return columns.split("|")
+    else:
+        return columns.split(",")
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, message_uuid=None):
@@ -90,7 +154,7 @@ def format_non_streaming_response(chatCompletion, history_metadata, message_uuid
                 response_obj["choices"][0]["messages"].append(
                     {
                         "role": "tool",
-                        "content": json.dumps(message.context),
+                        "content": serialization.dumps(message.context),
                     }
                 )
             response_obj["choices"][0]["messages"].append(
@@ -118,7 +182,7 @@ def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=N
         delta = chatCompletionChunk.choices[0].delta
         if delta:
             if hasattr(delta, "context"):
-                messageObj = {"role": "tool", "content": json.dumps(delta.context)}
+                messageObj = {"role": "tool", "content": serialization.dumps(delta.context)}
                 response_obj["choices"][0]["messages"].append(messageObj)
                 return response_obj
             if delta.role == "assistant" and hasattr(delta, "context"):
@@ -0,0 +1,103 @@
+"""Request charge and latency of chat history reads, appends and deletes in the items and document layouts.
+
+Needs a Cosmos DB account, normally the local emulator (see
+benchmarks/history_list.py). Run from the repository root:
+
+    python -m benchmarks.history_layout --conversations 20 --messages 60
+
+For each layout, conversations of ``--messages`` messages are seeded for one
+user, in question and answer turns like the app writes them. Then, per
+conversation, the benchmark times and charges:
+
+- read: all messages of the conversation, with the message cache off,
+- append: one more question and answer, stored together,
+- delete: clearing the conversation's messages and deleting it.
+
+RU are summed over every request an operation makes.
+"""
+import time
+import asyncio
+import argparse
+import numpy as np
+from benchmarks.history_list import add_connection_arguments, connect
+from backend.history.conversationdocuments import DocumentConversationClient
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+LAYOUTS = (("items", CosmosConversationClient), ("document", DocumentConversationClient))
+
+
+class ChargeMeter():
+    """Adds up the request charge of every response, as an azure-core ``raw_response_hook``."""
+
+    def __init__(self):
+        self.charge = 0.0
+
+    def __call__(self, response):
+        self.charge += float(response.http_response.headers.get("x-ms-request-charge", 0))
+
+    def take(self) -> float:
+        charge, self.charge = self.charge, 0.0
+        return charge
+
+
+def turn(i, message_bytes):
+    return [
+        {"role": "user", "content": f"Question {i} " + "q" * (message_bytes // 4)},
+        {"role": "assistant", "content": f"Answer {i} " + "a" * message_bytes},
+    ]
+
+
+async def measure(meter, operation, samples):
+    meter.take()
+    started = time.perf_counter()
+    await operation
+    samples.append((time.perf_counter() - started, meter.take()))
+
+
+def report(layout, name, samples):
+    seconds = [sample[0] for sample in samples]
+    charges = [sample[1] for sample in samples]
+    print(f"{layout:<10} {name:<8} {np.mean(charges):>8.2f} {1000 * np.percentile(seconds, 50):>8.1f} {1000 * np.percentile(seconds, 95):>8.1f}")
+
+
+async def run(args):
+    print(f"{'layout':<10} {'op':<8} {'RU':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for layout, client_class in LAYOUTS:
+        meter = ChargeMeter()
+        client = await connect(args, client_class, raw_response_hook=meter)
+        user_id = f"{args.user_id}-{layout}"
+        try:
+            await client.delete_all_conversations(user_id)
+            conversation_ids = []
+            for _ in range(args.conversations):
+                conversation = await client.create_conversation(user_id, "Benchmark")
+                for i in range(args.messages // 2):
+                    await client.create_messages(conversation["id"], user_id, turn(i, args.message_bytes))
+                conversation_ids.append(conversation["id"])
+
+            reads, appends, deletes = [], [], []
+            for conversation_id in conversation_ids:
+                await measure(meter, client.get_messages(user_id, conversation_id), reads)
+            for conversation_id in conversation_ids:
+                await measure(meter, client.create_messages(conversation_id, user_id, turn(args.messages, args.message_bytes)), appends)
+
+            async def delete(conversation_id):
+                await client.delete_messages(conversation_id, user_id)
+                await client.delete_conversation(user_id, conversation_id)
+
+            for conversation_id in conversation_ids:
+                await measure(meter, delete(conversation_id), deletes)
+            for name, samples in (("read", reads), ("append", appends), ("delete", deletes)):
+                report(layout, name, samples)
+        finally:
+            await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_connection_arguments(parser)
+    parser.add_argument("--user_id", default="benchmark-layout")
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=60, help="Messages per conversation before measuring")
+    parser.add_argument("--message_bytes", type=int, default=800, help="Approximate size of an answer; questions are a quarter of it")
+    asyncio.run(run(parser.parse_args()))
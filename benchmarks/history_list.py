@@ -0,0 +1,117 @@
+"""Request charge and latency of paging the conversation list, OFFSET/LIMIT against continuation tokens.
+
+Needs a Cosmos DB account to seed, normally the local emulator
+(https://learn.microsoft.com/azure/cosmos-db/emulator). Run from the
+repository root:
+
+    python -m benchmarks.history_list --conversations 5000 --page_size 25
+
+The conversations of one user are seeded into a container partitioned on
+``/userId`` (created if missing, reused when already seeded). Then every page
+of the list is read twice: once with ``OFFSET n LIMIT m`` queries, the way the
+sidebar used to page, and once by following continuation tokens, the way
+``/history/list`` does. The report gives RU and latency at a few page depths.
+"""
+import time
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from azure.cosmos import PartitionKey
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+## the emulator's fixed, publicly documented account key
+EMULATOR_ENDPOINT = "https://localhost:8081/"
+EMULATOR_KEY = "C2y6yDjf5/R+ob0N8A7Cgv30VRDJIWEHLM+4QDU5DE2nQ9nDuVTqobD4b8mGGyPMbIZnqyMsEcaGQy67XIw/Jw=="
+
+
+def add_connection_arguments(parser):
+    parser.add_argument("--endpoint", default=EMULATOR_ENDPOINT)
+    parser.add_argument("--key", default=EMULATOR_KEY)
+    parser.add_argument("--database", default="benchmarks")
+    parser.add_argument("--container", default="conversations")
+    parser.add_argument("--verify_tls", action="store_true", help="Verify the TLS certificate, off for the emulator's self-signed one")
+
+
+async def connect(args, client_class=CosmosConversationClient, **client_kwargs) -> CosmosConversationClient:
+    """A conversation client on the benchmark container, creating it if needed."""
+    client = client_class(args.endpoint, args.key, args.database, args.container, connection_verify=args.verify_tls, **client_kwargs)
+    try:
+        client.database_client = await client.cosmosdb_client.create_database_if_not_exists(args.database)
+        client.container_client = await client.database_client.create_container_if_not_exists(args.container, partition_key=PartitionKey(path="/userId"))
+    except Exception:
+        await client.close()
+        raise
+    return client
+
+
+def request_charge(client: CosmosConversationClient) -> float:
+    return float(client.container_client.client_connection.last_response_headers.get("x-ms-request-charge", 0))
+
+
+async def seed_conversations(client: CosmosConversationClient, user_id: str, count: int, concurrency: int = 50):
+    existing, _ = await client.get_conversations_page(user_id, limit=1)
+    if existing and existing[0]["id"] == f"{user_id}-{count - 1:06d}":
+        return
+    semaphore = asyncio.Semaphore(concurrency)
+    started = datetime(2024, 1, 1)
+
+    async def upsert(i):
+        timestamp = (started + timedelta(minutes=i)).isoformat()
+        async with semaphore:
+            await client.container_client.upsert_item({
+                "id": f"{user_id}-{i:06d}",
+                "type": "conversation",
+                "userId": user_id,
+                "createdAt": timestamp,
+                "updatedAt": timestamp,
+                "title": f"Conversation {i} " + "x" * 40,
+            })
+
+    await asyncio.gather(*(upsert(i) for i in range(count)))
+
+
+async def offset_pages(client, user_id, page_size, pages):
+    query = "SELECT * FROM c WHERE c.userId = @userId AND c.type='conversation' ORDER BY c.updatedAt DESC OFFSET @offset LIMIT @limit"
+    for page in range(pages):
+        started = time.perf_counter()
+        parameters = [{"name": "@userId", "value": user_id}, {"name": "@offset", "value": page * page_size}, {"name": "@limit", "value": page_size}]
+        [item async for item in client.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+        yield page, time.perf_counter() - started, request_charge(client)
+
+
+async def continuation_pages(client, user_id, page_size, pages):
+    continuation_token = None
+    for page in range(pages):
+        started = time.perf_counter()
+        _, continuation_token = await client.get_conversations_page(user_id, page_size, continuation_token)
+        yield page, time.perf_counter() - started, request_charge(client)
+        if continuation_token is None:
+            return
+
+
+async def run(args):
+    client = await connect(args)
+    try:
+        await seed_conversations(client, args.user_id, args.conversations)
+        pages = args.conversations // args.page_size
+        report_pages = {0, pages // 10, pages // 2, pages - 1}
+        print(f"{'mode':<14} {'page':>6} {'RU':>8} {'ms':>8}")
+        for mode, walk in (("offset", offset_pages), ("continuation", continuation_pages)):
+            total_charge = total_seconds = 0.0
+            async for page, seconds, charge in walk(client, args.user_id, args.page_size, pages):
+                total_charge += charge
+                total_seconds += seconds
+                if page in report_pages:
+                    print(f"{mode:<14} {page:>6} {charge:>8.2f} {1000 * seconds:>8.1f}")
+            print(f"{mode:<14} {'total':>6} {total_charge:>8.1f} {1000 * total_seconds:>8.1f}")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_connection_arguments(parser)
+    parser.add_argument("--user_id", default="benchmark-user")
+    parser.add_argument("--conversations", type=int, default=5000)
+    parser.add_argument("--page_size", type=int, default=25)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,88 @@
+"""Microbenchmarks for each JSON encoding call site, per serializer backend.
+
+Run from the repository root:
+
+    python -m benchmarks.json_serialization --number 2000
+
+"baseline" is the encoding each call site used before ``backend.serialization``
+(``json.dumps`` with the dataclass-aware ``JSONEncoder`` or defaults). Backends
+that are not installed are skipped.
+"""
+import json
+import random
+import timeit
+import argparse
+from types import SimpleNamespace
+from backend import serialization
+from backend.utils import JSONEncoder, format_non_streaming_response, format_stream_response
+
+HISTORY_METADATA = {
+    "conversation_id": "6f1c2d3e-4b5a-4c7d-8e9f-0a1b2c3d4e5f",
+    "title": "Quarterly sales summary",
+    "date": "2024-02-01T12:00:00.000000",
+}
+
+
+def stream_frame():
+    delta = SimpleNamespace(role="assistant", content=" token")
+    chunk = SimpleNamespace(id="chatcmpl-8mock", model="gpt-35-turbo", created=1700000000, object="chat.completion.chunk", choices=[SimpleNamespace(delta=delta)])
+    return format_stream_response(chunk, HISTORY_METADATA)
+
+
+def non_streaming_response():
+    message = SimpleNamespace(role="assistant", content="word " * 400)
+    completion = SimpleNamespace(id="chatcmpl-8mock", model="gpt-35-turbo", created=1700000000, object="chat.completion", choices=[SimpleNamespace(message=message)])
+    return format_non_streaming_response(completion, HISTORY_METADATA)
+
+
+def conversation_list():
+    return [
+        {"id": f"conversation-{i}", "type": "conversation", "userId": "user-1", "title": f"Conversation {i}",
+         "createdAt": "2024-02-01T12:00:00.000000", "updatedAt": "2024-02-01T12:30:00.000000"}
+        for i in range(25)
+    ]
+
+
+def embedded_document(dimensions):
+    rng = random.Random(0)
+    return {
+        "id": "0",
+        "content": "lorem ipsum " * 80,
+        "title": "Document title",
+        "filepath": "docs/file.md",
+        "url": "https://example.com/docs/file.md",
+        "contentVector": [rng.uniform(-1, 1) for _ in range(dimensions)],
+    }
+
+
+def baseline_dumps(obj):
+    return json.dumps(obj, cls=JSONEncoder)
+
+
+def main(args):
+    call_sites = {
+        "format_as_ndjson frame": stream_frame(),
+        "format_non_streaming_response": non_streaming_response(),
+        "jsonify /history/list": conversation_list(),
+        "embed_documents line": embedded_document(args.dimensions),
+    }
+    encoders = {"baseline": baseline_dumps}
+    for name, (serializer_class, available) in serialization.SERIALIZERS.items():
+        if available():
+            encoders[name] = serializer_class().dumps
+
+    print(f"{'call site':<32}" + "".join(f"{name + ' us':>14}" for name in encoders))
+    for site, obj in call_sites.items():
+        timings = []
+        for encode in encoders.values():
+            seconds = min(timeit.repeat(lambda: encode(obj), number=args.number, repeat=args.repeat))
+            timings.append(seconds / args.number * 1e6)
+        print(f"{site:<32}" + "".join(f"{t:>14.2f}" for t in timings))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    main(parser.parse_args())
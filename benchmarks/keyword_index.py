@@ -0,0 +1,93 @@
+"""Per-query latency of offline retrieval from the local keyword and vector indexes.
+
+Run from the repository root:
+
+    python -m benchmarks.keyword_index --sizes 10000 100000 --dimensions 384
+
+For each corpus size, synthetic chunks are built with Zipf-distributed words
+and random embeddings. The benchmark then builds a BM25 keyword index and a
+flat vector index in temporary directories. It times loading them and
+answering queries one at a time through the search clients the app uses:
+BM25 only, vector only, and both fused by reciprocal rank.
+"""
+import time
+import asyncio
+import argparse
+import tempfile
+import numpy as np
+from backend.search.keyword_index import KeywordIndex, KeywordSearchClient, build_keyword_index
+from backend.search.retrieval import HybridSearchClient
+from backend.search.vector_index import LocalSearchClient, VectorIndex, build_vector_index
+
+
+def words(count, rng):
+    return [f"w{rank}" for rank in rng.zipf(1.3, size=count) % 50000]
+
+
+def corpus(count, dimensions, chunk_words, rng):
+    for i in range(count):
+        yield {
+            "id": str(i),
+            "title": " ".join(words(4, rng)),
+            "content": " ".join(words(chunk_words, rng)),
+            "contentVector": rng.normal(size=dimensions).astype(np.float32),
+        }
+
+
+def percentile(samples, q):
+    return 1000 * float(np.percentile(samples, q))
+
+
+async def latencies(client, bodies):
+    samples = []
+    for body in bodies:
+        started = time.perf_counter()
+        await client.search(body)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def run(args):
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>10} {'mode':<8} {'build s':>8} {'load ms':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in args.sizes:
+        bodies = [{
+            "search": " ".join(words(args.query_words, rng)),
+            "vectorQueries": [{"kind": "vector", "vector": rng.normal(size=args.dimensions).tolist(), "k": args.k}],
+            "top": args.k,
+        } for _ in range(args.queries)]
+        with tempfile.TemporaryDirectory() as keyword_dir, tempfile.TemporaryDirectory() as vector_dir:
+            started = time.perf_counter()
+            build_keyword_index(corpus(size, args.dimensions, args.chunk_words, np.random.default_rng(size)), keyword_dir).close()
+            keyword_build = time.perf_counter() - started
+            started = time.perf_counter()
+            build_vector_index(corpus(size, args.dimensions, args.chunk_words, np.random.default_rng(size)), vector_dir).close()
+            vector_build = time.perf_counter() - started
+
+            started = time.perf_counter()
+            keyword = KeywordSearchClient(KeywordIndex.load(keyword_dir))
+            keyword_load = time.perf_counter() - started
+            started = time.perf_counter()
+            vector = LocalSearchClient(VectorIndex.load(vector_dir))
+            vector_load = time.perf_counter() - started
+
+            for mode, client, build, load in (
+                ("bm25", keyword, keyword_build, keyword_load),
+                ("vector", vector, vector_build, vector_load),
+                ("hybrid", HybridSearchClient([keyword, vector]), keyword_build + vector_build, keyword_load + vector_load),
+            ):
+                samples = await latencies(client, bodies)
+                print(f"{size:>10} {mode:<8} {build:>8.1f} {1000 * load:>8.1f} {percentile(samples, 50):>8.2f} {percentile(samples, 95):>8.2f}")
+            await keyword.close()
+            await vector.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--chunk_words", type=int, default=200)
+    parser.add_argument("--query_words", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    asyncio.run(run(parser.parse_args()))
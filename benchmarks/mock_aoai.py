@@ -0,0 +1,132 @@
+"""A minimal local stand-in for the Azure OpenAI chat completions endpoint.
+
+Serves ``POST /openai/deployments/<deployment>/chat/completions`` in both
+streaming (SSE) and non-streaming form so the app and benchmarks can run
+without a real deployment. Latency, token count and failures are tunable;
+``status`` can be changed while the server runs and ``disconnect_before_tokens``
+drops streams after the headers, before any content.
+``/embeddings`` returns hashed bag-of-words vectors, so texts sharing words
+are similar.
+"""
+import json
+import time
+import zlib
+import asyncio
+import argparse
+from aiohttp import web
+
+
+class MockAzureOpenAI():
+
+    def __init__(self, first_token_delay: float = 0.05, inter_token_delay: float = 0.005, tokens: int = 20, token_text: str = "tok ", status: int = 200, headers: dict = None, embedding_dimensions: int = 64, disconnect_before_tokens: bool = False):
+        self.first_token_delay = first_token_delay
+        self.inter_token_delay = inter_token_delay
+        self.tokens = tokens
+        self.token_text = token_text
+        self.status = status
+        self.headers = headers or {}
+        self.embedding_dimensions = embedding_dimensions
+        self.disconnect_before_tokens = disconnect_before_tokens
+        self.requests = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/openai/deployments/{deployment}/chat/completions", self.chat_completions)
+        app.router.add_post("/openai/deployments/{deployment}/embeddings", self.embeddings)
+        app.router.add_route("*", "/{tail:.*}", self.not_found)
+        return app
+
+    async def not_found(self, request):
+        return web.Response(status=404)
+
+    def _chunk(self, deployment, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def embed(self, text: str) -> list:
+        vector = [0.0] * self.embedding_dimensions
+        for word in text.lower().split():
+            vector[zlib.crc32(word.strip(".,?!").encode()) % self.embedding_dimensions] += 1.0
+        return vector
+
+    async def embeddings(self, request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({
+            "object": "list",
+            "model": request.match_info["deployment"],
+            "data": [{"object": "embedding", "index": i, "embedding": self.embed(text)} for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        })
+
+    async def chat_completions(self, request):
+        self.requests += 1
+        deployment = request.match_info["deployment"]
+        body = await request.json()
+
+        if self.status != 200:
+            return web.json_response(
+                {"error": {"code": str(self.status), "message": "mock failure"}},
+                status=self.status,
+                headers=self.headers,
+            )
+
+        await asyncio.sleep(self.first_token_delay)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.inter_token_delay * self.tokens)
+            return web.json_response({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": self.token_text * self.tokens},
+                }],
+                "usage": {"prompt_tokens": 1, "completion_tokens": self.tokens, "total_tokens": self.tokens + 1},
+            }, headers=self.headers)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **self.headers})
+        await response.prepare(request)
+        await response.write(f"data: {json.dumps(self._chunk(deployment, {'role': 'assistant', 'content': ''}))}\n\n".encode())
+        if self.disconnect_before_tokens:
+            request.transport.close()
+            return response
+        for i in range(self.tokens):
+            if i:
+                await asyncio.sleep(self.inter_token_delay)
+            chunk = self._chunk(deployment, {"content": self.token_text})
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(f"data: {json.dumps(self._chunk(deployment, {}, 'stop'))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+async def start_mock_server(mock: MockAzureOpenAI, host: str = "127.0.0.1", port: int = 0):
+    """Starts ``mock`` on a local port and returns ``(runner, base_url)``."""
+    runner = web.AppRunner(mock.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--first_token_delay", type=float, default=0.05)
+    parser.add_argument("--inter_token_delay", type=float, default=0.005)
+    parser.add_argument("--tokens", type=int, default=20)
+    args = parser.parse_args()
+
+    mock = MockAzureOpenAI(args.first_token_delay, args.inter_token_delay, args.tokens)
+    web.run_app(mock.make_app(), port=args.port)
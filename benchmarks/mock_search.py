@@ -0,0 +1,108 @@
+"""A minimal local stand-in for the Azure AI Search documents search endpoint.
+
+Serves ``POST /indexes/<index>/docs/search`` over an in-memory list of
+documents. Text queries are scored by the number of query words a document
+contains; vector queries by cosine similarity against ``vector_field``,
+computed with ``embed`` (e.g. ``MockAzureOpenAI.embed``) so query and
+document vectors match. ``<column>/any(g:search.in(g, '...'))`` filters are
+honoured, and a semantic query adds a ``@search.rerankerScore``.
+"""
+import re
+import math
+import json
+import asyncio
+import argparse
+from aiohttp import web
+
+_GROUP_FILTER = re.compile(r"^(\w+)/any\(g:search\.in\(g, '([^']*)'\)\)$")
+
+
+class MockAzureSearch():
+
+    def __init__(self, documents: list, embed=None, vector_field: str = "contentVector", latency: float = 0.0):
+        self.documents = documents
+        self.embed = embed
+        self.vector_field = vector_field
+        self.latency = latency
+        self.status = 200
+        self.requests = 0
+        self.last_body = None
+        if embed is not None:
+            for document in documents:
+                document.setdefault(vector_field, embed(document.get("content", "")))
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/indexes/{index}/docs/search", self.search)
+        return app
+
+    @staticmethod
+    def _words(text: str) -> set:
+        return {word.strip(".,?!").lower() for word in text.split()}
+
+    @staticmethod
+    def _cosine(a, b) -> float:
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(x * x for x in b))
+        return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+    def _matches(self, document, search_filter) -> bool:
+        if not search_filter:
+            return True
+        match = _GROUP_FILTER.match(search_filter)
+        if not match:
+            raise ValueError(f"Unsupported filter '{search_filter}'")
+        column, values = match.groups()
+        allowed = {value.strip() for value in values.split(",") if value.strip()}
+        return bool(allowed & set(document.get(column, [])))
+
+    async def search(self, request):
+        self.requests += 1
+        body = await request.json()
+        self.last_body = body
+        if self.status != 200:
+            return web.json_response({"error": {"code": str(self.status), "message": "mock failure"}}, status=self.status)
+        await asyncio.sleep(self.latency)
+
+        query_words = self._words(body.get("search") or "")
+        vector_queries = body.get("vectorQueries") or []
+        results = []
+        for document in self.documents:
+            if not self._matches(document, body.get("filter")):
+                continue
+            score = float(len(query_words & self._words(document.get("content", ""))))
+            for vector_query in vector_queries:
+                score += self._cosine(vector_query["vector"], document[self.vector_field])
+            if score > 0:
+                result = {key: value for key, value in document.items() if key != self.vector_field}
+                result["@search.score"] = score
+                results.append(result)
+
+        results.sort(key=lambda result: result["@search.score"], reverse=True)
+        results = results[:body.get("top", 50)]
+        if body.get("queryType") == "semantic" and results:
+            best = results[0]["@search.score"]
+            for result in results:
+                result["@search.rerankerScore"] = 4 * result["@search.score"] / best
+        return web.json_response({"value": results})
+
+
+async def start_mock_search(mock: MockAzureSearch, host: str = "127.0.0.1", port: int = 0):
+    """Starts ``mock`` on a local port and returns ``(runner, base_url)``."""
+    runner = web.AppRunner(mock.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--documents", required=True, help="JSON lines file of documents to serve")
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with open(args.documents) as f:
+        documents = [json.loads(line) for line in f if line.strip()]
+    web.run_app(MockAzureSearch(documents, latency=args.latency).make_app(), port=args.port)
@@ -0,0 +1,79 @@
+"""Bytes on the wire and CPU per stream: default NDJSON frames vs the compact delta format.
+
+Run from the repository root:
+
+    python -m benchmarks.stream_format --streams 200 --tokens 300
+
+Frames are produced by ``format_stream_response`` from synthetic completion
+chunks, as ``stream_chat_request`` does, so the comparison covers only the
+serialization step. ``--inter_token_ms`` adds a delay between chunks to show
+the effect of the coalescing window; CPU time is measured with
+``time.process_time`` so the delay does not count against either format.
+"""
+import time
+import asyncio
+import argparse
+import statistics
+from types import SimpleNamespace
+from backend.utils import format_as_ndjson, format_as_delta_ndjson, format_stream_response
+
+HISTORY_METADATA = {
+    "conversation_id": "6f1c2d3e-4b5a-4c7d-8e9f-0a1b2c3d4e5f",
+    "title": "Quarterly sales summary",
+    "date": "2024-02-01T12:00:00.000000",
+}
+
+
+def completion_chunk(content):
+    delta = SimpleNamespace(role="assistant", content=content)
+    return SimpleNamespace(
+        id="chatcmpl-8mock",
+        model="gpt-35-turbo",
+        created=1700000000,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=delta)],
+    )
+
+
+async def frames(tokens, inter_token_delay):
+    for i in range(tokens):
+        if inter_token_delay:
+            await asyncio.sleep(inter_token_delay)
+        yield format_stream_response(completion_chunk(f" token{i % 10}"), HISTORY_METADATA)
+
+
+async def measure(formatter, streams, tokens, inter_token_delay):
+    sizes, cpu, lines = [], [], []
+    for _ in range(streams):
+        started = time.process_time()
+        size = count = 0
+        async for line in formatter(frames(tokens, inter_token_delay)):
+            size += len(line.encode("utf-8"))
+            count += 1
+        cpu.append(time.process_time() - started)
+        sizes.append(size)
+        lines.append(count)
+    return sizes, cpu, lines
+
+
+async def main(args):
+    inter_token_delay = args.inter_token_ms / 1000
+    formats = {
+        "default": format_as_ndjson,
+        "delta": lambda r: format_as_delta_ndjson(r, flush_interval=args.flush_interval_ms / 1000, flush_bytes=args.flush_bytes),
+    }
+
+    print(f"{'format':<10}{'bytes/stream':>14}{'lines/stream':>14}{'cpu ms/stream':>15}")
+    for name, formatter in formats.items():
+        sizes, cpu, lines = await measure(formatter, args.streams, args.tokens, inter_token_delay)
+        print(f"{name:<10}{statistics.mean(sizes):>14.0f}{statistics.mean(lines):>14.1f}{statistics.mean(cpu) * 1000:>15.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--inter_token_ms", type=float, default=0)
+    parser.add_argument("--flush_interval_ms", type=float, default=30)
+    parser.add_argument("--flush_bytes", type=int, default=64)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,125 @@
+"""Time-to-first-token: per-request AsyncAzureOpenAI construction vs the pooled worker client.
+
+Run from the repository root:
+
+    python -m benchmarks.ttft_client_pool --requests 200 --concurrency 8 --token_latency_ms 40
+
+``--token_latency_ms`` simulates Azure AD token acquisition, which the old
+code paid on every request because it built a new ``DefaultAzureCredential``
+token provider each time. The mock endpoint is plain HTTP, so TLS handshake
+savings against a real endpoint come on top of the numbers reported here.
+"""
+import time
+import asyncio
+import argparse
+import statistics
+import httpx
+from azure.core.credentials import AccessToken
+from openai import AsyncAzureOpenAI
+from backend.aoai.client import AzureADTokenProvider, create_http_client, warmup_connections
+from benchmarks.mock_aoai import MockAzureOpenAI, start_mock_server
+
+API_VERSION = "2024-02-15-preview"
+DEPLOYMENT = "mock-deployment"
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+class SlowCredential():
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def get_token(self, *scopes, **kwargs):
+        await asyncio.sleep(self.latency)
+        return AccessToken("mock-token", int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def time_to_first_token(client, start=None):
+    start = start or time.perf_counter()
+    stream = await client.chat.completions.create(model=DEPLOYMENT, messages=MESSAGES, stream=True)
+    ttft = None
+    async for chunk in stream:
+        if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+            ttft = time.perf_counter() - start
+    return ttft
+
+
+async def run_per_request(endpoint, token_latency, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            credential = SlowCredential(token_latency)
+            provider = AzureADTokenProvider(credential, refresh_margin=0)
+            client = AsyncAzureOpenAI(
+                api_version=API_VERSION,
+                azure_ad_token_provider=provider,
+                azure_endpoint=endpoint,
+                http_client=httpx.AsyncClient(),
+            )
+            try:
+                return await time_to_first_token(client, start)
+            finally:
+                await client.close()
+
+    return await asyncio.gather(*(one() for _ in range(requests)))
+
+
+async def run_pooled(endpoint, token_latency, requests, concurrency):
+    provider = AzureADTokenProvider(SlowCredential(token_latency))
+    await provider.start()
+    http_client = create_http_client(max_connections=concurrency, max_keepalive_connections=concurrency, http2=False)
+    client = AsyncAzureOpenAI(
+        api_version=API_VERSION,
+        azure_ad_token_provider=provider,
+        azure_endpoint=endpoint,
+        http_client=http_client,
+    )
+    await warmup_connections(http_client, endpoint, concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await time_to_first_token(client)
+
+    try:
+        return await asyncio.gather(*(one() for _ in range(requests)))
+    finally:
+        await client.close()
+        await provider.close()
+
+
+async def main(args):
+    mock = MockAzureOpenAI(first_token_delay=args.first_token_ms / 1000, inter_token_delay=0.001, tokens=5)
+    runner, endpoint = await start_mock_server(mock)
+    token_latency = args.token_latency_ms / 1000
+    try:
+        results = {
+            "per-request client": await run_per_request(endpoint, token_latency, args.requests, args.concurrency),
+            "pooled client": await run_pooled(endpoint, token_latency, args.requests, args.concurrency),
+        }
+    finally:
+        await runner.cleanup()
+
+    print(f"{'mode':<20}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for mode, values in results.items():
+        values = [v * 1000 for v in values if v is not None]
+        print(f"{mode:<20}{percentile(values, 50):>10.2f}{percentile(values, 99):>10.2f}{statistics.mean(values):>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--token_latency_ms", type=float, default=40)
+    parser.add_argument("--first_token_ms", type=float, default=20)
+    asyncio.run(main(parser.parse_args()))
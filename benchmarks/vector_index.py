@@ -0,0 +1,76 @@
+"""Queries per second of the local vector index against corpus size.
+
+Run from the repository root:
+
+    python -m benchmarks.vector_index --sizes 10000 100000 500000 --dimensions 1536
+
+For each corpus size an index of clustered random vectors is built in a
+temporary directory and searched in batches, exactly (flat) and with IVF
+partitioning at a few ``nprobe`` settings. Recall is measured against the
+flat results.
+"""
+import time
+import argparse
+import tempfile
+import numpy as np
+from backend.search import vector_index
+
+
+def corpus(count, dimensions, clusters, rng):
+    centers = rng.normal(size=(clusters, dimensions)).astype(np.float32)
+    for start in range(0, count, 10000):
+        size = min(10000, count - start)
+        vectors = centers[rng.integers(clusters, size=size)] + 0.5 * rng.normal(size=(size, dimensions)).astype(np.float32)
+        for i, vector in enumerate(vectors):
+            yield {"id": str(start + i), "content": "", "contentVector": vector}
+
+
+def queries_per_second(index, queries, k, batch_size, nprobe=None):
+    rows = []
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        rows.append(index.search(batch, k=k, nprobe=nprobe)[1] if nprobe else index.search(batch, k=k)[1])
+    return len(queries) / (time.perf_counter() - started), np.vstack(rows)
+
+
+def recall(found, expected):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, expected)])
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>10} {'mode':<14} {'build s':>8} {'qps':>10} {'recall@k':>9}")
+    for size in args.sizes:
+        queries = rng.normal(size=(args.queries, args.dimensions)).astype(np.float32)
+        with tempfile.TemporaryDirectory() as flat_dir, tempfile.TemporaryDirectory() as ivf_dir:
+            started = time.perf_counter()
+            flat = vector_index.build_vector_index(corpus(size, args.dimensions, args.clusters, np.random.default_rng(size)), flat_dir)
+            build_seconds = time.perf_counter() - started
+            qps, exact = queries_per_second(flat, queries, args.k, args.batch_size)
+            print(f"{size:>10} {'flat':<14} {build_seconds:>8.1f} {qps:>10.0f} {1.0:>9.3f}")
+
+            lists = args.ivf_lists or max(int(np.sqrt(size)), 1)
+            started = time.perf_counter()
+            ivf = vector_index.build_vector_index(corpus(size, args.dimensions, args.clusters, np.random.default_rng(size)), ivf_dir, ivf_lists=lists)
+            build_seconds = time.perf_counter() - started
+            ## IVF stores rows grouped by list; map them back to ids to compare
+            ids = np.array([int(ivf.document(row)["id"]) for row in range(len(ivf))])
+            for nprobe in args.nprobe:
+                qps, rows = queries_per_second(ivf, queries, args.k, args.batch_size, nprobe)
+                print(f"{size:>10} {f'ivf{lists}/p{nprobe}':<14} {build_seconds:>8.1f} {qps:>10.0f} {recall(ids[rows], exact):>9.3f}")
+            flat.close()
+            ivf.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=64)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--ivf_lists", type=int, default=0, help="IVF partitions, default sqrt(chunks)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16])
+    main(parser.parse_args())
@@ -1,4 +1,4 @@
-import { UserInfo, ConversationRequest, Conversation, ChatMessage, CosmosDBHealth, CosmosDBStatus } from "./models";
+import { UserInfo, ConversationRequest, Conversation, ConversationPage, ChatMessage, CosmosDBHealth, CosmosDBStatus } from "./models";
 import { chatHistorySampleData } from "../constants/chatHistory";
 
 export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
@@ -35,8 +35,9 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
     return chatHistorySampleData;
 }
 
-export const historyList = async (offset=0): Promise<Conversation[] | null> => {
-    const response = await fetch(`/history/list?offset=${offset}`, {
+export const historyList = async (continuationToken?: string | null): Promise<ConversationPage | null> => {
+    const query = continuationToken ? `?continuation_token=${encodeURIComponent(continuationToken)}` : "";
+    const response = await fetch(`/history/list${query}`, {
         method: "GET",
     }).then(async (res) => {
         const payload = await res.json();
@@ -57,12 +58,12 @@ export const historyList = async (offset=0): Promise<Conversation[] | null> => {
             const conversation: Conversation = {
                 id: conv.id,
                 title: conv.title,
-                date: conv.createdAt,
+                date: conv.updatedAt,
                 messages: convMessages
             };
             return conversation;
         }));
-        return conversations;
+        return { conversations, continuationToken: res.headers.get("X-Continuation-Token") };
     }).catch((err) => {
         console.error("There was an issue fetching your data.");
         return null
@@ -49,6 +49,11 @@ export type Conversation = {
     date: string;
 }
 
+export type ConversationPage = {
+    conversations: Conversation[];
+    continuationToken: string | null;
+}
+
 export enum ChatCompletionType {
     ChatCompletion = "chat.completion",
     ChatCompletionChunk = "chat.completion.chunk"
@@ -247,7 +247,7 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
     const appStateContext = useContext(AppStateContext);
     const observerTarget = useRef(null);
     const [ , setSelectedItem] = React.useState<Conversation | null>(null);
-    const [offset, setOffset] = useState<number>(25);
+    const [continuationToken, setContinuationToken] = useState<string | null | undefined>(undefined);
     const [observerCounter, setObserverCounter] = useState(0);
     const [showSpinner, setShowSpinner] = useState(false);
     const firstRender = useRef(true);
@@ -270,17 +270,21 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
             return;
         }
         handleFetchHistory();
-        setOffset((offset) => offset += 25);
     }, [observerCounter]);
 
     const handleFetchHistory = async () => {
+        // a null token means the last page has been loaded
+        if (continuationToken === null) {
+            return;
+        }
         const currentChatHistory = appStateContext?.state.chatHistory;
         setShowSpinner(true);
 
-        await historyList(offset).then((response) => {
-            const concatenatedChatHistory = currentChatHistory && response && currentChatHistory.concat(...response)
+        await historyList(continuationToken).then((response) => {
+            const concatenatedChatHistory = currentChatHistory && response && currentChatHistory.concat(...response.conversations)
             if (response) {
-                appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: concatenatedChatHistory || response });
+                setContinuationToken(response.continuationToken);
+                appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: concatenatedChatHistory || response.conversations });
             } else {
                 appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: null });
             }
@@ -8,7 +8,7 @@ from azure.core.credentials import AzureKeyCredential
 from azure.keyvault.secrets import SecretClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, json_dumps
 
 def get_document_intelligence_client(config, secret_client):
     print("Setting up Document Intelligence client...")
@@ -89,6 +89,6 @@ if __name__ == "__main__":
                 d = dataclasses.asdict(chunk)
                 # add id to documents
                 d.update({"id": str(id)})
-                f.write(json.dumps(d) + "\n")
+                f.write(json_dumps(d) + "\n")
                 id += 1
         print("Chunking result written to {}.".format(args.output_file_path))
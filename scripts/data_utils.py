@@ -11,6 +11,7 @@ import tempfile
 import time
 from abc import ABC, abstractmethod
 from concurrent.futures import ProcessPoolExecutor
+import dataclasses
 from dataclasses import dataclass
 from functools import partial
 from typing import Callable, List, Dict, Optional, Generator, Tuple, Union
@@ -26,6 +27,11 @@ from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, Recursiv
 from tqdm import tqdm
 from typing import Any
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 FILE_FORMAT_DICT = {
         "md": "markdown",
@@ -51,6 +57,26 @@ PDF_HEADERS = {
     "sectionHeading": "h2"
 }
 
+def json_dumps(obj) -> str:
+    """Compact JSON for JSONL output; uses orjson when installed, which is much faster
+    for documents carrying embedding vectors. Dataclasses are serialized as dicts."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default)
+
+
+def _json_default(o):
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class TokenEstimator(object):
     GPT2_TOKENIZER = tiktoken.get_encoding("gpt2")
 
@@ -5,7 +5,7 @@ import json
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
-from data_utils import get_embedding
+from data_utils import get_embedding, json_dumps, json_loads
 
 RETRY_COUNT = 5
 
@@ -50,7 +50,7 @@ if __name__ == "__main__":
         print("Generating embeddings...")
         with open(args.input_data_path) as input_file, open(args.output_file_path, "w") as output_file:
             for line in input_file:
-                document = json.loads(line)
+                document = json_loads(line)
                 # Sleep/Retry in case embedding model is rate limited.
                 for _ in range(RETRY_COUNT):
                     try:
@@ -61,7 +61,7 @@ if __name__ == "__main__":
                         print("Error generating embedding. Retrying...")
                         sleep(30)
                 
-                output_file.write(json.dumps(document) + "\n")
+                output_file.write(json_dumps(document) + "\n")
 
         print("Embeddings generated and saved to {}.".format(args.output_file_path))
 
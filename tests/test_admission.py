@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from backend.aoai.admission import AdmissionController, AdmissionRejected, RateLimitState, parse_duration
+
+
+def test_parse_duration():
+    assert parse_duration("12") == 12
+    assert parse_duration("1.5") == 1.5
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("soon") is None
+    assert parse_duration(None) is None
+
+
+def test_rate_limit_headers_are_tracked():
+    state = RateLimitState()
+    state.update({"x-ratelimit-remaining-requests": "9", "x-ratelimit-remaining-tokens": "1200"})
+    assert (state.remaining_requests, state.remaining_tokens) == (9, 1200)
+    assert state.retry_after() == 0
+
+    state.update({"retry-after-ms": "5000"}, status_code=429)
+    assert 4 < state.retry_after() <= 5
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_for_a_free_slot():
+    controller = AdmissionController(max_concurrency=1, max_queue=5, queue_timeout=1)
+    first = await controller.acquire()
+    waiting = asyncio.ensure_future(controller.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    first.release()
+    second = await asyncio.wait_for(waiting, 1)
+    assert controller.in_flight == 1
+    second.release()
+    second.release()
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_is_rejected():
+    controller = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=1)
+    slot = await controller.acquire()
+    waiting = asyncio.ensure_future(controller.acquire())
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected) as error:
+        await controller.acquire()
+    assert error.value.reason == "queue_full"
+    assert error.value.retry_after >= 1
+
+    slot.release()
+    (await waiting).release()
+
+
+@pytest.mark.asyncio
+async def test_waiters_past_their_deadline_are_rejected():
+    controller = AdmissionController(max_concurrency=1, max_queue=5, queue_timeout=0.05)
+    slot = await controller.acquire()
+
+    with pytest.raises(AdmissionRejected) as error:
+        await controller.acquire()
+    assert error.value.reason == "deadline"
+    assert not controller._waiters
+
+    slot.release()
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_expected_wait_over_deadline_is_rejected_early():
+    controller = AdmissionController(max_concurrency=1, max_queue=5, queue_timeout=1)
+    controller.hold_time = 5
+    slot = await controller.acquire()
+
+    with pytest.raises(AdmissionRejected) as error:
+        await controller.acquire()
+    assert error.value.reason == "deadline"
+    assert error.value.retry_after >= 5
+    slot.release()
+
+
+@pytest.mark.asyncio
+async def test_upstream_back_off_longer_than_deadline_is_rejected():
+    controller = AdmissionController(queue_timeout=1)
+    controller.rate_limit.update({"retry-after": "30"}, status_code=429)
+
+    with pytest.raises(AdmissionRejected) as error:
+        await controller.acquire()
+    assert error.value.reason == "rate_limited"
+    assert 29 < error.value.retry_after <= 30
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_passes_its_slot_on():
+    controller = AdmissionController(max_concurrency=1, max_queue=5, queue_timeout=1)
+    slot = await controller.acquire()
+    cancelled = asyncio.ensure_future(controller.acquire())
+    waiting = asyncio.ensure_future(controller.acquire())
+    await asyncio.sleep(0)
+
+    cancelled.cancel()
+    slot.release()
+    (await asyncio.wait_for(waiting, 1)).release()
+    assert controller.in_flight == 0
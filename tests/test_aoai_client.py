@@ -0,0 +1,90 @@
+import time
+import asyncio
+import pytest
+from azure.core.credentials import AccessToken
+from backend.aoai.client import AzureADTokenProvider, create_http_client
+
+
+class CountingCredential():
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+        self.closed = False
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        return AccessToken(f"token-{self.calls}", int(time.time()) + self.lifetime)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_token_provider_caches_token():
+    credential = CountingCredential()
+    provider = AzureADTokenProvider(credential)
+
+    assert await provider() == "token-1"
+    assert await provider() == "token-1"
+    assert credential.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_token_provider_refreshes_expired_token():
+    credential = CountingCredential(lifetime=-1)
+    provider = AzureADTokenProvider(credential)
+
+    assert await provider() == "token-1"
+    assert await provider() == "token-2"
+
+
+@pytest.mark.asyncio
+async def test_token_provider_start_and_close():
+    credential = CountingCredential()
+    provider = AzureADTokenProvider(credential)
+
+    await provider.start()
+    assert credential.calls == 1
+    assert await provider() == "token-1"
+
+    await provider.close()
+    assert credential.closed
+
+
+@pytest.mark.asyncio
+async def test_short_lived_tokens_are_not_refreshed_in_a_loop(monkeypatch):
+    sleep = asyncio.sleep
+    delays = []
+
+    async def recording_sleep(delay):
+        delays.append(delay)
+        if len(delays) == 3:
+            await asyncio.Event().wait()
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", recording_sleep)
+    ## valid for less than the refresh margin: renewed halfway through
+    provider = AzureADTokenProvider(CountingCredential(lifetime=120), refresh_margin=300, min_refresh_interval=10)
+    await provider.start()
+    while len(delays) < 3:
+        await sleep(0)
+    await provider.close()
+    assert all(55 <= delay <= 60 for delay in delays)
+
+    ## already expired: renewed at most every min_refresh_interval
+    delays.clear()
+    provider = AzureADTokenProvider(CountingCredential(lifetime=-1), refresh_margin=300, min_refresh_interval=10)
+    await provider.start()
+    while len(delays) < 3:
+        await sleep(0)
+    await provider.close()
+    assert delays == [10] * 3
+
+
+@pytest.mark.asyncio
+async def test_create_http_client_limits():
+    http_client = create_http_client(max_connections=7, max_keepalive_connections=3, http2=False)
+    pool = http_client._transport._pool
+    assert pool._max_connections == 7
+    assert pool._max_keepalive_connections == 3
+    await http_client.aclose()
@@ -0,0 +1,332 @@
+import time
+import asyncio
+import pytest
+from types import SimpleNamespace
+from azure.cosmos import exceptions
+import app as app_module
+from backend.utils import format_stream_response
+
+
+class FakeConversationClient():
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = False
+
+    async def ensure(self):
+        ## a round trip, during which other requests get to run
+        await asyncio.sleep(0.01)
+        return (True, "ok") if self.healthy else (False, "CosmosDB container not found")
+
+    async def close(self):
+        self.closed = True
+
+    async def get_conversations_page(self, user_id, limit, continuation_token=None):
+        return [], None
+
+    async def get_conversation(self, user_id, conversation_id):
+        return {"id": conversation_id, "updatedAt": "2024-01-01"}
+
+    async def get_messages(self, user_id, conversation_id, updated_at=None, messages_version=None):
+        return []
+
+
+@pytest.fixture
+def cosmos_clients(monkeypatch):
+    """Clients built by the app, in order; the first ``unhealthy`` of them fail ``ensure()``."""
+    clients = []
+    state = {"unhealthy": 0}
+
+    def init_cosmosdb_client():
+        clients.append(FakeConversationClient(healthy=len(clients) >= state["unhealthy"]))
+        return clients[-1]
+
+    monkeypatch.setattr(app_module, "init_cosmosdb_client", init_cosmosdb_client)
+    return clients, state
+
+
+@pytest.mark.asyncio
+async def test_one_client_is_shared_by_routes_and_closed_on_shutdown(cosmos_clients):
+    clients, _ = cosmos_clients
+    app = app_module.create_app()
+    async with app.test_app() as test_app:
+        test_client = test_app.test_client()
+        assert (await test_client.get("/history/list")).status_code == 200
+        assert (await test_client.post("/history/read", json={"conversation_id": "c1"})).status_code == 200
+        assert len(clients) == 1 and not clients[0].closed
+    assert clients[0].closed
+    assert app.cosmos_conversation_client is None
+
+
+@pytest.mark.asyncio
+async def test_failed_startup_is_retried_once_by_concurrent_requests(cosmos_clients):
+    clients, state = cosmos_clients
+    state["unhealthy"] = 1
+    app = app_module.create_app()
+    async with app.test_app() as test_app:
+        ## ensure() failed in before_serving, that client was closed and none kept
+        assert len(clients) == 1 and clients[0].closed
+        assert app.cosmos_conversation_client is None
+
+        test_client = test_app.test_client()
+        responses = await asyncio.gather(*(test_client.get("/history/list") for _ in range(5)))
+        assert [response.status_code for response in responses] == [200] * 5
+        assert len(clients) == 2
+        assert app.cosmos_conversation_client is clients[1]
+    assert clients[1].closed
+
+
+def test_placeholder_title_is_the_last_user_message():
+    messages = [
+        {"role": "user", "content": "first question"},
+        {"role": "assistant", "content": "an answer"},
+        {"role": "user", "content": "q" * 100},
+    ]
+    assert app_module.placeholder_title(messages) == "q" * 64
+    assert app_module.placeholder_title([{"role": "assistant", "content": "hello"}]) == ""
+
+
+def test_title_messages_keep_the_latest_turns_within_budget():
+    messages = [
+        {"role": "user", "content": "a" * 40},
+        {"role": "tool", "content": "citations"},
+        {"role": "assistant", "content": "b" * 12},
+        {"role": "user", "content": ""},
+        {"role": "user", "content": "c" * 8},
+    ]
+    ## 5 tokens are 20 characters: all of the last two turns, the end of the one before
+    assert app_module.truncate_title_messages(messages, 5) == [
+        {"role": "assistant", "content": "b" * 12},
+        {"role": "user", "content": "c" * 8},
+    ]
+    assert app_module.truncate_title_messages(messages, 6) == [
+        {"role": "user", "content": "a" * 4},
+        {"role": "assistant", "content": "b" * 12},
+        {"role": "user", "content": "c" * 8},
+    ]
+    assert app_module.truncate_title_messages(messages, 0) == []
+
+
+class TitledConversationClient():
+    def __init__(self, error=None):
+        self.error = error
+        self.titles = []
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        if self.error:
+            raise self.error
+        self.titles.append(title)
+        return True
+
+
+def chunk(content):
+    delta = SimpleNamespace(role="assistant", content=content)
+    return SimpleNamespace(id="1", model="gpt", created=0, object="chat.completion.chunk", choices=[SimpleNamespace(delta=delta)])
+
+
+@pytest.mark.asyncio
+async def test_generated_title_is_sent_on_later_frames_and_saved(monkeypatch):
+    async def generate_title(conversation_messages):
+        return "Weather in Paris"
+
+    monkeypatch.setattr(app_module, "generate_title", generate_title)
+    client = TitledConversationClient()
+    history_metadata = {"title": "what is the weather in Paris", "conversation_id": "c1"}
+
+    before = format_stream_response(chunk("It"), history_metadata)
+    assert before["history_metadata"]["title"] == "what is the weather in Paris"
+    await app_module.update_conversation_title(client, "user-1", "c1", [], history_metadata)
+    after = format_stream_response(chunk(" is sunny"), history_metadata)
+    assert after["history_metadata"] == {"title": "Weather in Paris", "conversation_id": "c1"}
+    assert client.titles == ["Weather in Paris"]
+
+
+@pytest.mark.asyncio
+async def test_title_of_a_deleted_conversation_is_not_saved(monkeypatch, caplog):
+    async def generate_title(conversation_messages):
+        return "Weather in Paris"
+
+    monkeypatch.setattr(app_module, "generate_title", generate_title)
+    client = TitledConversationClient(error=exceptions.CosmosResourceNotFoundError(message="Entity with the specified id does not exist"))
+    history_metadata = {"title": "what is the weather in Paris"}
+
+    await app_module.update_conversation_title(client, "user-1", "c1", [], history_metadata)
+    assert history_metadata["title"] == "Weather in Paris"
+    assert "Failed to save title of conversation c1" in caplog.text
+
+
+class StalledRouter():
+    """Never answers, like Azure OpenAI before the first token; ``stream`` is returned once ``answered`` is set."""
+
+    def __init__(self):
+        self.called = asyncio.Event()
+        self.answered = asyncio.Event()
+        self.stream = StalledStream()
+
+    async def create(self, model_args):
+        self.called.set()
+        await self.answered.wait()
+        return self.stream
+
+
+class StalledStream():
+    def __init__(self):
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.Event().wait()
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def stalled_app():
+    app = app_module.create_app()
+    app.admission_controller.max_concurrency = 1
+    app.openai_router = StalledRouter()
+    return app
+
+
+@pytest.mark.asyncio
+async def test_slot_is_released_when_the_client_disconnects_before_the_answer(stalled_app):
+    async with stalled_app.app_context():
+        request = asyncio.ensure_future(app_module.send_chat_request({"stream": True}))
+        await stalled_app.openai_router.called.wait()
+        assert stalled_app.admission_controller.in_flight == 1
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+    assert stalled_app.admission_controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_is_released_when_a_stream_is_never_iterated(stalled_app):
+    stalled_app.openai_router.answered.set()
+    async with stalled_app.app_context():
+        ## closing the stream releases the slot, even before its first chunk
+        stream = await app_module.send_chat_request({"stream": True})
+        assert stalled_app.admission_controller.in_flight == 1
+        await stream.aclose()
+        assert stalled_app.admission_controller.in_flight == 0 and stalled_app.openai_router.stream.closed
+
+        ## a request ending before its stream is even closed releases it too
+        started = asyncio.Event()
+
+        async def handler():
+            await app_module.send_chat_request({"stream": True})
+            started.set()
+            await asyncio.Event().wait()
+
+        request = asyncio.ensure_future(handler())
+        await started.wait()
+        assert stalled_app.admission_controller.in_flight == 1
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+    assert stalled_app.admission_controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_openai_client_is_restarted_once_by_concurrent_requests(monkeypatch):
+    started = []
+
+    async def start_openai_client(app):
+        ## builds a connection pool and token provider, during which other requests get to run
+        await asyncio.sleep(0.01)
+        started.append(SimpleNamespace(client=object()))
+        app.openai_router = started[-1]
+        app.azure_openai_client = started[-1].client
+        return app.azure_openai_client
+
+    monkeypatch.setattr(app_module, "start_openai_client", start_openai_client)
+    app = app_module.create_app()
+    async with app.app_context():
+        clients = await asyncio.gather(*(app_module.get_openai_client() for _ in range(5)), app_module.get_openai_router())
+    assert len(started) == 1
+    assert clients == [started[0].client] * 5 + [started[0]]
+
+
+class FakeUserDetailsClient():
+    def __init__(self, healthy):
+        self.healthy = healthy
+        self.closed = False
+
+    async def ensure(self):
+        await asyncio.sleep(0.01)
+        return (True, "ok") if self.healthy else (False, "CosmosDB container userdetails must be partitioned on /userId, not ['/a', '/b']")
+
+    async def close(self):
+        self.closed = True
+
+    async def get_or_create_user_details(self, user_id):
+        return {"id": user_id, "userId": user_id, "_etag": "1"}, False
+
+
+@pytest.mark.asyncio
+async def test_failed_user_details_start_is_remembered(monkeypatch):
+    clients = []
+    state = {"healthy": False}
+
+    def init_user_details_client():
+        clients.append(FakeUserDetailsClient(healthy=state["healthy"]))
+        return clients[-1]
+
+    monkeypatch.setattr(app_module, "AZURE_COSMOSDB_ACCOUNT_URI", "https://account")
+    monkeypatch.setattr(app_module, "AZURE_COSMOSDB_ACCOUNT_KEY", "key")
+    monkeypatch.setattr(app_module, "init_user_details_client", init_user_details_client)
+    app = app_module.create_app()
+    async with app.test_app() as test_app:
+        assert len(clients) == 1 and clients[0].closed
+
+        ## within the retry interval requests get the startup error, without building another client
+        test_client = test_app.test_client()
+        responses = await asyncio.gather(*(test_client.get("/api/user/details/u1") for _ in range(5)))
+        assert [response.status_code for response in responses] == [500] * 5
+        assert [(await response.get_json())["error"] for response in responses] == ["CosmosDB container userdetails must be partitioned on /userId, not ['/a', '/b']"] * 5
+        assert len(clients) == 1
+
+        state["healthy"] = True
+        failed_at, error = app.user_details_failure
+        app.user_details_failure = (failed_at - app_module.USER_DETAILS_RETRY_INTERVAL, error)
+        responses = await asyncio.gather(*(test_client.get("/api/user/details/u1") for _ in range(5)))
+        assert [response.status_code for response in responses] == [200] * 5
+        assert len(clients) == 2 and app.user_details_failure is None
+    assert clients[1].closed
+
+
+class FakeCredential():
+    def __init__(self):
+        self.closed = False
+
+    async def get_token(self, *scopes, **kwargs):
+        return SimpleNamespace(token="token", expires_on=time.time() + 3600)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_embedding_client_outlives_the_chat_token_provider(monkeypatch):
+    credentials = []
+
+    def default_azure_credential():
+        credentials.append(FakeCredential())
+        return credentials[-1]
+
+    monkeypatch.setattr(app_module, "DefaultAzureCredential", default_azure_credential)
+    monkeypatch.setattr(app_module, "AZURE_OPENAI_EMBEDDING_ENDPOINT", "https://aoai.openai.azure.com/openai/deployments/embeddings/embeddings?api-version=2024-02-01")
+    monkeypatch.setattr(app_module, "AZURE_OPENAI_EMBEDDING_KEY", None)
+    app = app_module.create_app()
+    app.azure_openai_token_provider = app_module.AzureADTokenProvider(default_azure_credential())
+    await app.azure_openai_token_provider.start()
+
+    await app_module.start_embedding_client(app)
+    ## a restart of the chat client closes its provider
+    await app_module.stop_openai_client(app)
+    assert credentials[0].closed and not credentials[1].closed
+    assert app.embedding_token_provider.credential is credentials[1]
+
+    await app_module.stop_embedding_client(app)
+    assert credentials[1].closed
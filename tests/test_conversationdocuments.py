@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import pytest
+from backend.history.conversationdocuments import DocumentConversationClient, bucket_id
+from backend.history.migrate import migrate_user
+from test_cosmosdbservice import InMemoryContainer, store_conversation
+
+
+@pytest.fixture
+def document_client():
+    client = DocumentConversationClient.__new__(DocumentConversationClient)
+    client.container_client = InMemoryContainer()
+    client.enable_message_feedback = True
+    client.delete_concurrency = 4
+    client.delete_by_partition_key = False
+    client.message_cache = None
+    client.conversation_index_size = 0
+    client.tail_cache_size = 100
+    client._tails = OrderedDict()
+    return client
+
+
+def question(i):
+    return {'role': 'user', 'content': f"question {i} " + "x" * 100}
+
+
+@pytest.mark.asyncio
+async def test_messages_are_appended_to_buckets(document_client, monkeypatch):
+    monkeypatch.setattr('backend.history.conversationdocuments.BUCKET_MAX_BYTES', 1000)
+    container = document_client.container_client
+    conversation = await document_client.create_conversation('user-1', 'hello')
+    container.calls.clear()
+
+    created = []
+    for i in range(12):
+        created += await document_client.create_messages(conversation['id'], 'user-1', [question(i)])
+    ## every append is a single batch, without reading the conversation first
+    assert set(container.calls) == {'execute_item_batch'}
+
+    stored = container.items[('user-1', conversation['id'])]
+    assert stored['messageCount'] == 12 and stored['buckets'] > 1
+    assert stored['updatedAt'] == created[-1]['createdAt']
+    for bucket in range(stored['buckets']):
+        assert len(str(container.items[('user-1', bucket_id(conversation['id'], bucket))]['messages'])) < 1500
+
+    messages = await document_client.get_messages('user-1', conversation['id'])
+    assert [message['id'] for message in messages] == [message['id'] for message in created]
+
+
+@pytest.mark.asyncio
+async def test_append_with_a_stale_tail_is_retried(document_client, monkeypatch):
+    monkeypatch.setattr('backend.history.conversationdocuments.BUCKET_MAX_BYTES', 1000)
+    conversation = await document_client.create_conversation('user-1')
+    for i in range(6):
+        await document_client.create_messages(conversation['id'], 'user-1', [question(i)])
+    ## as if another worker had appended since this one last saw the conversation
+    document_client._tails[('user-1', conversation['id'])] = (1, 0)
+    await document_client.create_messages(conversation['id'], 'user-1', [question(6)])
+
+    assert len(await document_client.get_messages('user-1', conversation['id'])) == 7
+    assert await document_client.create_messages('missing', 'user-1', [question(0)]) == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_throttled_append_keeps_its_guard(document_client, monkeypatch):
+    monkeypatch.setattr('backend.history.cosmosdbservice.MAX_THROTTLE_BACKOFF', 0)
+    monkeypatch.setattr('backend.history.conversationdocuments.BUCKET_MAX_BYTES', 1000)
+    conversation = await document_client.create_conversation('user-1')
+    created = []
+    for i in range(6):
+        created += await document_client.create_messages(conversation['id'], 'user-1', [question(i)])
+    document_client._tails[('user-1', conversation['id'])] = (1, 0)
+    ## the retry after the 429 still carries the bucket predicate, so the stale append fails instead of going to the first bucket
+    document_client.container_client.throttled_batches = 1
+    created += await document_client.create_messages(conversation['id'], 'user-1', [question(6)])
+
+    messages = await document_client.get_messages('user-1', conversation['id'])
+    assert [message['id'] for message in messages] == [message['id'] for message in created]
+
+
+@pytest.mark.asyncio
+async def test_feedback_and_clearing(document_client):
+    container = document_client.container_client
+    conversation = await document_client.create_conversation('user-1')
+    messages = await document_client.create_messages(conversation['id'], 'user-1', [question(0), {'role': 'assistant', 'content': 'answer'}])
+
+    assert (await document_client.update_message_feedback('user-1', messages[1]['id'], 'positive'))['feedback'] == 'positive'
+    assert [message['feedback'] for message in await document_client.get_messages('user-1', conversation['id'])] == ['', 'positive']
+    assert not await document_client.update_message_feedback('user-1', 'missing', 'positive')
+
+    container.calls.clear()
+    assert await document_client.delete_messages(conversation['id'], 'user-1') == 2
+    assert container.calls == ['read_item', 'execute_item_batch']
+    assert await document_client.get_messages('user-1', conversation['id']) == []
+    await document_client.create_messages(conversation['id'], 'user-1', [question(1)])
+    assert len(await document_client.get_messages('user-1', conversation['id'])) == 1
+    assert await document_client.delete_all_conversations('user-1') == {'conversations': 1, 'messages': 1}
+    assert container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_migration_round_trip(document_client):
+    container = document_client.container_client
+    store_conversation(container, 'user-1', 'c1', messages=150)
+    store_conversation(container, 'user-1', 'c2')
+
+    assert await migrate_user(document_client, 'user-1', 'document', dry_run=True) == {'conversations': 2, 'messages': 0}
+    assert await migrate_user(document_client, 'user-1', 'document') == {'conversations': 2, 'messages': 150}
+    assert sorted(item['type'] for item in container.items.values()) == ['conversation', 'conversation', 'messages']
+    messages = await document_client.get_messages('user-1', 'c1')
+    assert [message['id'] for message in messages] == [f"c1-m{i}" for i in range(150)]
+    assert await migrate_user(document_client, 'user-1', 'document') == {'conversations': 0, 'messages': 0}
+
+    assert await migrate_user(document_client, 'user-1', 'items') == {'conversations': 2, 'messages': 150}
+    assert sum(item['type'] == 'message' for item in container.items.values()) == 150
+    assert 'layout' not in container.items[('user-1', 'c1')]
+    assert len(await document_client.get_messages('user-1', 'c1')) == 150
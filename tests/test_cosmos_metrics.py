@@ -0,0 +1,109 @@
+import inspect
+import logging
+import pytest
+from backend import cosmos_metrics
+from backend.cosmos_metrics import OPERATION_REQUEST_CHARGE, OPERATION_RETRIES, OPERATIONS, THROTTLED_REQUESTS
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.user.userdetailsservice import CosmosUserDetailsClient
+from test_cosmosdbservice import InMemoryContainer
+from test_userdetailsservice import InMemoryContainer as InMemoryUserContainer
+
+
+class FakeResponse():
+
+    def __init__(self, status_code, request_charge):
+        self.http_response = self
+        self.status_code = status_code
+        self.headers = {'x-ms-request-charge': str(request_charge), 'x-ms-request-duration-ms': '1.5'}
+
+
+class ChargedContainer():
+    """Calls ``hook`` with a response charging ``request_charge`` RU for every call to ``container``, like the SDK pipeline."""
+
+    def __init__(self, container, hook, request_charge=2.5):
+        self.container = container
+        self.hook = hook
+        self.request_charge = request_charge
+
+    def __getattr__(self, name):
+        attribute = getattr(self.container, name)
+        if not inspect.iscoroutinefunction(attribute):
+            if callable(attribute):
+                self.hook(FakeResponse(200, self.request_charge))
+            return attribute
+
+        async def call(*args, **kwargs):
+            try:
+                result = await attribute(*args, **kwargs)
+            except Exception as e:
+                self.hook(FakeResponse(getattr(e, 'status_code', 500), self.request_charge))
+                raise
+            self.hook(FakeResponse(200, self.request_charge))
+            return result
+
+        return call
+
+
+@pytest.fixture
+def instrumented_client():
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.container_client = ChargedContainer(InMemoryContainer(), cosmos_metrics.response_hook("conversations"))
+    client.enable_message_feedback = False
+    client.delete_concurrency = 4
+    client.delete_by_partition_key = False
+    client.message_cache = None
+    client.conversation_index_size = 0
+    return client
+
+
+@pytest.mark.asyncio
+async def test_requests_are_charged_to_the_outer_operation(instrumented_client):
+    instrumented_client.conversation_index_size = 5
+    labels = {'container': 'conversations', 'operation': 'get_conversations_page'}
+    count, charge = OPERATION_REQUEST_CHARGE.get(**labels)
+
+    ## reading the index, building it and querying for it are one listing
+    await instrumented_client.get_conversations_page('user-1', limit=5)
+    assert OPERATION_REQUEST_CHARGE.get(**labels) == (count + 1, charge + 3 * 2.5)
+    assert OPERATION_REQUEST_CHARGE.get(container='conversations', operation='_build_conversation_index') == (0, 0.0)
+
+
+@pytest.mark.asyncio
+async def test_throttled_requests_and_errors_are_counted(instrumented_client, caplog, monkeypatch):
+    monkeypatch.setattr('backend.history.cosmosdbservice.MAX_THROTTLE_BACKOFF', 0)
+    monkeypatch.setattr('backend.history.cosmosdbservice.MAX_THROTTLE_RETRIES', 2)
+    instrumented_client.log_operations = True
+    container = instrumented_client.container_client.container
+    container._store({'id': 'c1', 'type': 'conversation', 'userId': 'user-1', 'title': '', 'updatedAt': '2024-01-01'})
+    container.throttled_batches = 2
+    labels = {'container': 'conversations', 'operation': 'create_messages'}
+    throttled = THROTTLED_REQUESTS.get(**labels)
+    retries = OPERATION_RETRIES.get(**labels)
+    failed = OPERATIONS.get(outcome='error', **labels)
+
+    with caplog.at_level(logging.INFO):
+        await instrumented_client.create_messages('c1', 'user-1', [{'role': 'user', 'content': 'hello'}])
+    assert THROTTLED_REQUESTS.get(**labels) == throttled + 2
+    assert OPERATION_RETRIES.get(**labels) == (retries[0] + 1, retries[1] + 2)
+    assert "CosmosDB conversations.create_messages ok: 7.50 RU" in caplog.text
+    assert "3 requests, 2 retried, 2 throttled" in caplog.text
+
+    container.throttled_batches = 100
+    with pytest.raises(Exception):
+        await instrumented_client.create_messages('c1', 'user-1', [{'role': 'user', 'content': 'hello'}])
+    assert OPERATIONS.get(outcome='error', **labels) == failed + 1
+
+
+@pytest.mark.asyncio
+async def test_user_details_calls_are_instrumented():
+    client = CosmosUserDetailsClient.__new__(CosmosUserDetailsClient)
+    client.container_client = ChargedContainer(InMemoryUserContainer(), cosmos_metrics.response_hook("userdetails"), request_charge=1)
+    client.partition_key_path = '/userId'
+    labels = {'container': 'userdetails', 'operation': 'get_or_create_user_details'}
+    count, charge = OPERATION_REQUEST_CHARGE.get(**labels)
+    reads = OPERATION_REQUEST_CHARGE.get(container='userdetails', operation='get_user_details')
+
+    await client.get_or_create_user_details('user-1')
+    ## the point read, the legacy profile query and the create
+    assert OPERATION_REQUEST_CHARGE.get(**labels) == (count + 1, charge + 3)
+    assert OPERATION_REQUEST_CHARGE.get(container='userdetails', operation='get_user_details') == reads
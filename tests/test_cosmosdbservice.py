@@ -0,0 +1,446 @@
+import re
+import copy
+import json
+import pytest
+from azure.core.async_paging import AsyncItemPaged, AsyncList
+from azure.cosmos import exceptions
+from backend.history.cosmosdbservice import CosmosConversationClient, decode_continuation_token, encode_continuation_token
+from backend.history.message_cache import MessageCache
+
+_SELECT = re.compile(r"^SELECT (?P<fields>.+?) FROM c (?:WHERE|where) (?P<where>.+?)(?: (?:ORDER BY|order by) c\.(?P<order>\w+) (?P<direction>ASC|DESC))?(?: offset (?P<offset>\d+) limit (?P<limit>\d+))?$")
+_CONDITION = re.compile(r"c\.(\w+) ?= ?(@\w+|'[^']*')")
+_CONTAINS = re.compile(r'ARRAY_CONTAINS\(c\.(\w+), \{"(\w+)": (@\w+)\}, true\)')
+_PREDICATE = re.compile(r"c\.(\w+) (=|<=) (-?\d+)")
+_BEFORE = re.compile(r"c\.(\w+) < (@\w+)")
+
+
+class InMemoryContainer():
+    """Runs the simple queries ``CosmosConversationClient`` issues over a dict of items, paging like the SDK."""
+
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+        self.queries = []
+        ## number of upcoming batches to reject with 429
+        self.throttled_batches = 0
+        self._etags = 0
+
+    def _store(self, item, items=None):
+        item = copy.deepcopy(item)
+        self._etags += 1
+        item['_etag'] = str(self._etags)
+        (self.items if items is None else items)[(item['userId'], item['id'])] = item
+        return copy.deepcopy(item)
+
+    @staticmethod
+    def _patch(item, patch_operations, filter_predicate=None):
+        """Applies set/add/incr patches to ``item`` in place; returns False if ``filter_predicate`` does not hold."""
+        for field, operator, value in _PREDICATE.findall(filter_predicate or ''):
+            if field not in item or not (item[field] == int(value) if operator == '=' else item[field] <= int(value)):
+                return False
+        for operation in patch_operations:
+            *parents, last = operation['path'].strip('/').split('/')
+            target = item
+            for part in parents:
+                target = target[int(part)] if isinstance(target, list) else target[part]
+            if isinstance(target, list) and last == '-':
+                target.append(copy.deepcopy(operation['value']))
+                continue
+            last = int(last) if isinstance(target, list) else last
+            if operation['op'] == 'incr':
+                target[last] = target.get(last, 0) + operation['value']
+            else:
+                target[last] = copy.deepcopy(operation['value'])
+        return True
+
+    def _select(self, query, parameters):
+        match = _SELECT.match(query)
+        assert match, query
+        values = {parameter['name']: parameter['value'] for parameter in parameters or []}
+        conditions = [(field, values[value] if value.startswith('@') else value.strip("'")) for field, value in _CONDITION.findall(match['where'])]
+        rows = [item for item in self.items.values() if all(item.get(field) == value for field, value in conditions)]
+        for field, value in _BEFORE.findall(match['where']):
+            rows = [item for item in rows if item.get(field) is not None and item[field] < values[value]]
+        for field, key, value in _CONTAINS.findall(match['where']):
+            rows = [item for item in rows if any(element.get(key) == values[value] for element in item.get(field, []))]
+        if match['order']:
+            rows.sort(key=lambda item: item.get(match['order']) or '', reverse=match['direction'] == 'DESC')
+        if match['offset']:
+            rows = rows[int(match['offset']):int(match['offset']) + int(match['limit'])]
+        if match['fields'] != '*':
+            fields = [field.strip()[len('c.'):] for field in match['fields'].split(',')]
+            rows = [{field: row[field] for field in fields if field in row} for row in rows]
+        return copy.deepcopy(rows)
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, **kwargs):
+        self.calls.append('query_items')
+        self.queries.append(query)
+        rows = self._select(query, parameters)
+        page_size = max_item_count or len(rows) or 1
+
+        async def get_next(continuation_token):
+            start = json.loads(continuation_token)['skip'] if continuation_token else 0
+            return start, rows[start:start + page_size]
+
+        async def extract_data(response):
+            start, page = response
+            next_token = json.dumps({'skip': start + len(page)}) if start + len(page) < len(rows) else None
+            return next_token, AsyncList(page)
+
+        return AsyncItemPaged(get_next, extract_data)
+
+    async def upsert_item(self, body):
+        self.calls.append('upsert_item')
+        return self._store(body)
+
+    async def create_item(self, body):
+        self.calls.append('create_item')
+        if (body['userId'], body['id']) in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="conflict")
+        return self._store(body)
+
+    async def replace_item(self, item, body, etag=None, match_condition=None):
+        self.calls.append('replace_item')
+        current = self.items.get((body['userId'], item))
+        if current is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        if match_condition is not None and current['_etag'] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+        return self._store(body)
+
+    async def read_item(self, item, partition_key):
+        self.calls.append('read_item')
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return copy.deepcopy(self.items[(partition_key, item)])
+
+    async def delete_item(self, item, partition_key):
+        self.calls.append('delete_item')
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        del self.items[(partition_key, item)]
+
+    async def patch_item(self, item, partition_key, patch_operations):
+        self.calls.append('patch_item')
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        current = copy.deepcopy(self.items[(partition_key, item)])
+        self._patch(current, patch_operations)
+        return self._store(current)
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        """Applies every operation or, when one fails, none of them."""
+        self.calls.append('execute_item_batch')
+        assert len(batch_operations) <= 100
+        ## like the SDK, take the options off the caller's operations before sending them
+        batch_operations = [
+            (operation, args, {name: options[0].pop(name) for name in list(options[0])} if options else {})
+            for operation, args, *options in batch_operations
+        ]
+        if self.throttled_batches:
+            self.throttled_batches -= 1
+            error = exceptions.CosmosHttpResponseError(status_code=429, message="too many requests")
+            error.headers = {'x-ms-retry-after-ms': '1'}
+            raise error
+        items = copy.deepcopy(self.items)
+        results = []
+
+        def fail(index, status_code):
+            raise exceptions.CosmosBatchOperationError(
+                error_index=index, headers={}, status_code=status_code, message="batch failed", operation_responses=[{'statusCode': status_code}]
+            )
+
+        for index, (operation, args, *options) in enumerate(batch_operations):
+            options = options[0] if options else {}
+            if operation in ('upsert', 'create'):
+                assert args[0]['userId'] == partition_key
+                if operation == 'create' and (partition_key, args[0]['id']) in items:
+                    fail(index, 409)
+                results.append({'statusCode': 201, 'resourceBody': self._store(args[0], items)})
+                continue
+            if (partition_key, args[0]) not in items:
+                fail(index, 404)
+            current = items[(partition_key, args[0])]
+            if 'if_match_etag' in options and current['_etag'] != options['if_match_etag']:
+                fail(index, 412)
+            if operation == 'patch':
+                current = copy.deepcopy(current)
+                if not self._patch(current, args[1], options.get('filter_predicate')):
+                    fail(index, 412)
+                results.append({'statusCode': 200, 'resourceBody': self._store(current, items)})
+            elif operation == 'replace':
+                results.append({'statusCode': 200, 'resourceBody': self._store(args[1], items)})
+            elif operation == 'delete':
+                del items[(partition_key, args[0])]
+                results.append({'statusCode': 204})
+        self.items = items
+        return results
+
+    async def delete_all_items_by_partition_key(self, partition_key):
+        self.calls.append('delete_all_items_by_partition_key')
+        self.items = {key: item for key, item in self.items.items() if key[0] != partition_key}
+
+
+@pytest.fixture
+def conversation_client():
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.container_client = InMemoryContainer()
+    client.enable_message_feedback = False
+    client.delete_concurrency = 4
+    client.delete_by_partition_key = False
+    client.message_cache = None
+    client.conversation_index_size = 0
+    return client
+
+
+def store_conversation(container, user_id, conversation_id, messages=0):
+    container._store({'id': conversation_id, 'type': 'conversation', 'userId': user_id, 'title': '', 'updatedAt': '2024-01-01'})
+    for i in range(messages):
+        container._store({'id': f"{conversation_id}-m{i}", 'type': 'message', 'userId': user_id, 'conversationId': conversation_id, 'createdAt': f"{i:06d}"})
+
+
+def test_continuation_token_round_trip():
+    token = '{"compositeToken":"+RID:~abc==#RT:1","range":{"min":"","max":"FF"}}'
+    cursor = encode_continuation_token(token)
+    assert re.fullmatch(r"[\w-]+", cursor)
+    assert decode_continuation_token(cursor) == token
+    with pytest.raises(ValueError):
+        decode_continuation_token("not a cursor!")
+
+
+@pytest.mark.asyncio
+async def test_conversation_pages_follow_continuation_tokens(conversation_client):
+    container = conversation_client.container_client
+    for i in range(7):
+        container._store({'id': f"c{i}", 'type': 'conversation', 'userId': 'user-1', 'title': f"t{i}", 'createdAt': '', 'updatedAt': f"2024-01-0{i + 1}"})
+    container._store({'id': 'other', 'type': 'conversation', 'userId': 'user-2', 'title': '', 'updatedAt': '2024-02-01'})
+    container._store({'id': 'm1', 'type': 'message', 'userId': 'user-1', 'conversationId': 'c1', 'updatedAt': '2024-03-01'})
+
+    pages = []
+    continuation_token = None
+    while True:
+        conversations, continuation_token = await conversation_client.get_conversations_page('user-1', limit=3, continuation_token=continuation_token)
+        pages.append([conversation['id'] for conversation in conversations])
+        if continuation_token is None:
+            break
+
+    assert pages == [["c6", "c5", "c4"], ["c3", "c2", "c1"], ["c0"]]
+    ## only the sidebar fields are read, and no page skips rows with OFFSET
+    assert conversations == [{'id': 'c0', 'title': 't0', 'updatedAt': '2024-01-01'}]
+    assert not any('offset' in query.lower() for query in container.queries)
+
+
+@pytest.mark.asyncio
+async def test_create_message_is_one_transactional_batch(conversation_client):
+    container = conversation_client.container_client
+    container._store({'id': 'c1', 'type': 'conversation', 'userId': 'user-1', 'title': '', 'updatedAt': '2024-01-01'})
+
+    message = await conversation_client.create_message('m1', 'c1', 'user-1', {'role': 'user', 'content': 'hello'})
+    assert container.calls == ['execute_item_batch']
+    assert message['id'] == 'm1' and message['conversationId'] == 'c1'
+    assert container.items[('user-1', 'c1')]['updatedAt'] == message['createdAt']
+
+
+@pytest.mark.asyncio
+async def test_create_message_for_missing_conversation_writes_nothing(conversation_client):
+    container = conversation_client.container_client
+    assert await conversation_client.create_message('m1', 'missing', 'user-1', {'role': 'user', 'content': 'hello'}) == "Conversation not found"
+    assert container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_reply_messages_are_stored_together_in_order(conversation_client):
+    container = conversation_client.container_client
+    container._store({'id': 'c1', 'type': 'conversation', 'userId': 'user-1', 'title': '', 'updatedAt': '2024-01-01'})
+
+    messages = await conversation_client.create_messages('c1', 'user-1', [
+        {'role': 'tool', 'content': '{"citations": []}'},
+        {'role': 'assistant', 'content': 'Hi there'},
+    ])
+    assert container.calls == ['execute_item_batch']
+    assert [message['role'] for message in messages] == ['tool', 'assistant']
+    assert messages[0]['createdAt'] < messages[1]['createdAt']
+    assert container.items[('user-1', 'c1')]['updatedAt'] == messages[1]['createdAt']
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_in_batches_of_100(conversation_client):
+    container = conversation_client.container_client
+    store_conversation(container, 'user-1', 'c1', messages=250)
+    store_conversation(container, 'user-1', 'c2', messages=3)
+    container.throttled_batches = 2
+
+    assert await conversation_client.delete_messages('c1', 'user-1') == 250
+    ## three batches, two of them retried after a 429
+    assert container.calls.count('execute_item_batch') == 5
+    assert sorted(item['id'] for item in container.items.values()) == ['c1', 'c2', 'c2-m0', 'c2-m1', 'c2-m2']
+
+
+@pytest.mark.asyncio
+async def test_batch_skips_items_already_deleted(conversation_client):
+    container = conversation_client.container_client
+    store_conversation(container, 'user-1', 'c1', messages=3)
+    deleted = await conversation_client.execute_batch('user-1', [('delete', ('c1-m0',)), ('delete', ('gone',)), ('delete', ('c1-m2',))])
+    assert len(deleted) == 2
+    assert sorted(item['id'] for item in container.items.values()) == ['c1', 'c1-m1']
+
+
+@pytest.mark.asyncio
+async def test_persistent_throttling_is_raised(conversation_client, monkeypatch):
+    monkeypatch.setattr('backend.history.cosmosdbservice.MAX_THROTTLE_RETRIES', 1)
+    container = conversation_client.container_client
+    store_conversation(container, 'user-1', 'c1', messages=1)
+    container.throttled_batches = 2
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        await conversation_client.delete_messages('c1', 'user-1')
+
+
+@pytest.mark.asyncio
+async def test_delete_all_conversations(conversation_client):
+    container = conversation_client.container_client
+    store_conversation(container, 'user-1', 'c1', messages=120)
+    store_conversation(container, 'user-1', 'c2', messages=5)
+    store_conversation(container, 'user-2', 'c3', messages=1)
+
+    assert await conversation_client.delete_all_conversations('user-1') == {'conversations': 2, 'messages': 125}
+    assert sorted(item['id'] for item in container.items.values()) == ['c3', 'c3-m0']
+
+    conversation_client.delete_by_partition_key = True
+    assert await conversation_client.delete_all_conversations('user-2') == {'conversations': 1, 'messages': 1}
+    assert container.items == {}
+    assert 'delete_all_items_by_partition_key' in container.calls
+
+
+@pytest.mark.asyncio
+async def test_messages_are_read_in_creation_order(conversation_client):
+    container = conversation_client.container_client
+    store_conversation(container, 'user-1', 'c1')
+    for message_id, created_at in (('b', '2024-01-01T00:00:02'), ('a', '2024-01-01T00:00:01'), ('c', '2024-01-01T00:00:03')):
+        container._store({'id': message_id, 'type': 'message', 'userId': 'user-1', 'conversationId': 'c1', 'createdAt': created_at})
+
+    assert [message['id'] for message in await conversation_client.get_messages('user-1', 'c1')] == ['a', 'b', 'c']
+    assert 'ORDER BY c.createdAt ASC' in container.queries[-1]
+    assert (await conversation_client.get_conversation('user-1', 'c1'))['id'] == 'c1'
+    assert await conversation_client.get_conversation('user-1', 'a') is None
+
+
+@pytest.mark.asyncio
+async def test_message_cache_follows_writes(conversation_client):
+    conversation_client.message_cache = MessageCache(max_entries=1)
+    container = conversation_client.container_client
+    store_conversation(container, 'user-1', 'c1', messages=2)
+    store_conversation(container, 'user-1', 'c2', messages=1)
+
+    assert len(await conversation_client.get_messages('user-1', 'c1')) == 2
+    message = await conversation_client.create_message('m1', 'c1', 'user-1', {'role': 'user', 'content': 'hello'})
+    await conversation_client.update_message_feedback('user-1', 'c1-m0', 'positive')
+    queries = len(container.queries)
+    messages = await conversation_client.get_messages('user-1', 'c1', updated_at=message['createdAt'])
+    assert [item['id'] for item in messages] == ['c1-m0', 'c1-m1', 'm1']
+    assert messages[0]['feedback'] == 'positive'
+    assert len(container.queries) == queries
+
+    ## a message added by another worker makes the cached list stale
+    container._store({'id': 'm2', 'type': 'message', 'userId': 'user-1', 'conversationId': 'c1', 'createdAt': '9999'})
+    assert len(await conversation_client.get_messages('user-1', 'c1', updated_at='9999')) == 4
+    assert len(container.queries) == queries + 1
+
+    await conversation_client.get_messages('user-1', 'c2')
+    assert len(conversation_client.message_cache) == 1
+    await conversation_client.delete_messages('c2', 'user-1')
+    assert await conversation_client.get_messages('user-1', 'c2') == []
+
+
+@pytest.mark.asyncio
+async def test_message_cache_sees_other_workers_deletes_and_feedback(conversation_client):
+    container = conversation_client.container_client
+    other_worker = CosmosConversationClient.__new__(CosmosConversationClient)
+    other_worker.__dict__.update(conversation_client.__dict__, message_cache=MessageCache())
+    conversation_client.message_cache = MessageCache()
+    store_conversation(container, 'user-1', 'c1', messages=2)
+    container.items[('user-1', 'c1')]['updatedAt'] = '000001'
+
+    async def read(client):
+        conversation = container.items[('user-1', 'c1')]
+        messages = await client.get_messages('user-1', 'c1', conversation['updatedAt'], conversation.get('messagesVersion', 0))
+        return [(message['id'], message.get('feedback')) for message in messages]
+
+    assert await read(conversation_client) == [('c1-m0', None), ('c1-m1', None)]
+    ## this worker's own feedback keeps its cached copy current
+    await conversation_client.update_message_feedback('user-1', 'c1-m0', 'positive')
+    queries = len(container.queries)
+    assert await read(conversation_client) == [('c1-m0', 'positive'), ('c1-m1', None)]
+    assert len(container.queries) == queries
+
+    ## neither moves updatedAt
+    await other_worker.update_message_feedback('user-1', 'c1-m1', 'negative')
+    assert await read(conversation_client) == [('c1-m0', 'positive'), ('c1-m1', 'negative')]
+    await other_worker.delete_messages('c1', 'user-1')
+    assert await read(conversation_client) == []
+
+
+def test_slow_read_does_not_cache_messages_missing_a_write():
+    cache = MessageCache()
+    cache.reserve('user-1', 'c1')
+    cache.add_messages('user-1', 'c1', [{'id': 'm2', 'createdAt': '2'}])
+    cache.fill('user-1', 'c1', [{'id': 'm1', 'createdAt': '1'}])
+    assert cache.get('user-1', 'c1') is None
+
+
+async def list_all(client, user_id, limit):
+    pages = []
+    conversations, continuation_token = await client.get_conversations_page(user_id, limit=limit)
+    pages.append([conversation['id'] for conversation in conversations])
+    while continuation_token is not None:
+        conversations, continuation_token = await client.get_conversations_page(user_id, limit=limit, continuation_token=continuation_token)
+        pages.append([conversation['id'] for conversation in conversations])
+    return pages
+
+
+@pytest.mark.asyncio
+async def test_conversation_index_serves_the_first_page(conversation_client):
+    conversation_client.conversation_index_size = 3
+    container = conversation_client.container_client
+    for i in range(5):
+        container._store({'id': f"c{i}", 'type': 'conversation', 'userId': 'user-1', 'title': f"t{i}", 'updatedAt': f"2024-01-0{i + 1}"})
+
+    ## built from a query on first use, then listed from a single point read
+    assert await list_all(conversation_client, 'user-1', 2) == [['c4', 'c3'], ['c2', 'c1'], ['c0']]
+    assert container.items[('user-1', 'conversation-index')]['complete'] is False
+    container.calls.clear()
+    conversations, continuation_token = await conversation_client.get_conversations_page('user-1', limit=2)
+    assert container.calls == ['read_item']
+    assert conversations == [{'id': 'c4', 'title': 't4', 'updatedAt': '2024-01-05'}, {'id': 'c3', 'title': 't3', 'updatedAt': '2024-01-04'}]
+
+    ## writes update the index in the batch that stores them
+    conversation = await conversation_client.create_conversation('user-1', 'new')
+    await conversation_client.create_message('m1', 'c0', 'user-1', {'role': 'user', 'content': 'hello'})
+    await conversation_client.update_conversation_title('user-1', 'c4', 'renamed')
+    assert await conversation_client.delete_conversation('user-1', 'c3')
+    assert set(container.calls) == {'read_item', 'execute_item_batch'}
+    conversations, _ = await conversation_client.get_conversations_page('user-1', limit=3)
+    assert [(item['id'], item['title']) for item in conversations] == [('c0', 't0'), (conversation['id'], 'new'), ('c4', 'renamed')]
+    assert await list_all(conversation_client, 'user-1', 3) == [['c0', conversation['id'], 'c4'], ['c2', 'c1']]
+
+
+@pytest.mark.asyncio
+async def test_conversation_index_is_trimmed(conversation_client):
+    conversation_client.conversation_index_size = 2
+    container = conversation_client.container_client
+    ids = []
+    for i in range(6):
+        ids.insert(0, (await conversation_client.create_conversation('user-1', f"t{i}"))['id'])
+        await conversation_client.create_message(f"m{i}", ids[0], 'user-1', {'role': 'user', 'content': 'hi'})
+    assert len(container.items[('user-1', 'conversation-index')]['updated']) == 6
+
+    assert await list_all(conversation_client, 'user-1', 2) == [ids[:2], ids[2:4], ids[4:]]
+    index = container.items[('user-1', 'conversation-index')]
+    assert set(index['updated']) == set(ids[:2]) and index['complete'] is False
+
+    ## a conversation trimmed from the index comes back when written to, its title read from the conversation
+    await conversation_client.create_message('m9', ids[-1], 'user-1', {'role': 'user', 'content': 'again'})
+    conversations, _ = await conversation_client.get_conversations_page('user-1', limit=2)
+    assert [item['id'] for item in conversations] == [ids[-1], ids[0]]
+    assert conversations[0]['title'] == 't0'
+    with pytest.raises(ValueError):
+        await conversation_client.get_conversations_page('user-1', limit=2, continuation_token='before:{')
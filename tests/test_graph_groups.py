@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+import pytest
+from backend.auth.auth_utils import get_authenticated_user_details
+from backend.auth.graph_groups import GraphClient, GroupFilterCache, build_group_filter, group_filter_key
+
+
+class FakeGraph():
+    """Serves /me/transitiveMemberOf in pages of two, like Graph's @odata.nextLink paging."""
+
+    def __init__(self, groups, latency=0.0, status=200):
+        self.groups = groups
+        self.latency = latency
+        self.status = status
+        self.requests = []
+
+    async def handler(self, request):
+        self.requests.append(request)
+        await asyncio.sleep(self.latency)
+        if self.status != 200:
+            return httpx.Response(self.status, json={"error": {"code": "InvalidAuthenticationToken"}})
+        page = int(request.url.params.get("page", 0))
+        response = {"value": [{"id": group} for group in self.groups[page * 2:page * 2 + 2]]}
+        if (page + 1) * 2 < len(self.groups):
+            response["@odata.nextLink"] = f"https://graph.microsoft.com/v1.0/me/transitiveMemberOf?page={page + 1}"
+        return httpx.Response(200, json=response)
+
+    def client(self):
+        return GraphClient(httpx.AsyncClient(transport=httpx.MockTransport(self.handler)))
+
+
+@pytest.mark.asyncio
+async def test_follows_next_links():
+    graph = FakeGraph(["a", "b", "c", "d", "e"])
+    assert await graph.client().fetch_group_ids("token") == ["a", "b", "c", "d", "e"]
+    assert len(graph.requests) == 3
+    assert graph.requests[0].url.params["$top"] == "999"
+    assert graph.requests[0].headers["Authorization"] == "bearer token"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_one_call_and_are_cached():
+    graph = FakeGraph(["a", "b"], latency=0.05)
+    cache = GroupFilterCache(graph.client(), "groups")
+
+    filters = await asyncio.gather(*[cache.get_filter("user", "token") for _ in range(10)])
+    assert set(filters) == {"groups/any(g:search.in(g, 'a, b'))"}
+    assert len(graph.requests) == 1
+
+    assert await cache.get_group_ids("user", "token") == ["a", "b"]
+    assert len(graph.requests) == 1
+    await cache.get_filter("other user", "token")
+    assert len(graph.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_refreshes_in_background_before_expiry():
+    graph = FakeGraph(["a"], latency=0.02)
+    cache = GroupFilterCache(graph.client(), "groups", ttl=0.5, refresh_margin=0.45)
+    await cache.get_filter("user", "token")
+
+    await asyncio.sleep(0.06)
+    graph.groups = ["a", "b"]
+    started = asyncio.get_running_loop().time()
+    ## answered from the cache straight away, the refresh runs behind it
+    assert await cache.get_group_ids("user", "token") == ["a"]
+    assert asyncio.get_running_loop().time() - started < 0.02
+    await cache.get_group_ids("user", "token")
+    await asyncio.sleep(0.01)
+    assert len(graph.requests) == 2
+
+    await asyncio.sleep(0.05)
+    assert await cache.get_group_ids("user", "token") == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_failed_lookup_matches_no_groups_and_is_not_cached():
+    graph = FakeGraph(["a"], status=401)
+    cache = GroupFilterCache(graph.client(), "groups")
+
+    assert await cache.get_filter("user", "token") == build_group_filter("groups", [])
+    graph.status = 200
+    assert await cache.get_filter("user", "token") == build_group_filter("groups", ["a"])
+
+    assert await cache.get_filter("user", "") == build_group_filter("groups", [])
+    assert len(graph.requests) == 2
+
+
+def test_callers_without_easy_auth_are_keyed_by_token():
+    ## no Easy Auth headers: every caller is the sample user
+    sample_principal_id = get_authenticated_user_details(request_headers={})["user_principal_id"]
+    assert group_filter_key(sample_principal_id, "token-a") != group_filter_key(sample_principal_id, "token-b")
+    assert group_filter_key(sample_principal_id, "token-a") == group_filter_key(sample_principal_id, "token-a")
+    assert group_filter_key("user-1", "token-a") == group_filter_key("user-1", "token-b") == "user-1"
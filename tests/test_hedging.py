@@ -0,0 +1,104 @@
+import time
+import httpx
+import pytest
+import pytest_asyncio
+from openai import AsyncAzureOpenAI
+from backend.aoai.hedging import HedgePolicy
+from backend.aoai.router import CircuitBreaker, Deployment, DeploymentRouter
+from benchmarks.mock_aoai import MockAzureOpenAI, start_mock_server
+
+API_VERSION = "2024-02-15-preview"
+STREAM_ARGS = {"model": "gpt", "messages": [{"role": "user", "content": "hello"}], "stream": True}
+
+
+def test_delay_tracks_percentile_of_observed_ttft():
+    policy = HedgePolicy(percentile=90)
+    assert policy.delay() == HedgePolicy.DEFAULT_DELAY
+    for i in range(1, 101):
+        policy.observe(i / 100)
+    assert policy.delay() == pytest.approx(0.9)
+    assert HedgePolicy(delay=0.25).delay() == 0.25
+
+
+def test_budget_caps_hedge_share():
+    policy = HedgePolicy(delay=0, budget_percent=10)
+    hedged = 0
+    for _ in range(200):
+        policy.request()
+        hedged += policy.try_hedge()
+    assert hedged == 20
+
+
+@pytest_asyncio.fixture
+async def slow_and_fast():
+    mocks = [
+        MockAzureOpenAI(first_token_delay=1.0, inter_token_delay=0.001, tokens=2, token_text="slow "),
+        MockAzureOpenAI(first_token_delay=0.01, inter_token_delay=0.001, tokens=2, token_text="fast "),
+    ]
+    started = [await start_mock_server(mock) for mock in mocks]
+    deployments = [
+        Deployment(f"d{i}", url, "gpt", AsyncAzureOpenAI(api_version=API_VERSION, api_key="k", azure_endpoint=url, http_client=httpx.AsyncClient(), max_retries=0), CircuitBreaker())
+        for i, (_, url) in enumerate(started)
+    ]
+    yield mocks, deployments
+    for deployment in deployments:
+        await deployment.client.close()
+    for runner, _ in started:
+        await runner.cleanup()
+
+
+def hedged_router(deployments, policy):
+    router = DeploymentRouter(deployments, hedge_policy=policy)
+    router.select = lambda exclude=(): next(d for d in deployments if d not in exclude)
+    return router
+
+
+async def stream_text(stream):
+    return "".join([chunk.choices[0].delta.content or "" async for chunk in stream if chunk.choices])
+
+
+@pytest.mark.asyncio
+async def test_late_first_token_is_hedged_and_loser_cancelled(slow_and_fast):
+    mocks, deployments = slow_and_fast
+    policy = HedgePolicy(delay=0.05, budget_percent=100)
+    router = hedged_router(deployments, policy)
+
+    started = time.monotonic()
+    stream = await router.create(STREAM_ARGS)
+    assert time.monotonic() - started < 0.5
+    assert await stream_text(stream) == "fast fast "
+    assert mocks[0].requests == 1 and mocks[1].requests == 1
+    ## the cancelled request does not count against the slow deployment
+    assert deployments[0].circuit_breaker.state == CircuitBreaker.CLOSED and deployments[0].circuit_breaker.available()
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_without_budget(slow_and_fast):
+    mocks, deployments = slow_and_fast
+    router = hedged_router(deployments, HedgePolicy(delay=0.05, budget_percent=0))
+
+    stream = await router.create(STREAM_ARGS)
+    assert await stream_text(stream) == "slow slow "
+    assert mocks[1].requests == 0
+
+
+@pytest.mark.asyncio
+async def test_fast_first_token_is_not_hedged(slow_and_fast):
+    mocks, deployments = slow_and_fast
+    router = hedged_router(list(reversed(deployments)), HedgePolicy(delay=0.5, budget_percent=100))
+
+    stream = await router.create(STREAM_ARGS)
+    assert await stream_text(stream) == "fast fast "
+    assert mocks[0].requests == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_primary_fails_over_before_hedge_delay(slow_and_fast):
+    mocks, deployments = slow_and_fast
+    mocks[0].status = 500
+    router = hedged_router(deployments, HedgePolicy(delay=5, budget_percent=0))
+
+    started = time.monotonic()
+    stream = await router.create(STREAM_ARGS)
+    assert time.monotonic() - started < 1
+    assert await stream_text(stream) == "fast fast "
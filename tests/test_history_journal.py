@@ -0,0 +1,149 @@
+import os
+import asyncio
+import pytest
+import pytest_asyncio
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.journal import HistoryJournal, WriteBehindConversationClient, QUEUE_DEPTH
+from test_cosmosdbservice import InMemoryContainer, store_conversation
+
+
+def cosmos_client(container):
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.container_client = container
+    client.enable_message_feedback = True
+    client.delete_concurrency = 4
+    client.delete_by_partition_key = False
+    client.message_cache = None
+    client.conversation_index_size = 0
+
+    async def close():
+        pass
+    client.close = close
+    return client
+
+
+@pytest_asyncio.fixture
+async def write_behind(tmp_path):
+    container = InMemoryContainer()
+    client = WriteBehindConversationClient(cosmos_client(container), HistoryJournal(str(tmp_path / "journal.sqlite3")), flush_interval=0.01)
+    await client.start()
+    yield client
+    await client.close()
+
+
+def conversation_ids(container):
+    return sorted(item['id'] for item in container.items.values() if item['type'] == 'conversation')
+
+
+@pytest.mark.asyncio
+async def test_writes_are_flushed_in_one_batch(write_behind):
+    container = write_behind.client.container_client
+    write_behind.flush_interval = 10
+    conversation = await write_behind.create_conversation('user-1', 'hello')
+    question = await write_behind.create_message('m1', conversation['id'], 'user-1', {'role': 'user', 'content': 'hi'})
+    await write_behind.create_messages(conversation['id'], 'user-1', [{'role': 'assistant', 'content': 'hello'}])
+    await write_behind.update_conversation_title('user-1', conversation['id'], 'Greetings')
+    ## nothing has reached CosmosDB yet
+    assert container.calls == []
+
+    await write_behind.flush()
+    assert container.calls == ['execute_item_batch']
+    stored = container.items[('user-1', conversation['id'])]
+    assert stored['title'] == 'Greetings'
+    assert stored['updatedAt'] > question['createdAt']
+    assert len(container.items) == 3
+    assert len(write_behind.journal) == 0
+    assert QUEUE_DEPTH.get() == 0
+
+
+@pytest.mark.asyncio
+async def test_reads_include_pending_writes(write_behind):
+    container = write_behind.client.container_client
+    store_conversation(container, 'user-1', 'old', messages=1)
+    conversation = await write_behind.create_conversation('user-1', 'new')
+    message = await write_behind.create_message('m1', 'old', 'user-1', {'role': 'user', 'content': 'again'})
+    await write_behind.update_message_feedback('user-1', 'old-m0', 'positive')
+
+    conversations, _ = await write_behind.get_conversations_page('user-1', limit=10)
+    assert [item['id'] for item in conversations] == ['old', conversation['id']]
+    assert conversations[0]['updatedAt'] == message['createdAt']
+    assert (await write_behind.get_conversation('user-1', conversation['id']))['title'] == 'new'
+    messages = await write_behind.get_messages('user-1', 'old')
+    assert [(item['id'], item.get('feedback')) for item in messages] == [('old-m0', 'positive'), ('m1', '')]
+
+
+@pytest.mark.asyncio
+async def test_writes_to_deleted_conversations_are_dropped(write_behind):
+    container = write_behind.client.container_client
+    store_conversation(container, 'user-1', 'c1')
+    kept = await write_behind.create_conversation('user-1')
+    await write_behind.create_message('m1', 'missing', 'user-1', {'role': 'user', 'content': 'lost'})
+    await write_behind.create_message('m2', kept['id'], 'user-1', {'role': 'user', 'content': 'kept'})
+    await write_behind.create_message('m3', 'c1', 'user-1', {'role': 'user', 'content': 'deleted'})
+    await write_behind.delete_conversation('user-1', 'c1')
+
+    await write_behind.flush()
+    assert sorted(item['id'] for item in container.items.values()) == sorted([kept['id'], 'm2'])
+    assert len(write_behind.journal) == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried(write_behind):
+    container = write_behind.client.container_client
+    container.throttled_batches = 100
+    conversation = await write_behind.create_conversation('user-1')
+    await asyncio.sleep(0.1)
+    assert container.items == {} and len(write_behind.journal) == 1
+
+    container.throttled_batches = 0
+    await write_behind.flush(timeout=5)
+    assert conversation_ids(container) == [conversation['id']]
+
+
+@pytest.mark.asyncio
+async def test_writes_of_an_exited_worker_are_recovered(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = HistoryJournal(path)
+    conversation = cosmos_client(InMemoryContainer()).build_conversation('user-1', 'orphan')
+    ## above the largest pid Linux hands out, so never a running process
+    journal.append(2 ** 22 + 1, 'user-1', conversation['id'], 'conversation', conversation)
+    journal.append(os.getpid(), 'user-2', 'c2', 'title', {'title': 'mine'})
+    journal.close()
+
+    container = InMemoryContainer()
+    store_conversation(container, 'user-2', 'c2')
+    client = WriteBehindConversationClient(cosmos_client(container), HistoryJournal(path), flush_interval=0.01)
+    await client.start()
+    await client.close()
+    assert conversation_ids(container) == sorted([conversation['id'], 'c2'])
+    assert container.items[('user-2', 'c2')]['title'] == 'mine'
+    assert len(HistoryJournal(path)) == 0
+
+
+@pytest.mark.asyncio
+async def test_live_workers_keep_their_writes_during_an_outage(tmp_path, monkeypatch):
+    monkeypatch.setattr('backend.history.cosmosdbservice.MAX_THROTTLE_RETRIES', 0)
+    path = str(tmp_path / "journal.sqlite3")
+    container = InMemoryContainer()
+    container.throttled_batches = 10 ** 6
+    workers = []
+    for owner in (os.getpid(), os.getppid()):
+        ## two live workers of one node, sharing the journal
+        worker = WriteBehindConversationClient(
+            cosmos_client(container), HistoryJournal(path), flush_interval=0.01, recovery_interval=0.02, stale_after=0.1, max_retry_backoff=0.05,
+        )
+        worker.owner = owner
+        await worker.start()
+        await worker.create_conversation(f'user-{owner}')
+        workers.append(worker)
+
+    await asyncio.sleep(0.5)
+    assert [worker._depth() for worker in workers] == [1, 1]
+    ## claiming an entry the worker already holds does not queue it twice
+    workers[0]._enqueue(workers[0].journal.pending(f'user-{os.getpid()}'), recovered=True)
+    assert workers[0]._depth() == 1
+
+    container.throttled_batches = 0
+    for worker in workers:
+        await worker.close()
+    assert len(conversation_ids(container)) == 2 and len(HistoryJournal(path)) == 0
@@ -0,0 +1,129 @@
+import math
+import numpy as np
+import pytest
+from backend.search.keyword_index import KeywordIndex, KeywordSearchClient, build_keyword_index, tokenize
+from backend.search.retrieval import FallbackSearchClient, HybridSearchClient, Retriever, reciprocal_rank_fusion
+from backend.search.vector_index import LocalSearchClient, build_vector_index
+
+
+DOCUMENTS = [
+    {"id": "1", "title": "Expense policy", "content": "Meals are reimbursed up to the daily limit.", "groups": ["finance"]},
+    {"id": "2", "title": "Travel", "content": "Book travel through the portal. Travel over the limit needs approval.", "groups": ["all"]},
+    {"id": "3", "title": "Holidays", "content": "Employees get twenty days of holiday.", "groups": ["all"]},
+    {"id": "4", "title": None, "content": "", "groups": ["all"]},
+]
+
+
+def bm25(documents, query, k1=1.2, b=0.75):
+    """Straightforward BM25 over title and content, for comparison."""
+    tokens = [tokenize(document["title"] or "") + tokenize(document["content"]) for document in documents]
+    average = sum(map(len, tokens)) / len(tokens)
+    scores = []
+    for document_tokens in tokens:
+        score = 0.0
+        for term in set(tokenize(query)):
+            df = sum(term in other for other in tokens)
+            tf = document_tokens.count(term)
+            if tf:
+                idf = math.log(1 + (len(tokens) - df + 0.5) / (df + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(document_tokens) / average))
+        scores.append(score)
+    return scores
+
+
+def test_bm25_scores_match_reference(tmp_path):
+    index = build_keyword_index(DOCUMENTS, str(tmp_path))
+    ## the chunk without text is skipped
+    assert len(index) == 3
+
+    scores, rows = index.search("travel limit approval", k=5)
+    expected = bm25(DOCUMENTS[:3], "travel limit approval")
+    assert [index.document(int(row))["id"] for row in rows] == ["2", "1"]
+    assert np.allclose(scores, [expected[1], expected[0]], rtol=1e-5)
+    assert index.search("unknown words", k=5)[1].size == 0
+
+
+def test_reloaded_index_is_memory_mapped(tmp_path):
+    build_keyword_index(DOCUMENTS, str(tmp_path)).close()
+
+    index = KeywordIndex.load(str(tmp_path))
+    assert isinstance(index.rows, np.memmap) and isinstance(index.frequencies, np.memmap)
+    assert "holiday" in index.vocabulary
+    _, rows = index.search("HOLIDAY", k=1)
+    assert index.document(int(rows[0]))["id"] == "3"
+    index.close()
+
+
+@pytest.mark.asyncio
+async def test_keyword_search_client_filters(tmp_path):
+    client = KeywordSearchClient(build_keyword_index(DOCUMENTS, str(tmp_path)))
+    results = await client.search({"search": "limit", "top": 5, "filter": "groups/any(g:search.in(g, 'all'))"})
+    assert [result["id"] for result in results] == ["2"]
+    assert results[0]["@search.score"] > 0
+    assert await client.search({"vectorQueries": [{"vector": [1.0]}]}) == []
+    await client.close()
+
+
+def test_reciprocal_rank_fusion():
+    keyword = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    vector = [{"id": "c"}, {"id": "a"}, {"id": "d"}]
+    fused = reciprocal_rank_fusion([keyword, vector], k=60, top=3)
+    assert [result["id"] for result in fused] == ["a", "c", "b"]
+    assert fused[0]["@search.score"] == pytest.approx(1 / 61 + 1 / 62)
+
+
+@pytest.mark.asyncio
+async def test_offline_hybrid_retrieval(tmp_path):
+    vectors = {"1": [1.0, 0.0], "2": [0.0, 1.0], "3": [0.7, 0.7]}
+    embedded = [{**document, "contentVector": vectors[document["id"]]} for document in DOCUMENTS[:3]]
+    keyword = KeywordSearchClient(build_keyword_index(embedded, str(tmp_path / "keyword")))
+    vector = LocalSearchClient(build_vector_index(embedded, str(tmp_path / "vector")))
+
+    class Embeddings():
+        async def embed(self, text):
+            return [1.0, 0.0]
+
+    retriever = Retriever(
+        HybridSearchClient([keyword, vector]),
+        embedding_client=Embeddings(),
+        query_type="vectorSimpleHybrid",
+        top_k=3,
+        strictness=1,
+        vector_columns=["contentVector"],
+    )
+    ## "travel" only matches document 2 by keyword, the vector ranks 1, 3, 2; found by both lists, 2 comes first
+    documents = (await retriever.retrieve("travel")).documents
+    assert [document["id"] for document in documents] == ["2", "1", "3"]
+    await retriever.close()
+
+
+@pytest.mark.asyncio
+async def test_vector_only_retrieval_falls_back_to_local_indexes(tmp_path):
+    vectors = {"1": [1.0, 0.0], "2": [0.0, 1.0], "3": [0.7, 0.7]}
+    embedded = [{**document, "contentVector": vectors[document["id"]]} for document in DOCUMENTS[:3]]
+    keyword = KeywordSearchClient(build_keyword_index(embedded, str(tmp_path / "keyword")))
+    vector = LocalSearchClient(build_vector_index(embedded, str(tmp_path / "vector")))
+
+    class Unavailable():
+        async def search(self, body):
+            raise ConnectionError("search service unavailable")
+
+        async def close(self):
+            pass
+
+    class Embeddings():
+        async def embed(self, text):
+            return [0.0, 1.0]
+
+    retriever = Retriever(
+        FallbackSearchClient(Unavailable(), HybridSearchClient([keyword, vector])),
+        embedding_client=Embeddings(),
+        query_type="vector",
+        top_k=3,
+        strictness=1,
+        vector_columns=["contentVector"],
+    )
+    ## the request carries no search text, only the keyword half comes back empty
+    documents = (await retriever.retrieve("travel")).documents
+    assert [document["id"] for document in documents] == ["2", "3", "1"]
+    await retriever.close()
@@ -0,0 +1,67 @@
+import os
+import pytest
+from backend import metrics
+
+
+def worker_registry(requests, queued):
+    registry = metrics.MetricsRegistry()
+    registry.register(metrics.Counter("requests_total", "Requests", ("outcome",))).inc(requests, outcome="ok")
+    registry.register(metrics.Gauge("queue_depth", "Queued requests")).set(queued)
+    registry.register(metrics.Histogram("request_seconds", "Request time", buckets=(1, 10))).observe(requests)
+    return registry
+
+
+@pytest.fixture
+def workers(monkeypatch, tmp_path):
+    """Starts SharedMetrics as if in worker ``pid``; exits a worker when its pid is removed from ``alive``."""
+    path = str(tmp_path / "metrics.sqlite3")
+    state = {"pid": 0, "alive": set()}
+    monkeypatch.setattr(os, "getpid", lambda: state["pid"])
+    monkeypatch.setattr(metrics, "_alive", lambda pid: pid in state["alive"])
+
+    def worker(pid, requests, queued):
+        state["pid"] = pid
+        state["alive"].add(pid)
+        return metrics.SharedMetrics(path, worker_registry(requests, queued))
+
+    return worker, state
+
+
+def test_any_worker_reports_the_node_totals(workers):
+    worker, state = workers
+    first = worker(101, requests=2, queued=3)
+    first.publish()
+    second = worker(102, requests=5, queued=1)
+    rendered = second.render()
+
+    node = f'node="{metrics.NODE}"'
+    assert f'requests_total{{outcome="ok",{node}}} 7' in rendered
+    assert f'queue_depth{{{node}}} 4' in rendered
+    assert f'request_seconds_bucket{{{node},le="1"}} 0' in rendered
+    assert f'request_seconds_bucket{{{node},le="10"}} 2' in rendered
+    assert f'request_seconds_count{{{node}}} 2' in rendered
+    assert "worker=" not in rendered
+
+
+def test_exited_workers_keep_their_counters_but_not_their_gauges(workers):
+    worker, state = workers
+    recycled = worker(101, requests=2, queued=3)
+    recycled.publish()
+    killed = worker(102, requests=5, queued=1)
+    killed.publish()
+
+    ## shuts down cleanly
+    state["pid"] = 101
+    recycled.retire()
+    state["alive"].discard(101)
+    ## never gets to
+    state["alive"].discard(102)
+
+    rendered = worker(103, requests=1, queued=2).render()
+    assert f'requests_total{{outcome="ok",node="{metrics.NODE}"}} 8' in rendered
+    assert f'queue_depth{{node="{metrics.NODE}"}} 2' in rendered
+
+    ## a new process given the pid of an exited one doesn't overwrite its counts
+    rendered = worker(103, requests=0, queued=0).render()
+    assert f'requests_total{{outcome="ok",node="{metrics.NODE}"}} 8' in rendered
+    assert f'queue_depth{{node="{metrics.NODE}"}} 0' in rendered
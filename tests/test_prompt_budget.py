@@ -0,0 +1,119 @@
+import pytest
+from backend.aoai.prompt_budget import HistoryAssembler, TokenCounter, SUMMARY_PREFIX, tiktoken_model_name
+
+
+class WordEncoding():
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text, disallowed_special=()):
+        self.calls += 1
+        return text.split()
+
+
+SYSTEM = [{"role": "system", "content": "be helpful"}]
+
+
+def conversation(turns):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"question {i} " + "word " * 8})
+        history.append({"role": "assistant", "content": f"answer {i} " + "word " * 8})
+    history.append({"role": "user", "content": "latest question"})
+    return history
+
+
+def test_model_name_mapping():
+    assert tiktoken_model_name("gpt-35-turbo-16k") == "gpt-3.5-turbo-16k"
+    assert tiktoken_model_name("gpt-4") == "gpt-4"
+
+
+def test_counts_are_cached_per_message():
+    encoding = WordEncoding()
+    counter = TokenCounter("gpt-4", encoding=encoding)
+    message = {"role": "user", "content": "one two three"}
+
+    assert counter.count_message(message) == TokenCounter.TOKENS_PER_MESSAGE + 1 + 3
+    calls = encoding.calls
+    counter.count_message(dict(message))
+    assert encoding.calls == calls
+
+
+def test_counts_are_estimated_without_tokenizer():
+    counter = TokenCounter("gpt-4")
+    assert counter.count_text("abcdefgh") == 2
+
+
+def test_history_within_budget_is_untouched():
+    assembler = HistoryAssembler(TokenCounter("gpt-4", encoding=WordEncoding()), max_prompt_tokens=10000)
+    history = conversation(3)
+    messages, trim = assembler.assemble(SYSTEM, history)
+    assert messages == SYSTEM + history
+    assert trim.tokens == 0 and trim.messages == 0
+
+
+def test_oldest_turns_are_dropped():
+    counter = TokenCounter("gpt-4", encoding=WordEncoding())
+    history = conversation(5)
+    assembler = HistoryAssembler(counter, max_prompt_tokens=60)
+    messages, trim = assembler.assemble(SYSTEM, history)
+
+    assert messages[0] == SYSTEM[0]
+    assert messages[1]["role"] == "user"
+    assert messages[-1] == history[-1]
+    assert counter.count_messages(messages) <= 60
+    assert trim.messages == len(history) - (len(messages) - 1)
+    assert trim.tokens == sum(counter.count_message(m) for m in history[:trim.messages])
+
+
+def test_latest_message_is_kept_over_budget():
+    assembler = HistoryAssembler(TokenCounter("gpt-4", encoding=WordEncoding()), max_prompt_tokens=1)
+    history = conversation(2)
+    messages, trim = assembler.assemble(SYSTEM, history)
+    assert messages == SYSTEM + history[-1:]
+    assert trim.messages == len(history) - 1
+
+
+@pytest.mark.asyncio
+async def test_rolling_summary_replaces_dropped_turns():
+    calls = []
+
+    async def summarize(messages, previous_summary):
+        calls.append((len(messages), previous_summary))
+        return f"summary {len(calls)}"
+
+    counter = TokenCounter("gpt-4", encoding=WordEncoding())
+    assembler = HistoryAssembler(counter, max_prompt_tokens=80, strategy="summarize", summarize=summarize)
+    history = conversation(4)
+
+    messages, trim = assembler.assemble(SYSTEM, history, "conversation-1")
+    assert not any(m["content"].startswith(SUMMARY_PREFIX) for m in messages)
+    assert trim.summary_update is not None
+    await assembler.update_summary(*trim.summary_update)
+
+    messages, trim = assembler.assemble(SYSTEM, history, "conversation-1")
+    assert messages[1] == {"role": "system", "content": SUMMARY_PREFIX + "summary 1"}
+    assert counter.count_messages(messages) <= 80
+
+    ## making room for the summary can drop another turn, which the next update folds in
+    while trim.summary_update is not None:
+        await assembler.update_summary(*trim.summary_update)
+        messages, trim = assembler.assemble(SYSTEM, history, "conversation-1")
+    assert trim.summarized == trim.messages
+    summaries = len(calls)
+
+    ## the next turn extends the existing summary instead of starting over
+    longer = history + [{"role": "assistant", "content": "reply " * 10}, {"role": "user", "content": "follow up " * 5}]
+    messages, trim = assembler.assemble(SYSTEM, longer, "conversation-1")
+    await assembler.update_summary(*trim.summary_update)
+    assert calls[-1][1] == f"summary {summaries}"
+
+    ## an edited history no longer matches the summary
+    edited = [dict(history[0], content="something else")] + history[1:]
+    messages, trim = assembler.assemble(SYSTEM, edited, "conversation-1")
+    assert not any(m["content"].startswith(SUMMARY_PREFIX) for m in messages)
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        HistoryAssembler(TokenCounter("gpt-4"), max_prompt_tokens=100, strategy="truncate")
@@ -0,0 +1,116 @@
+import os
+import time
+import pytest
+from backend import metrics
+from backend.cache.response_cache import (
+    InMemoryCacheBackend,
+    ResponseCache,
+    SQLiteCacheBackend,
+    cacheable_response,
+    make_cache_key,
+    replay_response,
+    replay_stream_response,
+)
+
+
+def model_args(content, temperature=0.0, stream=True):
+    return {
+        "messages": [{"role": "system", "content": "sys"}, {"role": "user", "content": content}],
+        "temperature": temperature,
+        "stream": stream,
+        "model": "gpt",
+    }
+
+
+def test_make_cache_key_normalizes_messages():
+    assert make_cache_key(model_args("hello  world ")) == make_cache_key(model_args("hello world"))
+    assert make_cache_key(model_args("hello", stream=True)) == make_cache_key(model_args("hello", stream=False))
+    assert make_cache_key(model_args("hello")) != make_cache_key(model_args("goodbye"))
+    assert make_cache_key(model_args("hello", temperature=0.0)) != make_cache_key(model_args("hello", temperature=1.0))
+
+
+def test_in_memory_backend_lru_eviction():
+    backend = InMemoryCacheBackend(max_entries=2)
+    backend.set("a", 1, 60)
+    backend.set("b", 2, 60)
+    assert backend.get("a") == 1
+    assert backend.set("c", 3, 60) == 1
+    assert backend.get("b") is None
+    assert backend.get("a") == 1
+    assert backend.get("c") == 3
+
+
+def test_in_memory_backend_ttl():
+    backend = InMemoryCacheBackend()
+    backend.set("a", 1, -1)
+    assert backend.get("a") is None
+
+
+def test_sqlite_backend_is_shared(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    writer = SQLiteCacheBackend(path, max_entries=2)
+    reader = SQLiteCacheBackend(path, max_entries=2)
+
+    writer.set("a", {"frames": [1]}, 60)
+    assert reader.get("a") == {"frames": [1]}
+
+    time.sleep(0.01)
+    writer.set("b", {"frames": [2]}, 60)
+    time.sleep(0.01)
+    assert writer.set("c", {"frames": [3]}, 60) == 1
+    assert reader.get("a") is None
+    assert len(reader) == 2
+    writer.close()
+    reader.close()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_counts_hits_and_misses():
+    cache = ResponseCache(InMemoryCacheBackend(max_entries=1), ttl=60)
+    assert "# TYPE response_cache_hits_total counter" in metrics.REGISTRY.render()
+
+    before_misses = cache_metric("response_cache_misses_total")
+    before_hits = cache_metric("response_cache_hits_total")
+    before_evictions = cache_metric("response_cache_evictions_total")
+
+    assert await cache.get("k") is None
+    await cache.set("k", {"id": "1", "model": "gpt", "object": "chat.completion.chunk", "frames": [[{"role": "assistant", "content": "hi"}]]})
+    cached = await cache.get("k")
+    await cache.set("other", {})
+
+    assert cache_metric("response_cache_misses_total") == before_misses + 1
+    assert cache_metric("response_cache_hits_total") == before_hits + 1
+    assert cache_metric("response_cache_evictions_total") == before_evictions + 1
+    assert f'response_cache_hits_total{{backend="memory",node="{metrics.NODE}",worker="{os.getpid()}"}}' in metrics.REGISTRY.render()
+    ## every sample already carries the worker labels
+    with pytest.raises(ValueError):
+        metrics.counter("per_worker_total", "Labelled by hand", ("worker",))
+
+    frames = [frame async for frame in replay_stream_response(cached, {"conversation_id": "c"})]
+    assert frames[0]["choices"][0]["messages"][0]["content"] == "hi"
+    assert frames[0]["history_metadata"] == {"conversation_id": "c"}
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_replays_whole_when_not_streamed():
+    cache = ResponseCache(InMemoryCacheBackend(), ttl=60)
+    frames = [
+        [{"role": "tool", "content": '{"citations": []}'}, {"role": "assistant", "content": "Hel"}],
+        [{"role": "assistant", "content": "lo "}],
+        [{"role": "assistant", "content": "there"}],
+    ]
+    first = {"id": "1", "model": "gpt", "object": "chat.completion.chunk"}
+    ## streamed and non-streamed requests share a cache key
+    assert make_cache_key(model_args("hi", stream=True)) == make_cache_key(model_args("hi", stream=False))
+    await cache.set(make_cache_key(model_args("hi")), cacheable_response(first, frames))
+
+    cached = await cache.get(make_cache_key(model_args("hi", stream=False)))
+    assert replay_response(cached, {})["choices"][0]["messages"] == [
+        {"role": "tool", "content": '{"citations": []}'},
+        {"role": "assistant", "content": "Hello there"},
+    ]
+    assert len([frame async for frame in replay_stream_response(cached, {})]) == 3
+
+
+def cache_metric(name):
+    return metrics.REGISTRY._metrics[name].get(backend="memory")
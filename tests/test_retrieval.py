@@ -0,0 +1,105 @@
+import json
+import httpx
+import pytest
+import pytest_asyncio
+from backend.search.retrieval import Retriever, SearchClient
+from benchmarks.mock_aoai import MockAzureOpenAI
+from benchmarks.mock_search import MockAzureSearch, start_mock_search
+
+DOCUMENTS = [
+    {"id": "1", "content": "Sleep seven to nine hours every night.", "title": "Sleep", "filepath": "sleep.md", "groups": ["a"]},
+    {"id": "2", "content": "Avoid screens an hour before sleep at night.", "title": "Screens", "filepath": "screens.md", "groups": ["b"]},
+    {"id": "3", "content": "Eat more vegetables.", "title": "Food", "filepath": "food.md", "groups": ["a"]},
+]
+
+
+class CountingEmbeddingClient():
+    def __init__(self):
+        self.calls = 0
+        self.mock = MockAzureOpenAI()
+
+    async def embed(self, text):
+        self.calls += 1
+        return self.mock.embed(text)
+
+
+@pytest_asyncio.fixture
+async def search_service():
+    mock = MockAzureSearch([dict(document) for document in DOCUMENTS], embed=MockAzureOpenAI().embed)
+    runner, url = await start_mock_search(mock)
+    search_client = SearchClient(url, "index", httpx.AsyncClient(), api_key="k")
+    yield mock, search_client
+    await search_client.close()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_retrieves_and_formats_passages(search_service):
+    mock, search_client = search_service
+    retriever = Retriever(search_client, top_k=5, strictness=3, title_column="title", filename_column="filepath")
+
+    retrieval = await retriever.retrieve("how much sleep at night")
+    ## best match first; "Eat more vegetables" shares no words with the question
+    assert [document["id"] for document in retrieval.documents] == ["2", "1"]
+    assert "[doc1] title: Screens" in retrieval.prompt()
+    assert "not available in the retrieved data" in retrieval.prompt(in_domain=True)
+    assert "not available" not in retrieval.prompt(in_domain=False)
+
+    tool_content = json.loads(retrieval.tool_message()["content"])
+    assert [citation["filepath"] for citation in tool_content["citations"]] == ["screens.md", "sleep.md"]
+    assert json.loads(tool_content["intent"]) == ["how much sleep at night"]
+
+
+@pytest.mark.asyncio
+async def test_strictness_drops_weak_passages(search_service):
+    _, search_client = search_service
+    strict = await Retriever(search_client, strictness=5).retrieve("sleep at night")
+    lenient = await Retriever(search_client, strictness=1).retrieve("sleep at night")
+    assert len(strict.documents) < len(lenient.documents)
+
+
+@pytest.mark.asyncio
+async def test_search_results_cached_by_query_and_filter(search_service):
+    mock, search_client = search_service
+    retriever = Retriever(search_client, result_cache_ttl=60)
+    group_a = "groups/any(g:search.in(g, 'a'))"
+
+    first = await retriever.retrieve("sleep at night", group_a)
+    second = await retriever.retrieve("sleep at night", group_a)
+    assert mock.requests == 1
+    assert first.documents == second.documents
+    assert [document["id"] for document in first.documents] == ["1"]
+    assert mock.last_body["filter"] == group_a
+
+    await retriever.retrieve("sleep at night", "groups/any(g:search.in(g, 'b'))")
+    assert mock.requests == 2
+
+    retriever.result_cache_ttl = 0
+    await retriever.retrieve("vegetables")
+    await retriever.retrieve("vegetables")
+    assert mock.requests == 4
+
+
+@pytest.mark.asyncio
+async def test_vector_queries_reuse_cached_embeddings(search_service):
+    mock, search_client = search_service
+    embedding_client = CountingEmbeddingClient()
+    retriever = Retriever(search_client, embedding_client, query_type="vectorSemanticHybrid", vector_columns=["contentVector"], result_cache_ttl=0, embedding_cache_size=1)
+
+    retrieval = await retriever.retrieve("vegetables to eat")
+    assert retrieval.documents[0]["id"] == "3"
+    assert mock.last_body["queryType"] == "semantic" and mock.last_body["vectorQueries"][0]["fields"] == "contentVector"
+    await retriever.retrieve("vegetables to eat")
+    assert embedding_client.calls == 1 and mock.requests == 2
+
+    ## the LRU holds a single query here
+    await retriever.retrieve("sleep")
+    await retriever.retrieve("vegetables to eat")
+    assert embedding_client.calls == 3
+
+
+def test_vector_query_type_needs_embeddings():
+    with pytest.raises(ValueError):
+        Retriever(None, query_type="vector")
+    with pytest.raises(ValueError):
+        Retriever(None, query_type="keyword")
@@ -0,0 +1,133 @@
+import time
+import random
+import httpx
+import pytest
+import pytest_asyncio
+from openai import AsyncAzureOpenAI, BadRequestError
+from backend.aoai.router import CircuitBreaker, Deployment, DeploymentRouter, parse_deployments
+from benchmarks.mock_aoai import MockAzureOpenAI, start_mock_server
+
+API_VERSION = "2024-02-15-preview"
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_circuit_breaker_opens_and_probes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.available()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available()
+
+    time.sleep(0.06)
+    assert breaker.available()
+    breaker.begin()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    ## only one probe at a time
+    assert not breaker.available()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    breaker.begin()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.available()
+
+
+def test_selection_prefers_fast_deployments_with_budget():
+    fast = Deployment("fast", "https://fast.example.com", "gpt", None)
+    slow = Deployment("slow", "https://slow.example.com", "gpt", None)
+    fast.ttft, slow.ttft = 0.1, 1.0
+    router = DeploymentRouter([fast, slow], rng=random.Random(0))
+
+    picks = [router.select().name for _ in range(1000)]
+    assert picks.count("fast") > 800
+
+    fast.rate_limit.update({"retry-after": "30"}, status_code=429)
+    assert router.budget_factor(fast) == 0
+    assert {router.select().name for _ in range(50)} == {"slow"}
+
+    fast.circuit_breaker.state = CircuitBreaker.OPEN
+    fast.circuit_breaker.opened_at = time.monotonic()
+    assert router.select(exclude=[slow]) is fast
+
+
+def test_parse_deployments():
+    entries = parse_deployments([{"endpoint": "https://a.openai.azure.com/", "key": "k"}, {"endpoint": "https://b.openai.azure.com/", "deployment": "gpt4"}], default_deployment="gpt")
+    assert [(e["name"], e["deployment"], e["key"]) for e in entries] == [("gpt@a.openai.azure.com", "gpt", "k"), ("gpt4@b.openai.azure.com", "gpt4", None)]
+    with pytest.raises(ValueError):
+        parse_deployments([{"deployment": "gpt"}])
+
+
+@pytest_asyncio.fixture
+async def mock_deployments():
+    mocks = [MockAzureOpenAI(first_token_delay=0.01, inter_token_delay=0.001, tokens=3, token_text=f"d{i} ") for i in range(2)]
+    started = [await start_mock_server(mock) for mock in mocks]
+    deployments = []
+    for i, (mock, (_, url)) in enumerate(zip(mocks, started)):
+        client = AsyncAzureOpenAI(api_version=API_VERSION, api_key="k", azure_endpoint=url, http_client=httpx.AsyncClient(), max_retries=0)
+        deployments.append(Deployment(f"d{i}", url, "gpt", client, CircuitBreaker(failure_threshold=1, reset_timeout=60)))
+    yield mocks, deployments
+    for deployment in deployments:
+        await deployment.client.close()
+    for runner, _ in started:
+        await runner.cleanup()
+
+
+async def stream_text(stream):
+    return "".join([chunk.choices[0].delta.content or "" async for chunk in stream if chunk.choices])
+
+
+@pytest.mark.asyncio
+async def test_fails_over_when_upstream_errors(mock_deployments):
+    mocks, deployments = mock_deployments
+    mocks[0].status = 500
+    router = DeploymentRouter(deployments)
+    router.select = lambda exclude=(): next(d for d in deployments if d not in exclude)
+
+    stream = await router.create({"model": "gpt", "messages": MESSAGES, "stream": True})
+    assert await stream_text(stream) == "d1 d1 d1 "
+    assert deployments[0].circuit_breaker.state == CircuitBreaker.OPEN
+    assert deployments[1].ttft is not None
+
+
+@pytest.mark.asyncio
+async def test_fails_over_when_stream_drops_before_first_token(mock_deployments):
+    mocks, deployments = mock_deployments
+    mocks[0].disconnect_before_tokens = True
+    router = DeploymentRouter(deployments)
+    router.select = lambda exclude=(): next(d for d in deployments if d not in exclude)
+
+    stream = await router.create({"model": "gpt", "messages": MESSAGES, "stream": True})
+    assert await stream_text(stream) == "d1 d1 d1 "
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_headers_are_tracked_per_deployment(mock_deployments):
+    mocks, deployments = mock_deployments
+    mocks[1].status = 429
+    mocks[1].headers = {"retry-after": "20", "x-ratelimit-remaining-requests": "0"}
+    router = DeploymentRouter(deployments)
+    for deployment in deployments:
+        deployment.client._client.event_hooks["response"] = [router.observe_response]
+    router.select = lambda exclude=(): next(d for d in reversed(deployments) if d not in exclude)
+
+    response = await router.create({"model": "gpt", "messages": MESSAGES})
+    assert response.choices[0].message.content == "d0 d0 d0 "
+    assert deployments[1].rate_limit.remaining_requests == 0
+    assert 19 < deployments[1].rate_limit.retry_after() <= 20
+    assert deployments[0].rate_limit.retry_after() == 0
+    assert router.retry_after() == 0
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried(mock_deployments):
+    mocks, deployments = mock_deployments
+    mocks[0].status = 400
+    router = DeploymentRouter(deployments)
+    router.select = lambda exclude=(): next(d for d in deployments if d not in exclude)
+
+    with pytest.raises(BadRequestError):
+        await router.create({"model": "gpt", "messages": MESSAGES})
+    assert mocks[1].requests == 0
+    assert deployments[0].circuit_breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,75 @@
+import pytest
+from backend.cache.semantic_cache import SemanticCache
+
+EMBEDDINGS = {
+    "how do I sleep better": [1.0, 0.0, 0.0],
+    "tips for better sleep": [0.99, 0.1, 0.0],
+    "what should I eat": [0.0, 1.0, 0.0],
+}
+
+
+class FakeEmbeddingClient():
+    def __init__(self):
+        self.calls = 0
+
+    async def embed(self, text):
+        self.calls += 1
+        return EMBEDDINGS[text]
+
+
+def model_args(*turns, system="sys"):
+    messages = [{"role": "system", "content": system}]
+    for i, content in enumerate(turns):
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return {"messages": messages, "temperature": 0.0, "model": "gpt"}
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_hits_paraphrase():
+    cache = SemanticCache(FakeEmbeddingClient(), threshold=0.95)
+
+    cached, embedding = await cache.get(model_args("how do I sleep better"))
+    assert cached is None
+    cache.set(embedding, model_args("how do I sleep better"), {"frames": ["sleep"]}, 2.0)
+
+    cached, embedding = await cache.get(model_args("tips for better sleep"))
+    assert cached == {"frames": ["sleep"]}
+    assert embedding is None
+
+    cached, embedding = await cache.get(model_args("what should I eat"))
+    assert cached is None
+    assert embedding is not None
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_respects_namespace_and_history():
+    embedding_client = FakeEmbeddingClient()
+    cache = SemanticCache(embedding_client, threshold=0.95, max_turns=1)
+    _, embedding = await cache.get(model_args("how do I sleep better"))
+    cache.set(embedding, model_args("how do I sleep better"), {"frames": ["sleep"]}, 2.0)
+
+    cached, _ = await cache.get(model_args("how do I sleep better", system="other"))
+    assert cached is None
+
+    calls = embedding_client.calls
+    cached, embedding = await cache.get(model_args("hi", "hello", "how do I sleep better"))
+    assert cached is None and embedding is None
+    assert embedding_client.calls == calls
+
+
+def test_semantic_cache_evicts_least_recently_used():
+    cache = SemanticCache(None, max_entries=2, threshold=0.95)
+    cache.add([1.0, 0.0, 0.0], "ns", "a")
+    cache.add([0.0, 1.0, 0.0], "ns", "b")
+    assert cache.lookup([1.0, 0.0, 0.0], "ns")[0] == "a"
+
+    cache.add([0.0, 0.0, 1.0], "ns", "c")
+    assert len(cache) == 2
+    assert cache.lookup([0.0, 1.0, 0.0], "ns") is None
+    assert cache.lookup([1.0, 0.0, 0.0], "ns")[0] == "a"
+
+
+def test_semantic_cache_skips_expired_entries():
+    cache = SemanticCache(None, ttl=-1, threshold=0.5)
+    cache.add([1.0, 0.0], "ns", "a")
+    assert cache.lookup([1.0, 0.0], "ns") is None
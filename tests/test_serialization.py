@@ -0,0 +1,50 @@
+import uuid
+import datetime
+import dataclasses
+import pytest
+from quart import Quart, jsonify
+from backend import serialization
+from backend.serialization import FastJSONProvider, SERIALIZERS, StdlibSerializer, create_serializer
+
+
+@dataclasses.dataclass
+class Chunk():
+    content: str
+    title: str
+
+
+SAMPLE = {
+    "chunk": Chunk("héllo", "doc"),
+    "created": datetime.datetime(2024, 2, 1, 12, 0, 0, 123456),
+    "id": uuid.UUID(int=1),
+    "vector": [0.25, -1.5, 3.0],
+    "flags": [True, None],
+}
+
+
+@pytest.mark.parametrize("backend", [name for name, (_, available) in SERIALIZERS.items() if available()])
+def test_backends_produce_identical_output(backend):
+    serializer = create_serializer(backend)
+    expected = StdlibSerializer().dumps(SAMPLE)
+    assert serializer.dumps(SAMPLE) == expected
+    assert serializer.loads(serializer.dumps_bytes(SAMPLE))["chunk"] == {"content": "héllo", "title": "doc"}
+    assert serializer.dumps({"b": 1, "a": 2}, sort_keys=True) == '{"a":2,"b":1}'
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_serializer("yaml")
+
+
+def test_unserializable_object_raises_type_error():
+    with pytest.raises(TypeError):
+        serialization.dumps({"value": object()})
+
+
+@pytest.mark.asyncio
+async def test_jsonify_uses_fast_provider():
+    app = Quart(__name__)
+    app.json = FastJSONProvider(app)
+    async with app.app_context():
+        response = jsonify({"chunk": Chunk("a", "b")})
+        assert await response.get_data(as_text=True) == '{"chunk":{"content":"a","title":"b"}}\n'
@@ -0,0 +1,60 @@
+import os
+import pytest
+from backend import metrics
+from backend.aoai.stream_metrics import (
+    STREAM_CHUNK_GAP_SECONDS, STREAM_DURATION_SECONDS, STREAM_FIRST_FLUSH_SECONDS, STREAM_TOKENS, STREAMS, StreamTimer,
+)
+
+
+async def body(timer, chunks, fail=False):
+    for has_content in chunks:
+        timer.chunk(has_content)
+        yield "line\n"
+    if fail:
+        raise RuntimeError("upstream failed")
+
+
+@pytest.mark.asyncio
+async def test_completed_stream_is_recorded():
+    streams = STREAMS.get(outcome="completed")
+    tokens = STREAM_TOKENS.get()
+    gaps = STREAM_CHUNK_GAP_SECONDS.get()
+    flushes = STREAM_FIRST_FLUSH_SECONDS.get()
+
+    timer = StreamTimer()
+    timer.upstream_call()
+    assert [data async for data in timer.timed(body(timer, [False, True, True, True]))] == ["line\n"] * 4
+
+    assert STREAMS.get(outcome="completed") == streams + 1
+    assert STREAM_TOKENS.get() == (tokens[0] + 1, tokens[1] + 3)
+    assert STREAM_CHUNK_GAP_SECONDS.get()[0] == gaps[0] + 3
+    assert STREAM_FIRST_FLUSH_SECONDS.get()[0] == flushes[0] + 1
+    assert f'chat_streams_total{{outcome="completed",node="{metrics.NODE}",worker="{os.getpid()}"}}' in metrics.REGISTRY.render()
+
+
+@pytest.mark.asyncio
+async def test_aborted_and_failed_streams_are_told_apart():
+    aborted = STREAMS.get(outcome="aborted")
+    failed = STREAMS.get(outcome="error")
+    completed = STREAM_DURATION_SECONDS.get(outcome="completed")
+
+    timer = StreamTimer()
+    timer.upstream_call()
+    stream = timer.timed(body(timer, [True] * 10))
+    await stream.__anext__()
+    ## the client went away
+    await stream.aclose()
+    assert STREAMS.get(outcome="aborted") == aborted + 1
+
+    timer = StreamTimer()
+    timer.upstream_call()
+    with pytest.raises(RuntimeError):
+        async for _ in timer.timed(body(timer, [True], fail=True)):
+            pass
+    assert STREAMS.get(outcome="error") == failed + 1
+
+    ## a replay from the response cache never called upstream
+    timer = StreamTimer()
+    async for _ in timer.timed(body(timer, [True, True])):
+        pass
+    assert STREAM_DURATION_SECONDS.get(outcome="completed") == completed
@@ -0,0 +1,162 @@
+import copy
+import uuid
+import pytest
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from backend.user.userdetailsservice import CosmosUserDetailsClient
+
+
+class InMemoryContainer():
+    def __init__(self, partition_key='userId'):
+        self.partition_key = partition_key
+        self.items = {}
+        self.calls = []
+
+    def _store(self, item):
+        item = copy.deepcopy(item)
+        item['_etag'] = str(uuid.uuid4())
+        self.items[(item[self.partition_key], item['id'])] = item
+        return copy.deepcopy(item)
+
+    async def read_item(self, item, partition_key):
+        self.calls.append('read_item')
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return copy.deepcopy(self.items[(partition_key, item)])
+
+    async def create_item(self, body):
+        self.calls.append('create_item')
+        if (body[self.partition_key], body['id']) in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="exists")
+        return self._store(body)
+
+    async def delete_item(self, item, partition_key):
+        self.calls.append('delete_item')
+        del self.items[(partition_key, item)]
+
+    async def patch_item(self, item, partition_key, patch_operations, etag=None, match_condition=None):
+        self.calls.append('patch_item')
+        assert len(patch_operations) <= 10
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        current = self.items[(partition_key, item)]
+        if match_condition == MatchConditions.IfNotModified and current['_etag'] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+        for operation in patch_operations:
+            current[operation['path'].lstrip('/')] = operation['value']
+        return self._store(current)
+
+    async def query_items(self, query, parameters, partition_key=None, enable_cross_partition_query=False):
+        self.calls.append('query_items')
+        assert (partition_key is None) == enable_cross_partition_query
+        for (pk, _), item in list(self.items.items()):
+            if pk == partition_key or (enable_cross_partition_query and item['userId'] == parameters[0]['value']):
+                yield copy.deepcopy(item)
+
+
+@pytest.fixture
+def user_details_client():
+    client = CosmosUserDetailsClient.__new__(CosmosUserDetailsClient)
+    client.container_client = InMemoryContainer()
+    client.partition_key_path = '/userId'
+    return client
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_uses_point_reads(user_details_client):
+    profile, created = await user_details_client.get_or_create_user_details("user-1")
+    assert created
+    assert profile['id'] == "user-1"
+
+    user_details_client.container_client.calls.clear()
+    profile, created = await user_details_client.get_or_create_user_details("user-1")
+    assert not created
+    assert user_details_client.container_client.calls == ['read_item']
+
+
+@pytest.mark.asyncio
+async def test_legacy_profile_is_migrated(user_details_client):
+    container = user_details_client.container_client
+    container._store({'id': 'random-id', 'userId': 'user-1', 'answers': ['a']})
+
+    profile = await user_details_client.get_user_details("user-1")
+    assert profile['id'] == "user-1"
+    assert profile['answers'] == ['a']
+    assert list(container.items) == [('user-1', 'user-1')]
+
+
+@pytest.mark.asyncio
+async def test_update_patches_fields_in_chunks(user_details_client):
+    await user_details_client.get_or_create_user_details("user-1")
+    data = {f"field{i}": i for i in range(15)}
+    data['id'] = 'ignored'
+
+    profile = await user_details_client.update_user_details("user-1", data)
+    assert profile['id'] == "user-1"
+    assert profile['field14'] == 14
+    assert profile['answers'] == []
+
+
+@pytest.mark.asyncio
+async def test_update_creates_missing_profile(user_details_client):
+    profile = await user_details_client.update_user_details("user-2", {"answers": ["x"]})
+    assert profile['answers'] == ["x"]
+
+
+@pytest.mark.asyncio
+async def test_update_with_stale_etag_fails(user_details_client):
+    profile, _ = await user_details_client.get_or_create_user_details("user-1")
+    await user_details_client.update_user_details("user-1", {"answers": ["x"]}, etag=profile['_etag'])
+
+    with pytest.raises(exceptions.CosmosAccessConditionFailedError):
+        await user_details_client.update_user_details("user-1", {"answers": ["y"]}, etag=profile['_etag'])
+
+
+class PartitionedContainer():
+    def __init__(self, paths):
+        self.paths = paths
+
+    async def read(self):
+        return {'id': 'userdetails', 'partitionKey': {'paths': self.paths, 'kind': 'Hash'}}
+
+
+class ReadableDatabase():
+    async def read(self):
+        return {'id': 'db'}
+
+
+@pytest.mark.asyncio
+async def test_ensure_reads_the_partition_key(user_details_client):
+    user_details_client.database_client = ReadableDatabase()
+    user_details_client.container_name = 'userdetails'
+
+    user_details_client.container_client = PartitionedContainer(['/userId'])
+    assert (await user_details_client.ensure())[0]
+    assert user_details_client.partition_key_path == '/userId'
+
+    user_details_client.container_client = PartitionedContainer(['/id'])
+    assert (await user_details_client.ensure())[0]
+    assert user_details_client.partition_key_path == '/id'
+
+    user_details_client.container_client = PartitionedContainer(['/tenantId', '/userId'])
+    ok, message = await user_details_client.ensure()
+    assert not ok
+    assert message == "CosmosDB container userdetails must be partitioned on /userId, not ['/tenantId', '/userId']"
+
+
+@pytest.mark.asyncio
+async def test_profiles_in_a_container_partitioned_otherwise(user_details_client):
+    container = user_details_client.container_client = InMemoryContainer(partition_key='id')
+    user_details_client.partition_key_path = '/id'
+    ## a profile written before point reads, with a random id
+    container._store({'id': 'random-id', 'userId': 'user-1', 'answers': ['a']})
+
+    profile, created = await user_details_client.get_or_create_user_details("user-1")
+    assert not created and profile['answers'] == ['a']
+    profile = await user_details_client.update_user_details("user-1", {"answers": ["b"]}, etag=profile['_etag'])
+    assert profile['id'] == 'random-id' and profile['answers'] == ['b']
+
+    profile = await user_details_client.update_user_details("user-2", {"answers": ["c"]})
+    assert (await user_details_client.get_user_details("user-2"))['answers'] == ["c"]
+    assert sorted(container.items) == [('random-id', 'random-id'), ('user-2', 'user-2')]
+    assert 'read_item' not in container.calls
@@ -1,5 +1,18 @@
+import json
+import asyncio
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend.utils import format_as_ndjson, format_as_delta_ndjson, parse_multi_columns
+
+
+def stream_frame(content, role="assistant", history_metadata=None):
+    return {
+        "id": "chatcmpl-1",
+        "model": "gpt-35-turbo",
+        "created": 1700000000,
+        "object": "chat.completion.chunk",
+        "choices": [{"messages": [{"role": role, "content": content}]}],
+        "history_metadata": history_metadata if history_metadata is not None else {"conversation_id": "c1"},
+    }
 
 
 @pytest.mark.asyncio
@@ -8,7 +21,7 @@ async def test_format_as_ndjson():
         yield {"message": "test message\n"}
 
     async for event in format_as_ndjson(dummy_generator()):
-        assert event == '{"message": "test message\\n"}\n'
+        assert event == '{"message":"test message\\n"}\n'
 
 
 @pytest.mark.asyncio
@@ -27,3 +40,54 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+@pytest.mark.asyncio
+async def test_format_as_delta_ndjson_coalesces_content():
+    async def dummy_generator():
+        yield stream_frame('[{"title": "doc"}]', role="tool")
+        yield {}
+        for token in ["Hello", " ", "world", "!"]:
+            yield stream_frame(token)
+
+    lines = [json.loads(line) async for line in format_as_delta_ndjson(dummy_generator(), flush_interval=10, flush_bytes=1024)]
+    assert lines == [
+        {"h": {"id": "chatcmpl-1", "model": "gpt-35-turbo", "created": 1700000000, "object": "chat.completion.chunk", "history_metadata": {"conversation_id": "c1"}}},
+        {"tool": '[{"title": "doc"}]'},
+        {"d": "Hello world!"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_format_as_delta_ndjson_flushes_on_size_and_time():
+    async def dummy_generator():
+        yield stream_frame("abcd")
+        yield stream_frame("efgh")
+        yield stream_frame("ij")
+        await asyncio.sleep(0.05)
+        yield stream_frame("kl")
+
+    lines = [json.loads(line) async for line in format_as_delta_ndjson(dummy_generator(), flush_interval=0.01, flush_bytes=8)]
+    assert [line.get("d") for line in lines[1:]] == ["abcdefgh", "ij", "kl"]
+
+
+@pytest.mark.asyncio
+async def test_format_as_delta_ndjson_sends_metadata_changes():
+    async def dummy_generator():
+        yield stream_frame("a", history_metadata={"conversation_id": "c1", "title": "New chat"})
+        yield stream_frame("b", history_metadata={"conversation_id": "c1", "title": "Greeting"})
+
+    lines = [json.loads(line) async for line in format_as_delta_ndjson(dummy_generator(), flush_interval=10, flush_bytes=1024)]
+    assert lines[0]["h"]["history_metadata"]["title"] == "New chat"
+    assert lines[1:] == [{"d": "a"}, {"m": {"conversation_id": "c1", "title": "Greeting"}}, {"d": "b"}]
+
+
+@pytest.mark.asyncio
+async def test_format_as_delta_ndjson_exception():
+    async def dummy_generator():
+        yield stream_frame("partial")
+        raise Exception("test exception")
+
+    lines = [line async for line in format_as_delta_ndjson(dummy_generator(), flush_interval=10, flush_bytes=1024)]
+    assert json.loads(lines[-2]) == {"d": "partial"}
+    assert lines[-1] == '{"error": "test exception"}'
@@ -0,0 +1,120 @@
+import dataclasses
+import httpx
+import numpy as np
+import pytest
+from backend.search.retrieval import FallbackSearchClient, Retriever, SearchClient
+from backend.search.vector_index import LocalSearchClient, VectorIndex, build_vector_index
+from benchmarks.mock_search import MockAzureSearch, start_mock_search
+
+
+@dataclasses.dataclass
+class Chunk():
+    content: str
+    id: str = None
+    title: str = None
+    contentVector: list = None
+
+
+@dataclasses.dataclass
+class Chunks():
+    chunks: list
+    total_files: int = 1
+
+
+def clustered_vectors(count, dimensions=32, clusters=8, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimensions))
+    return centers[rng.integers(clusters, size=count)] + 0.3 * rng.normal(size=(count, dimensions))
+
+
+def exact_top_k(vectors, queries, k):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+
+
+def test_flat_search_is_exact_and_batched(tmp_path):
+    vectors = clustered_vectors(500)
+    documents = [{"id": str(i), "content": f"chunk {i}", "contentVector": vector.tolist()} for i, vector in enumerate(vectors)]
+    index = build_vector_index(documents, str(tmp_path))
+    queries = clustered_vectors(7, seed=1)
+
+    scores, rows = index.search(queries, k=10)
+    assert scores.shape == rows.shape == (7, 10)
+    assert (rows == exact_top_k(vectors, queries, 10)).all()
+    assert (np.diff(scores, axis=1) <= 0).all()
+    assert index.document(int(rows[0, 0])) == {"id": str(rows[0, 0]), "content": f"chunk {rows[0, 0]}"}
+
+
+def test_reloaded_index_is_memory_mapped(tmp_path):
+    vectors = clustered_vectors(50)
+    chunks = Chunks([Chunk(f"chunk {i}", id=str(i), contentVector=vector.tolist()) for i, vector in enumerate(vectors)] + [Chunk("no embedding")])
+    build_vector_index(chunks, str(tmp_path)).close()
+
+    index = VectorIndex.load(str(tmp_path))
+    assert isinstance(index.vectors, np.memmap)
+    assert len(index) == 50 and index.dimensions == 32
+    _, rows = index.search(vectors[3], k=1)
+    assert index.document(int(rows[0, 0]))["title"] is None and index.document(int(rows[0, 0]))["id"] == "3"
+
+
+def test_ivf_search_recall(tmp_path):
+    vectors = clustered_vectors(2000)
+    documents = [{"id": str(i), "content": str(i), "contentVector": vector.tolist()} for i, vector in enumerate(vectors)]
+    index = build_vector_index(documents, str(tmp_path), ivf_lists=16)
+    queries = clustered_vectors(20, seed=2)
+    expected = exact_top_k(vectors, queries, 10)
+
+    ## documents are stored grouped by list, so compare ids rather than rows
+    def ids(rows):
+        return [{int(index.document(int(row))["id"]) for row in query_rows} for query_rows in rows]
+
+    _, rows = index.search(queries, k=10, nprobe=16)
+    assert ids(rows) == [set(query_rows) for query_rows in expected]
+
+    _, rows = index.search(queries, k=10, nprobe=4)
+    recall = np.mean([len(found & set(query_rows)) / 10 for found, query_rows in zip(ids(rows), expected)])
+    assert recall > 0.9
+
+
+@pytest.mark.asyncio
+async def test_local_search_client_filters_and_embeds(tmp_path):
+    documents = [
+        {"id": "1", "content": "a", "groups": ["x"], "contentVector": [1.0, 0.0]},
+        {"id": "2", "content": "b", "groups": ["y"], "contentVector": [0.9, 0.1]},
+        {"id": "3", "content": "c", "groups": ["x"], "contentVector": [0.0, 1.0]},
+    ]
+    client = LocalSearchClient(build_vector_index(documents, str(tmp_path)))
+
+    results = await client.search({"vectorQueries": [{"vector": [1.0, 0.0]}], "top": 2, "filter": "groups/any(g:search.in(g, 'x'))"})
+    assert [result["id"] for result in results] == ["1", "3"]
+    assert results[0]["@search.score"] == pytest.approx(1.0)
+
+    async def embed(text):
+        return [0.0, 1.0]
+
+    client.embed = embed
+    assert (await client.search({"search": "anything", "top": 1}))[0]["id"] == "3"
+
+
+@pytest.mark.asyncio
+async def test_retriever_falls_back_to_local_index(tmp_path):
+    documents = [{"id": "1", "content": "local passage", "contentVector": [1.0, 0.0]}]
+    local = LocalSearchClient(build_vector_index(documents, str(tmp_path)))
+    mock = MockAzureSearch([{"id": "9", "content": "remote passage"}])
+    mock.status = 503
+    runner, url = await start_mock_search(mock)
+    search_client = FallbackSearchClient(SearchClient(url, "index", httpx.AsyncClient()), local, failure_threshold=1)
+
+    async def embed(text):
+        return [1.0, 0.0]
+
+    local.embed = embed
+    retriever = Retriever(search_client, result_cache_ttl=0)
+    assert [document["id"] for document in (await retriever.retrieve("passage")).documents] == ["1"]
+    ## the service is ejected after the failure, the next search goes straight to the local index
+    await retriever.retrieve("passage")
+    assert mock.requests == 1
+
+    await search_client.close()
+    await runner.cleanup()